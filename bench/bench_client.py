@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Benchmark request throughput through the in-memory test client
+
+Requests go through the full parse, dispatch and write path without
+sockets, one after the other on a keep-alive connection and then with
+several connections at once.
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import grole
+
+def make_app():
+    app = grole.Grole()
+    app._logger.disabled = True
+
+    @app.route('/text')
+    def text(env, req):
+        return 'Hello, World!'
+
+    @app.route('/json', methods=['POST'])
+    def echo(env, req):
+        return req.json()
+
+    return app
+
+async def sequential(client, method, path, count, **kwargs):
+    start = time.perf_counter()
+    for _ in range(count):
+        await client.request(method, path, **kwargs)
+    return count / (time.perf_counter() - start)
+
+async def concurrent(client, path, count, width):
+    async def worker():
+        for _ in range(count // width):
+            await client.get(path)
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(width)])
+    return count / (time.perf_counter() - start)
+
+async def main(count=50000):
+    app = make_app()
+    async with app.test_client() as client:
+        await app.warmup()
+        print('GET text, keep-alive:      {:8.0f} req/s'.format(
+            await sequential(client, 'GET', '/text', count)))
+        print('POST json, keep-alive:     {:8.0f} req/s'.format(
+            await sequential(client, 'POST', '/json', count, json={'a': [1, 2, 3]})))
+        print('GET text, 50 connections:  {:8.0f} req/s'.format(
+            await concurrent(client, '/text', count, 50)))
+
+if __name__ == '__main__':
+    asyncio.new_event_loop().run_until_complete(main())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Benchmark server memory (RSS) against the number of open connections
+
+A server runs in a child process, then connections are opened to it in
+steps. Each sends one keep-alive request and is left idle. The server's
+RSS is read from /proc (Linux) at each step, for the default settings
+and for tighter read and write buffer limits.
+
+Usage: bench_connections.py [max connections, default 10000]
+"""
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import grole
+
+CONFIGS = [('default', {}),
+           ('tuned', {'read_limit': 8192, 'max_header_size': 8192, 'max_headers': 50,
+                      'write_limits': (16384, 4096)})] # Limits options
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+def serve(port, config):
+    """
+    Child process, run a server with the named config
+    """
+    raise_fd_limit()
+    app = grole.Grole(limits=grole.Limits(**dict(CONFIGS)[config]))
+    app._logger.disabled = True
+
+    @app.route('/')
+    def hello(env, req):
+        return 'Hello, World!'
+
+    app.run(listeners=[grole.Listener('127.0.0.1', port, backlog=4096)])
+
+def rss(pid):
+    """
+    Resident set size of process pid in KiB
+    """
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+async def connect(port, count, connections):
+    async def one():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET / HTTP/1.1\r\nHost: bench\r\n\r\n')
+        await reader.readuntil(b'Hello, World!')
+        connections.append(writer)
+    for start in range(0, count, 500):
+        await asyncio.gather(*[one() for _ in range(min(500, count - start))])
+
+async def measure(config, port, steps):
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve', str(port), config])
+    connections = []
+    try:
+        for _ in range(100):
+            try:
+                await connect(port, 1, connections)
+                break
+            except OSError:
+                await asyncio.sleep(0.05)
+        await asyncio.sleep(0.2)
+        base = rss(proc.pid)
+        print('{:8} {:>11} {:>10} {:>14}'.format(config, 'connections', 'RSS MiB', 'KiB/connection'))
+        for step in steps:
+            await connect(port, step - len(connections), connections)
+            await asyncio.sleep(0.5) # Let the server settle
+            used = rss(proc.pid)
+            print('{:8} {:11} {:10.1f} {:14.2f}'.format(
+                '', len(connections), used / 1024, (used - base) / (len(connections) - 1)))
+    finally:
+        for writer in connections:
+            writer.close()
+        proc.kill()
+        proc.wait()
+
+def main(count=10000):
+    limit = raise_fd_limit()
+    if count * 2 + 100 > limit:
+        count = (limit - 100) // 2
+        print('Limited to {} connections by RLIMIT_NOFILE'.format(count))
+    steps = sorted({max(count * i // 5, 2) for i in range(1, 6)})
+    loop = asyncio.new_event_loop()
+    for i, (config, _) in enumerate(CONFIGS):
+        loop.run_until_complete(measure(config, 18000 + i, steps))
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve(int(sys.argv[2]), sys.argv[3])
+    else:
+        main(*[int(x) for x in sys.argv[1:]])
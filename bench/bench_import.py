@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark the time taken to import grole and to serve the first request
+
+Each measurement is run in a fresh interpreter. The cost of importing
+asyncio, which grole can not avoid, is reported separately. The latency of
+the first request to a new Grole object, with and without warmup, is
+compared to that of the thousandth.
+"""
+import asyncio
+import os
+import py_compile
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+IMPORT = '''
+import time
+{}
+start = time.perf_counter()
+import {}
+print(time.perf_counter() - start)
+'''
+
+def best(code, runs=20):
+    """
+    Best time in ms printed by code run in a new interpreter
+    """
+    times = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+        times.append(float(out) * 1000)
+    return min(times)
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.sent = False
+
+    async def readline(self):
+        if self.sent:
+            return b''
+        self.sent = True
+        return self.data
+
+    async def readexactly(self, n):
+        return b''
+
+    def at_eof(self):
+        return self.sent
+
+class Writer:
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def get_extra_info(self, name):
+        return None
+
+def requests(warmup, count=1000):
+    """
+    Print times in ms of the first, second and last of count requests to a new app
+    """
+    sys.path.insert(0, ROOT)
+    import grole
+    app = grole.Grole()
+    grole.serve_static(app, '/static', ROOT)
+
+    loop = asyncio.new_event_loop()
+    if warmup:
+        loop.run_until_complete(app.warmup())
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        loop.run_until_complete(app._handle(Reader(b'GET /static/README.rst HTTP/1.1\r\n\r\n'), Writer()))
+        times.append((time.perf_counter() - start) * 1000)
+    loop.close()
+    print('{:.3f} {:.3f} {:.3f}'.format(times[0], times[1], times[-1]))
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--requests':
+        return requests(sys.argv[2] == 'warm')
+
+    # Exclude byte-compiling grole from the measurements
+    py_compile.compile(os.path.join(ROOT, 'grole.py'))
+    base = best(IMPORT.format('', 'asyncio'))
+    own = best(IMPORT.format('import asyncio', 'grole'))
+    print('import asyncio:                      {:8.2f} ms'.format(base))
+    print('import grole (after asyncio):        {:8.2f} ms'.format(own))
+    for mode in ('cold', 'warm'):
+        out = subprocess.check_output([sys.executable, __file__, '--requests', mode])
+        first, second, last = out.decode().split()
+        print('1st / 2nd / 1000th request ({}): {:>6} / {} / {} ms'.format(mode, first, second, last))
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
-from grole import Grole
-import ssl
+from grole import Grole, TLSContext
 
 # Create an SSL context from keys created through e.g. Let's Encrypt or self signing:
 # Generate a self signed cert with:
@@ -11,9 +10,10 @@ import ssl
 #   openssl req -new -sha256 -key cert.key -subj "/CN=localhost" -out cert.csr
 #   openssl x509 -req -in cert.csr -CA rootCA.crt -CAkey rootCA.key -CAcreateserial -out cert.crt -days 500 -sha256
 # If using a self signed cert, you can access the server using: curl --cacert rootCA.crt https://localhost:8443
-ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-ssl_context.load_cert_chain('cert.crt', keyfile='cert.key')
-ssl_context.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
+#
+# TLSContext enables session resumption and ALPN, and picks up renewed
+# certificates without a restart. ssl_context.stats() reports handshakes.
+ssl_context = TLSContext('cert.crt', keyfile='cert.key')
 
 app = Grole()
 
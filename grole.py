@@ -2,21 +2,22 @@
 """
 Grole is a python (3.5+) nano web framework based on asyncio. It's goals are to be simple, embedable (single file and standard library only) and easy to use.
 """
+# Modules only needed by the static file server, command line or profiling
+# are imported where they are used to keep importing grole fast
 import asyncio
-import socket
-import json
 import re
-import urllib
-import traceback
-import inspect
+import urllib.parse
 import io
-import mimetypes
-import pathlib
-import html
+import importlib
+import os
+import signal
+import stat
+import struct
 import sys
-import argparse
+import threading
+import time
 import logging
-from collections import defaultdict
+from collections import defaultdict, deque, Counter, OrderedDict
 
 __author__ = 'witchard'
 __version__ = '0.3.0'
@@ -35,41 +36,90 @@ class Request:
       * headers:  Dictionary of headers from the request
       * data:     Raw data from the request body
       * match:    The re.MatchObject from the successful path matching 
+      * peer:     The client address, as given by the transport (None if unknown)
+
+    If the handler's route was registered with buffer=False, data is empty
+    and the body is instead read with read() or multipart().
     """
+    def __init__(self, json_backend=None):
+        """
+        Create a request
+
+        Parameters:
+
+            * json_backend: JSONBackend used by json(), default is the stdlib json module
+        """
+        self._json = json_backend or _default_json
+        self.peer = None
+        self.timing = None # List of (phase, perf_counter_ns) when timing is enabled
+        self._conn = None # _Connection the request arrived on
+        self._slot = False # Holds a FairQueue slot
+        self._reader = None # Set when the body is streamed
+        self._remaining = 0 # Unread body bytes when streaming
+        self._offset = 0 # Position of read() in data when buffered
 
     async def _read(self, reader):
         """
         Parses HTTP request into member variables
         """
-        start_line = await self._readline(reader)
-        self.method, self.location, self.version = start_line.decode().split()
-        path_query = urllib.parse.unquote(self.location).split('?', 1)
-        self.path = path_query[0]
-        self.query = {}
-        if len(path_query) > 1:
-            for q in path_query[1].split('&'):
-                try:
-                    k, v = q.split('=', 1)
-                    self.query[k] = v
-                except ValueError:
-                    self.query[q] = None
+        await self._read_head(reader)
+        await self._buffer_body(reader)
+
+    async def _read_head(self, reader, max_size=None, max_count=None):
+        """
+        Parses the request line and headers into member variables
+
+        Raises HTTPError if the request line and headers are larger than
+        max_size bytes, or there are more than max_count headers.
+        """
+        start_line = await self._readline(reader, 414, 'URI Too Long')
+        if self.timing is not None:
+            self._mark('start')
+        size = len(start_line)
+        if max_size is not None and size > max_size:
+            raise HTTPError(414, 'URI Too Long')
+        self._set_start(*start_line.decode().split())
         self.headers = {}
+        count = 0
         while True:
             header_raw = await self._readline(reader)
             if header_raw.strip() == b'':
                 break
+            size += len(header_raw)
+            count += 1
+            if ((max_size is not None and size > max_size) or
+                    (max_count is not None and count > max_count)):
+                raise HTTPError(431, 'Request Header Fields Too Large')
             header = header_raw.decode().split(':', 1)
             self.headers[header[0]] = header[1].strip()
 
         # TODO implement chunked handling
         self.data = b''
-        await self._buffer_body(reader)
 
-    async def _readline(self, reader):
+    def _set_start(self, method, location, version):
+        """
+        Set the members from the request line, parsing the path and query
+        """
+        self.method, self.location, self.version = method, location, version
+        path_query = urllib.parse.unquote(self.location).split('?', 1)
+        self.path = path_query[0]
+        self.query = {}
+        if len(path_query) > 1:
+            for q in path_query[1].split('&'):
+                try:
+                    k, v = q.split('=', 1)
+                    self.query[k] = v
+                except ValueError:
+                    self.query[q] = None
+
+    async def _readline(self, reader, code=431, reason='Request Header Fields Too Large'):
         """
-        Readline helper
+        Readline helper, raises HTTPError(code, reason) if the line is over the reader's limit
         """
-        ret = await reader.readline()
+        try:
+            ret = await reader.readline()
+        except ValueError:
+            raise HTTPError(code, reason)
         if len(ret) == 0 and reader.at_eof():
             raise EOFError()
         return ret
@@ -85,6 +135,63 @@ class Request:
             except asyncio.IncompleteReadError:
                 raise EOFError()
 
+    def _stream_body(self, reader):
+        """
+        Leave the body of the request to be read by the handler
+        """
+        self._reader = reader
+        self._remaining = int(self.headers.get('Content-Length', 0))
+
+    async def _discard_body(self):
+        """
+        Read and drop any of a streamed body left unread by the handler
+        """
+        while self._remaining > 0:
+            await self.read(io.DEFAULT_BUFFER_SIZE * 16)
+
+    async def read(self, n=-1):
+        """
+        Read up to n bytes of the body, or all of it if n is negative
+
+        Returns b'' at the end of the body.
+        """
+        if self._reader is None:
+            end = len(self.data) if n < 0 else self._offset + n
+            ret = self.data[self._offset:end]
+            self._offset += len(ret)
+            return ret
+        if n < 0 or n > self._remaining:
+            n = self._remaining
+        if n == 0:
+            return b''
+        ret = await self._reader.read(n)
+        if len(ret) == 0:
+            raise EOFError()
+        self._remaining -= len(ret)
+        return ret
+
+    def multipart(self, **kwargs):
+        """
+        Parse a multipart/form-data body incrementally
+
+        Returns a MultipartParser, an async iterator of MultipartPart.
+        Keyword arguments are passed to MultipartParser.
+        """
+        return MultipartParser(self, **kwargs)
+
+    def _mark(self, phase):
+        """
+        Record the end of a processing phase for timing
+        """
+        self.timing.append((phase, _perf_counter_ns()))
+
+    def _phases(self):
+        """
+        Yield (phase, duration in ns) from the recorded timing marks
+        """
+        for (_, start), (phase, end) in zip(self.timing, self.timing[1:]):
+            yield phase, end - start
+
     def body(self):
         """
         Decodes body as string
@@ -95,7 +202,358 @@ class Request:
         """
         Decodes json object from the body
         """
-        return json.loads(self.body())
+        return self._json.loads(self.data)
+
+class HTTPError(Exception):
+    """
+    Raise from a handler to send an error response
+
+    Parameters:
+
+        * code: The response code
+        * reason: The response reason
+    """
+    def __init__(self, code, reason):
+        super().__init__('{} {}'.format(code, reason))
+        self.code = code
+        self.reason = reason
+
+class MultipartError(HTTPError):
+    """
+    Malformed or too large multipart/form-data body
+    """
+    def __init__(self, message, code=400, reason='Bad Request'):
+        HTTPError.__init__(self, code, reason)
+        self.args = (message,)
+
+class MultipartPart:
+    """
+    A field or file from a multipart/form-data body
+
+    The following members are populated:
+
+      * name:         Form field name
+      * filename:     Uploaded file name, None for plain fields
+      * content_type: Content-Type of the part, default text/plain
+      * headers:      Dictionary of the part's headers
+      * size:         Size of the content in bytes
+      * file:         File object holding the content, in memory until
+                      larger than the spool size and on disk after
+
+    Call close() to remove any temporary file.
+    """
+    def __init__(self, headers, spool_size):
+        self.headers = headers
+        self.content_type = headers.get('Content-Type', 'text/plain')
+        params = _header_params(headers.get('Content-Disposition', ''))
+        self.name = params.get('name')
+        self.filename = params.get('filename')
+        self.size = 0
+        import tempfile
+        self.file = tempfile.SpooledTemporaryFile(spool_size)
+
+    def _write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def read(self):
+        """
+        Return the whole content as bytes
+        """
+        self.file.seek(0)
+        return self.file.read()
+
+    def text(self, encoding='utf-8'):
+        """
+        Return the whole content decoded as a string
+        """
+        return self.read().decode(encoding)
+
+    def close(self):
+        """
+        Release the content
+        """
+        self.file.close()
+
+def _header_params(value):
+    """
+    Parse the parameters from a header value like: form-data; name="foo"
+    """
+    params = {}
+    for key, val in re.findall(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)', value):
+        if val.startswith('"'):
+            val = re.sub(r'\\(.)', r'\1', val[1:-1])
+        else:
+            val = val.strip()
+        params[key.lower()] = val
+    return params
+
+class MultipartParser:
+    """
+    Incremental multipart/form-data parser
+
+    An async iterator yielding a MultipartPart as each one is received.
+    Only one chunk of the body is held in memory at a time, part content
+    above spool_size is written to a temporary file.
+    """
+    def __init__(self, req, spool_size=1024 * 1024, max_parts=1000,
+                 max_part_size=None, max_header_size=16 * 1024,
+                 chunk_size=64 * 1024):
+        """
+        Create a parser for the body of req
+
+        Parameters:
+
+            * req: Request with a multipart/form-data body
+            * spool_size: Bytes of each part to keep in memory before using a temporary file
+            * max_parts: Maximum number of parts
+            * max_part_size: Maximum size of a part in bytes, default unlimited
+            * max_header_size: Maximum size of the headers of a part
+            * chunk_size: Bytes to read from the body at a time
+        """
+        boundary = _header_params(req.headers.get('Content-Type', '')).get('boundary')
+        if not boundary:
+            raise MultipartError('No multipart boundary')
+        self._req = req
+        self._delimiter = b'\r\n--' + boundary.encode()
+        self._buf = b'\r\n' # So the first delimiter looks like the others
+        self._eof = False
+        self._started = False
+        self._done = False
+        self.parts = 0
+        self.spool_size = spool_size
+        self.max_parts = max_parts
+        self.max_part_size = max_part_size
+        self.max_header_size = max_header_size
+        self.chunk_size = chunk_size
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._started:
+            self._started = True
+            # Skip the preamble up to the first delimiter
+            while True:
+                index = self._buf.find(self._delimiter)
+                if index >= 0:
+                    self._buf = self._buf[index + len(self._delimiter):]
+                    break
+                self._buf = self._buf[-len(self._delimiter):]
+                await self._fill()
+        if self._done:
+            raise StopAsyncIteration()
+
+        # After a delimiter comes -- for the end or a line ending for a part
+        while len(self._buf) < 2:
+            await self._fill()
+        if self._buf.startswith(b'--'):
+            self._done = True
+            await self._req._discard_body() # Epilogue
+            raise StopAsyncIteration()
+
+        self.parts += 1
+        if self.parts > self.max_parts:
+            raise MultipartError('Too many parts', 413, 'Payload Too Large')
+        part = MultipartPart(await self._headers(), self.spool_size)
+        try:
+            await self._content(part)
+        except:
+            part.close()
+            raise
+        return part
+
+    async def _fill(self):
+        """
+        Read the next chunk of the body into the buffer
+        """
+        data = await self._req.read(self.chunk_size)
+        if len(data) == 0:
+            raise MultipartError('Unexpected end of multipart body')
+        self._buf += data
+
+    async def _headers(self):
+        """
+        Read the headers of a part
+        """
+        while True:
+            index = self._buf.find(b'\r\n\r\n')
+            if index >= 0:
+                break
+            if len(self._buf) > self.max_header_size:
+                raise MultipartError('Part headers too large', 413, 'Payload Too Large')
+            await self._fill()
+        headers = {}
+        for line in self._buf[:index].decode().split('\r\n')[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip()] = value.strip()
+        self._buf = self._buf[index + 4:]
+        return headers
+
+    async def _content(self, part):
+        """
+        Read the content of a part, up to the next delimiter
+        """
+        keep = len(self._delimiter) - 1 # Could be the start of a split delimiter
+        while True:
+            index = self._buf.find(self._delimiter)
+            end = index if index >= 0 else max(0, len(self._buf) - keep)
+            if end:
+                part._write(self._buf[:end])
+                self._buf = self._buf[end:]
+            if self.max_part_size is not None and part.size > self.max_part_size:
+                raise MultipartError('Part too large', 413, 'Payload Too Large')
+            if index >= 0:
+                self._buf = self._buf[len(self._delimiter):]
+                part.file.seek(0)
+                return
+            await self._fill()
+
+if hasattr(time, 'perf_counter_ns'):
+    _perf_counter_ns = time.perf_counter_ns
+else: # Python < 3.7
+    def _perf_counter_ns():
+        return int(time.perf_counter() * 1e9)
+
+class JSONBackend:
+    """
+    Pluggable JSON encoder / decoder
+
+    Wraps a module providing dumps and loads, by default the stdlib json
+    module. Use the name auto to pick the fastest importable module out of
+    orjson, ujson and rapidjson, falling back to the stdlib if none are present.
+    """
+    FAST = ('orjson', 'ujson', 'rapidjson')
+
+    def __init__(self, name='json'):
+        """
+        Select the JSON module to use
+
+        Parameters:
+
+            * name: Module name, e.g. json or orjson, or auto to pick the fastest available
+        """
+        self._module = None
+        if name == 'json':
+            # Always available, imported on first use
+            self.name = name
+            return
+        candidates = self.FAST + ('json',) if name == 'auto' else (name,)
+        for candidate in candidates:
+            try:
+                self._module = importlib.import_module(candidate)
+                self.name = candidate
+                return
+            except ImportError:
+                pass
+        raise ImportError('No JSON module available from {}'.format(', '.join(candidates)))
+
+    @property
+    def module(self):
+        """
+        The JSON module in use
+        """
+        if self._module is None:
+            import json
+            self._module = json
+        return self._module
+
+    def dumps(self, data):
+        """
+        Encodes data as json bytes
+        """
+        ret = self.module.dumps(data)
+        if isinstance(ret, str):
+            ret = ret.encode()
+        return ret
+
+    def loads(self, data):
+        """
+        Decodes json from bytes or a string
+        """
+        if isinstance(data, bytes) and sys.version_info < (3, 6):
+            data = data.decode() # stdlib json only accepts bytes from 3.6
+        return self.module.loads(data)
+
+_default_json = JSONBackend()
+
+def _write_chunk(writer, data):
+    """
+    Write data to writer using chunked transfer encoding framing
+
+    Writers which frame the body themselves (e.g. for ASGI) provide a
+    write_chunk method which is used instead, an empty chunk ends the body.
+    """
+    framed = getattr(writer, 'write_chunk', None)
+    if framed is not None:
+        return framed(data)
+    writer.write(format(len(data), 'x').encode() + b'\r\n')
+    writer.write(data)
+    writer.write(b'\r\n')
+
+def _coalesce(iterable, size=io.DEFAULT_BUFFER_SIZE):
+    """
+    Join small string pieces from iterable into chunks of at least size characters
+    """
+    parts = []
+    length = 0
+    for part in iterable:
+        parts.append(part)
+        length += len(part)
+        if length >= size:
+            yield ''.join(parts)
+            parts = []
+            length = 0
+    if parts:
+        yield ''.join(parts)
+
+FILE_WORKERS = 4 # Threads used for filesystem access by ResponseFile and serve_static
+_file_pool = (None, None) # (pid, executor)
+
+def _file_executor():
+    """
+    Return the bounded thread pool used for blocking filesystem calls
+
+    It is created on first use with FILE_WORKERS threads, and again in a
+    forked child as the threads of the parent's pool don't survive the fork.
+    """
+    global _file_pool
+    pid, pool = _file_pool
+    if pool is None or pid != os.getpid():
+        import concurrent.futures
+        pool = concurrent.futures.ThreadPoolExecutor(FILE_WORKERS)
+        _file_pool = (os.getpid(), pool)
+    return pool
+
+def _in_file_pool(func, *args):
+    """
+    Run func(*args) on the file thread pool and return an awaitable result
+    """
+    return asyncio.get_event_loop().run_in_executor(_file_executor(), func, *args)
+
+def _read_size(size):
+    """
+    Choose how much of a file of size bytes to read at once
+
+    Files under 64KiB are read in one go (asking for one byte more than the
+    size means the short read marks EOF). Larger files are read in chunks
+    of an eighth of the file, kept between 64KiB and 1MiB.
+    """
+    if size < 1 << 16:
+        return size + 1
+    return min(max(size // 8, 1 << 16), 1 << 20)
+
+def _open_file(filename):
+    """
+    Open filename for reading, returns the file and its size
+    """
+    f = io.FileIO(filename)
+    try:
+        return f, os.fstat(f.fileno()).st_size
+    except:
+        f.close()
+        raise
 
 class ResponseBody:
     """
@@ -121,6 +579,12 @@ class ResponseBody:
         """
         headers.update(self._headers)
 
+    async def _head(self, headers):
+        """
+        Adjust headers for a response to HEAD, the body won't be written
+        """
+        pass
+
     async def _write(self, writer):
         """
         Write out the data
@@ -143,11 +607,56 @@ class ResponseString(ResponseBody):
         """
         super().__init__(data.encode(), content_type)
 
+class ResponseStream(ResponseBody):
+    """
+    Response body from an iterable of chunks
+
+    The iterable (or async iterable) yields bytes or strings which are sent as
+    they are produced using chunked transfer encoding.
+    """
+    def __init__(self, iterable, content_type='text/plain'):
+        """
+        Initialise object, iterable provides the data to send
+
+        Parameters:
+
+            * iterable: Iterable or async iterable of bytes / strings to send
+            * content_type: Value of Content-Type header, default text/plain
+        """
+        self._headers = {'Transfer-Encoding': 'chunked',
+                         'Content-Type': content_type}
+        self._iterable = iterable
+
+    async def _write(self, writer):
+        """
+        Write out each chunk as it is produced followed by the terminating chunk
+        """
+        if hasattr(self._iterable, '__aiter__'):
+            async for data in self._iterable:
+                await self._write_data(writer, data)
+        else:
+            for data in self._iterable:
+                await self._write_data(writer, data)
+        _write_chunk(writer, b'')
+        await writer.drain()
+
+    async def _write_data(self, writer, data):
+        if isinstance(data, str):
+            data = data.encode()
+        if len(data) > 0: # Empty chunk would terminate the body
+            _write_chunk(writer, data)
+            await writer.drain()
+
 class ResponseJSON(ResponseString):
     """
     Response body encoded in json
+
+    With stream set the object is encoded incrementally with
+    json.JSONEncoder.iterencode and sent using chunked transfer encoding,
+    avoiding holding the whole encoded document in memory.
     """
-    def __init__(self, data='', content_type='application/json'):
+    def __init__(self, data='', content_type='application/json', stream=False,
+                 backend=None):
         """
         Initialise object, data is the data to send
     
@@ -155,8 +664,32 @@ class ResponseJSON(ResponseString):
 
             * data: Object to encode as json for sending
             * content_type: Value of Content-Type header, default application/json
+            * stream: Encode and send incrementally, default False
+            * backend: JSONBackend to encode with (when not streaming), default is the stdlib json module
+        """
+        if stream:
+            self._headers = {'Transfer-Encoding': 'chunked',
+                             'Content-Type': content_type}
+            import json
+            self._iterable = _coalesce(json.JSONEncoder().iterencode(data))
+        else:
+            self._iterable = None
+            backend = backend or _default_json
+            ResponseBody.__init__(self, backend.dumps(data), content_type)
+
+    async def _write(self, writer):
         """
-        super().__init__(json.dumps(data), content_type)
+        Write out the data, chunk by chunk when streaming
+        """
+        if self._iterable is None:
+            await super()._write(writer)
+        else:
+            await ResponseStream(self._iterable)._write(writer)
+
+    async def _head(self, headers):
+        if self._iterable is not None:
+            # Not encoded, so no length to give
+            headers.pop('Transfer-Encoding', None)
 
 class ResponseFile(ResponseBody):
     """
@@ -174,23 +707,47 @@ class ResponseFile(ResponseBody):
             * content_type: Value of Content-Type header, default is to guess from file extension
         """
         if content_type == None:
+            import mimetypes
             content_type = mimetypes.guess_type(filename)[0]
         self.filename = filename
         self._headers = {'Transfer-Encoding': 'chunked',
                          'Content-Type': content_type}
 
+    async def _head(self, headers):
+        # The size is enough, the file isn't opened
+        size = await _in_file_pool(os.path.getsize, self.filename)
+        headers.pop('Transfer-Encoding', None)
+        headers['Content-Length'] = size
+
     async def _write(self, writer):
-        f = io.FileIO(self.filename)
-        while True:
-            data = f.read(io.DEFAULT_BUFFER_SIZE)
-            header = format(len(data), 'x') + '\r\n'
-            writer.write(header.encode())
-            writer.write(data)
-            writer.write(b'\r\n')
-            await writer.drain()
-            if len(data) == 0:
-                f.close()
-                return # EOF
+        # File access happens on the file thread pool so a slow disk only
+        # holds up this response. The next chunk is read while the current
+        # one is being written.
+        f, size = await _in_file_pool(_open_file, self.filename)
+        chunk = _read_size(size)
+        pending = None
+        try:
+            pending = _in_file_pool(f.read, chunk)
+            while pending is not None:
+                data = await pending
+                pending = None
+                if data:
+                    # Reads may return less than asked (e.g. on network
+                    # filesystems), only an empty one is the end
+                    pending = _in_file_pool(f.read, chunk)
+                if data:
+                    _write_chunk(writer, data)
+                    await writer.drain()
+        finally:
+            if pending is not None:
+                # Let an outstanding read finish before closing the file
+                try:
+                    await pending
+                except Exception:
+                    pass
+            f.close()
+        _write_chunk(writer, b'') # EOF
+        await writer.drain()
 
 class Response:
     """
@@ -209,6 +766,9 @@ class Response:
           * version:  The response version, default HTTP/1.1
           * headers:  Dictionary of response headers, default is a Server header and those from the response body
 
+        A header value may be a list, sent as one header line per item (e.g.
+        for several Set-Cookie headers).
+
         Note, data is intelligently converted to an appropriate ResponseXYZ object depending on it's type.
         """
         self.version = version
@@ -219,13 +779,18 @@ class Response:
         self.data._set_headers(self.headers) # Update headers from data
         self.headers.update(headers) # Update headers from user
 
-    async def _write(self, writer):
+    async def _write(self, writer, head=False):
+        """
+        Write the response, with head set only the headers are written (for HEAD requests)
+        """
+        if head:
+            await self.data._head(self.headers)
         start_line = '{} {} {}\r\n'.format(self.version, self.code, self.reason)
-        headers = ['{}: {}'.format(x[0], x[1]) for x in self.headers.items()] 
-        header = start_line + '\r\n'.join(headers) + '\r\n\r\n'
+        header = start_line + ''.join(_header_lines(self.headers)) + '\r\n'
         writer.write(header.encode())
         await writer.drain()
-        await self.data._write(writer)
+        if not head:
+            await self.data._write(writer)
 
     def _create_body(self, data):
         if isinstance(data, ResponseBody):
@@ -239,81 +804,3202 @@ class Response:
         else:
             return ResponseJSON(data)
 
-def serve_static(app, base_url, base_path, index=False):
+def _header_lines(headers):
     """
-    Serve a directory statically
+    Yield the lines of a dictionary of response headers, one per item of a list value
+    """
+    for name, value in headers.items():
+        if isinstance(value, list):
+            for item in value:
+                yield '{}: {}\r\n'.format(name, item)
+        else:
+            yield '{}: {}\r\n'.format(name, value)
 
-    Parameters:
+def _add_header(headers, name, value):
+    """
+    Add a received header to a dictionary of response headers
 
-        * app: Grole application object
-        * base_url: Base URL to serve from, e.g. /static
-        * base_path: Base path to look for files in
-        * index: Provide simple directory indexes if True
+    Repeated headers are joined with commas, apart from Set-Cookie whose
+    values may contain commas, they become a list.
     """
-    @app.route(base_url + '/(.*)')
-    def serve(env, req):
+    if name not in headers:
+        headers[name] = value
+    elif name.lower() == 'set-cookie':
+        if not isinstance(headers[name], list):
+            headers[name] = [headers[name]]
+        headers[name].append(value)
+    else:
+        headers[name] += ', ' + value
+
+class _Prebuilt:
+    """
+    A response serialized once and written as is
+
+    Create one per request with prebuilt.copy(), headers added to the copy
+    (e.g. Connection: close) are written after the prebuilt ones.
+    """
+    def __init__(self, res):
         """
-        Static files
+        Serialize res, whose body must be a ResponseBody of bytes
         """
-        try:
-            base = pathlib.Path(base_path).resolve()
-            path = (base / req.match.group(1)).resolve()
-        except FileNotFoundError:
-            return Response(None, 404, 'Not Found')
+        self.code = res.code
+        self.headers = {}
+        # Own copy, headers added to res after this aren't part of it
+        self.template = Response(res.data, res.code, res.reason, res.headers, res.version)
+        start_line = '{} {} {}\r\n'.format(res.version, res.code, res.reason)
+        self._head = (start_line + ''.join(_header_lines(res.headers))).encode()
+        self._body = res.data._data
 
+    def copy(self):
+        res = _Prebuilt.__new__(_Prebuilt)
+        res.code = self.code
+        res.headers = {}
+        res.template = self.template
+        res._head = self._head
+        res._body = self._body
+        return res
 
-        # Don't let bad paths through
-        if base == path or base in path.parents:
-            if path.is_file():
-                return ResponseFile(str(path))
-            if index and path.is_dir():
-                if base == path:
-                    ret = ''
-                else:
-                    ret = '<a href="../">../</a><br/>\r\n'
-                for item in path.iterdir():
-                    name = item.parts[-1]
-                    if item.is_dir():
-                        name += '/'
-                    ret += '<a href="{}">{}</a><br/>\r\n'.format(urllib.parse.quote(name), html.escape(name))
-                ret = ResponseString(ret, 'text/html')
-                return ret
+    def response(self):
+        """
+        Return an equivalent Response, including headers added to this copy
+        """
+        t = self.template
+        res = Response(t.data, t.code, t.reason, t.headers, t.version)
+        res.headers.update(self.headers)
+        return res
 
-        return Response(None, 404, 'Not Found')
+    async def _write(self, writer, head=False):
+        body = b'' if head else self._body
+        if self.headers:
+            extra = ''.join(_header_lines(self.headers))
+            writer.write(self._head + extra.encode() + b'\r\n' + body)
+        else:
+            writer.write(self._head + b'\r\n' + body)
+        await writer.drain()
 
-def serve_doc(app, url):
+class _DirectoryIndex:
     """
-    Serve API documentation extracted from request handler docstrings
+    Directory listings for serve_static
 
-    Parameters:
-        * app: Grole application object
-        * url: URL to serve at
+    Directories are read with os.scandir, which avoids a stat per entry. The
+    rendered listing pages are cached and thrown away when the modification
+    time of the directory changes.
     """
-    @app.route(url, doc=False)
-    def index(env, req):
-        ret = ''
-        for d in env['doc']:
-            ret += 'URL: {url}, supported methods: {methods}{doc}\n'.format(**d)
-        return ret
+    CHUNK = 1000 # Entries per chunk when streaming html
 
-class Grole:
-    """
-    A Grole Webserver
-    """
-    def __init__(self, env={}):
+    def __init__(self, sort=True, page_size=None, max_cached=128):
+        self.sort = sort
+        self.page_size = page_size
+        self.max_cached = max_cached
+        self._cache = OrderedDict() # path -> (mtime, entries, rendered pages)
+        self._lock = threading.Lock() # Listings are built on the file thread pool
+
+    def _entries(self, path):
         """
-        Initialise a server
+        Return (entries, rendered) for path, rescanning if it has changed
+        """
+        key = str(path)
+        mtime = os.stat(key).st_mtime_ns
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] == mtime:
+                self._cache.move_to_end(key)
+                return cached[1], cached[2]
 
-        env is passed to request handlers to provide shared state.
-        Note, env by default contains doc which is populated from
-        registered route docstrings.
+        entries = [(entry.name, entry.is_dir()) for entry in os.scandir(key)]
+        if self.sort:
+            entries.sort()
+        cached = (mtime, entries, {})
+        with self._lock:
+            self._cache[key] = cached
+            if len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        return cached[1], cached[2]
+
+    def response(self, path, top, query):
         """
+        Create the response for a listing of path
+
+        Parameters:
+
+            * path: Directory to list
+            * top: True if this is the base directory (no parent link)
+            * query: Request query, page selects the page and format=json returns json
+        """
+        entries, rendered = self._entries(path)
+        fmt = 'json' if query.get('format') == 'json' else 'html'
+        pages = 1
+        page = 1
+        if self.page_size:
+            pages = max(1, -(-len(entries) // self.page_size))
+            try:
+                page = min(max(1, int(query.get('page') or 1)), pages)
+            except ValueError:
+                pass
+            entries = entries[(page - 1) * self.page_size:page * self.page_size]
+
+        chunks = rendered.get((fmt, page))
+        if chunks is None:
+            if fmt == 'json':
+                import json
+                chunks = [json.dumps({'page': page, 'pages': pages,
+                                      'entries': [{'name': name, 'dir': is_dir}
+                                                  for name, is_dir in entries]}).encode()]
+            else:
+                chunks = list(self._html(entries, top, page, pages))
+            rendered[(fmt, page)] = chunks
+
+        if fmt == 'json':
+            return ResponseBody(chunks[0], 'application/json')
+        return ResponseStream(chunks, 'text/html')
+
+    def _html(self, entries, top, page, pages):
+        """
+        Render html for entries in chunks
+        """
+        import html
+        lines = [] if top else ['<a href="../">../</a><br/>\r\n']
+        if page > 1:
+            lines.append('<a href="?page={}">&lt; previous</a><br/>\r\n'.format(page - 1))
+        for name, is_dir in entries:
+            if is_dir:
+                name += '/'
+            lines.append('<a href="{}">{}</a><br/>\r\n'.format(urllib.parse.quote(name), html.escape(name)))
+            if len(lines) >= self.CHUNK:
+                yield ''.join(lines).encode()
+                lines = []
+        if page < pages:
+            lines.append('<a href="?page={}">next &gt;</a><br/>\r\n'.format(page + 1))
+        if lines:
+            yield ''.join(lines).encode()
+
+class StaticPack:
+    """
+    Static files packed into one memory mapped file, see pack and serve_static
+
+    The file holds an index of path -> offset, length, mimetype and etag,
+    then the file contents and any gzip compressed variants. Opening it
+    reads the index, after which responses are served as slices of the
+    mapping without copying or any filesystem calls.
+    """
+    MAGIC = b'GROLEPK1'
+    _HEADER = struct.Struct('<8sQ') # magic, index length
+
+    def __init__(self, filename):
+        """
+        Map filename, a pack built by pack
+        """
+        import mmap
+        with open(filename, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_length = self._HEADER.unpack_from(self._mm)
+        if magic != self.MAGIC:
+            raise ValueError('{} is not a static pack'.format(filename))
+        start = self._HEADER.size + index_length
+        self._view = memoryview(self._mm)
+        self.files = {} # path -> (offset, length, mimetype, etag, gzip offset, gzip length)
+        import json
+        for entry in json.loads(self._mm[self._HEADER.size:start].decode()):
+            path, offset, length, mimetype, etag, gz_offset, gz_length = entry
+            if gz_offset is not None:
+                gz_offset += start
+            self.files[path] = (offset + start, length, mimetype, etag, gz_offset, gz_length)
+
+    def response(self, name, req):
+        """
+        Return the Response for file name (or its index.html) requested by req, None if not packed
+
+        The gzip variant is sent to clients accepting it and 304 Not Modified
+        to those with a matching If-None-Match.
+        """
+        entry = self.files.get(name)
+        if entry is None and (name == '' or name.endswith('/')):
+            entry = self.files.get(name + 'index.html')
+        if entry is None:
+            return None
+        offset, length, mimetype, etag, gz_offset, gz_length = entry
+        headers = {}
+        if gz_offset is not None:
+            headers['Vary'] = 'Accept-Encoding'
+            for coding in req.headers.get('Accept-Encoding', '').split(','):
+                coding, _, params = coding.partition(';')
+                if coding.strip() == 'gzip' and params.replace(' ', '') not in ('q=0', 'q=0.0'):
+                    offset, length = gz_offset, gz_length
+                    etag = etag[:-1] + '-gzip"' # Strong etags differ per encoding
+                    headers['Content-Encoding'] = 'gzip'
+                    break
+        headers['ETag'] = etag
+        match = req.headers.get('If-None-Match')
+        if match is not None and (match.strip() == '*' or etag in [x.strip() for x in match.split(',')]):
+            return Response(None, 304, 'Not Modified', headers)
+        body = ResponseBody(self._view[offset:offset + length], mimetype or 'application/octet-stream')
+        return Response(body, headers=headers)
+
+    def close(self):
+        self._view.release()
+        self._mm.close()
+
+def pack(directory, output, compress=True, min_compress=256):
+    """
+    Pack the files under directory into output, a StaticPack for serve_static
+
+    Parameters:
+
+        * directory: Directory of files to pack
+        * output: Pack file to write, replaced once complete
+        * compress: Store gzip variants of files which shrink by at least 10%
+        * min_compress: Don't compress files smaller than this
+
+    Returns the number of files packed.
+    """
+    import mimetypes
+    import hashlib
+    import zlib
+    entries = []
+    import tempfile
+    with tempfile.TemporaryFile() as data:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    content = f.read()
+                entry = [os.path.relpath(path, directory).replace(os.sep, '/'), data.tell(),
+                         len(content), mimetypes.guess_type(name)[0],
+                         '"{}"'.format(hashlib.sha1(content).hexdigest()[:20]), None, None]
+                data.write(content)
+                if compress and len(content) >= min_compress:
+                    gz = zlib.compressobj(9, zlib.DEFLATED, 31) # 31: gzip container
+                    gz = gz.compress(content) + gz.flush()
+                    if len(gz) <= len(content) * 0.9:
+                        entry[5:] = [data.tell(), len(gz)]
+                        data.write(gz)
+                entries.append(entry)
+        import json
+        index = json.dumps(entries).encode()
+        data.seek(0)
+        with open(output + '.tmp', 'wb') as f:
+            f.write(StaticPack._HEADER.pack(StaticPack.MAGIC, len(index)))
+            f.write(index)
+            while True:
+                chunk = data.read(1 << 20)
+                if not chunk:
+                    break
+                f.write(chunk)
+    os.replace(output + '.tmp', output)
+    return len(entries)
+
+def serve_static(app, base_url, base_path, index=False, sort=True, page_size=None):
+    """
+    Serve a directory statically
+
+    Parameters:
+
+        * app: Grole application object
+        * base_url: Base URL to serve from, e.g. /static
+        * base_path: Base path to look for files in, or a pack file built by pack
+        * index: Provide simple directory indexes if True
+        * sort: Sort directory indexes by name, default True
+        * page_size: Split directory indexes into pages of this many entries, default no paging
+
+    Directory indexes are available as json by adding ?format=json to the URL.
+
+    Files in a pack are served from memory (see StaticPack), with etags
+    and precompressed variants. Directories are served their index.html,
+    there are no directory indexes.
+    """
+    if os.path.isfile(base_path):
+        static_pack = StaticPack(base_path)
+
+        @app.route(base_url + '/(.*)')
+        def serve_pack(env, req):
+            """
+            Static files
+            """
+            res = static_pack.response(req.match.group(1), req)
+            if res is None:
+                return Response(None, 404, 'Not Found')
+            return res
+        return
+
+    import pathlib
+    listing = _DirectoryIndex(sort, page_size)
+
+    def lookup(name, query):
+        """
+        Find what to send for name, runs on the file thread pool
+        """
+        try:
+            base = pathlib.Path(base_path).resolve()
+            path = (base / name).resolve()
+        except FileNotFoundError:
+            return None
+
+        # Don't let bad paths through
+        if base == path or base in path.parents:
+            if path.is_file():
+                return ResponseFile(str(path))
+            if index and path.is_dir():
+                return listing.response(path, base == path, query)
+
+    @app.route(base_url + '/(.*)')
+    async def serve(env, req):
+        """
+        Static files
+        """
+        res = await _in_file_pool(lookup, req.match.group(1), req.query)
+        if res is None:
+            return Response(None, 404, 'Not Found')
+        return res
+
+_HOP_HEADERS = frozenset(['connection', 'keep-alive', 'proxy-authenticate',
+                          'proxy-authorization', 'te', 'trailer', 'trailers',
+                          'transfer-encoding', 'upgrade'])
+
+async def _read_response_head(reader):
+    """
+    Read the status line and headers of an HTTP response
+
+    Returns (version, code, reason, headers) where headers is a list of
+    (name, value) pairs. Interim responses such as 100 Continue are
+    skipped. Raises EOFError if the connection closes first.
+    """
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise EOFError()
+        version, code, reason = (line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        headers = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise EOFError()
+            if not line.strip():
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers.append((name.strip(), value.strip()))
+        if not 100 <= int(code) < 200 or int(code) == 101:
+            return version, int(code), reason, headers
+
+class _BodyReader:
+    """
+    Reads an HTTP response body framed by Content-Length, chunked transfer
+    encoding (when length is None and chunked is True) or the end of the
+    connection (length None)
+    """
+    def __init__(self, reader, length=None, chunked=False, chunk_size=1 << 16):
+        self._reader = reader
+        self._remaining = length
+        self._chunked = chunked
+        self._chunk_size = chunk_size
+        self._done = length == 0
+
+    async def read(self):
+        """
+        Return the next piece of the body, b'' at the end
+        """
+        if self._done:
+            return b''
+        reader = self._reader
+        if self._chunked:
+            size = int((await reader.readline()).split(b';', 1)[0], 16)
+            if size == 0:
+                while (await reader.readline()).strip(): # Trailers
+                    pass
+                self._done = True
+                return b''
+            data = await reader.readexactly(size)
+            await reader.readexactly(2)
+            return data
+        if self._remaining is None:
+            data = await reader.read(self._chunk_size)
+            self._done = not data
+            return data
+        data = await reader.read(min(self._remaining, self._chunk_size))
+        if not data:
+            raise EOFError()
+        self._remaining -= len(data)
+        self._done = self._remaining == 0
+        return data
+
+class UpstreamPool:
+    """
+    Keep-alive connections to an upstream HTTP server, used by proxy
+
+    At most max_size connections are open at once, further requests wait
+    for one to be released. Idle connections are reused most recently used
+    first, and closed once idle for idle_timeout seconds or if the upstream
+    has closed them. After failing to connect the upstream is treated as
+    down for retry_after seconds.
+
+    stats counts connects, reuses, retries, evicted connections and
+    failures, see also report().
+    """
+    def __init__(self, host, port, ssl_context=None, max_size=10, idle_timeout=30,
+                 retry_after=1):
+        """
+        Create an empty pool
+
+        Parameters:
+
+            * host: Upstream host
+            * port: Upstream port
+            * ssl_context: SSL context to connect with, None for plain HTTP
+            * max_size: Maximum number of connections
+            * idle_timeout: Seconds an idle connection is kept for
+            * retry_after: Seconds to fail requests for after a failed connect
+        """
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.retry_after = retry_after
+        self.stats = Counter()
+        self._idle = deque() # (reader, writer, time released), most recent last
+        self._in_use = 0
+        self._waiters = deque()
+        self._down_until = 0
+
+    def _usable(self, idle, now):
+        """
+        Health check an idle (reader, writer, time released) before reuse
+        """
+        reader, writer, released = idle
+        return (now - released <= self.idle_timeout
+                and not reader.at_eof() and not writer.transport.is_closing())
+
+    async def acquire(self):
+        """
+        Get a connection, returns (reader, writer, reused)
+
+        Raises ConnectionError if the upstream is down, or OSError from connecting.
+        """
+        if time.monotonic() < self._down_until:
+            raise ConnectionRefusedError('Upstream {}:{} is down'.format(self.host, self.port))
+        while self._in_use >= self.max_size:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._wake() # Woken for a free slot, pass it on
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self._in_use += 1
+        try:
+            now = time.monotonic()
+            while self._idle:
+                idle = self._idle.pop()
+                if self._usable(idle, now):
+                    self.stats['reuses'] += 1
+                    return idle[0], idle[1], True
+                self.stats['evicted'] += 1
+                idle[1].close()
+            try:
+                kwargs = {}
+                if self.ssl_context is not None:
+                    kwargs = {'ssl': self.ssl_context, 'server_hostname': self.host}
+                reader, writer = await asyncio.open_connection(self.host, self.port, **kwargs)
+            except OSError:
+                self.stats['failures'] += 1
+                self._down_until = time.monotonic() + self.retry_after
+                raise
+            self.stats['connects'] += 1
+            return reader, writer, False
+        except BaseException:
+            self._release_slot()
+            raise
+
+    def release(self, reader, writer, reuse=True):
+        """
+        Return a connection to the pool, closing it unless reuse is True
+        """
+        if reuse and not writer.transport.is_closing():
+            self._idle.append((reader, writer, time.monotonic()))
+            self._evict()
+        else:
+            writer.close()
+        self._release_slot()
+
+    def _release_slot(self):
+        self._in_use -= 1
+        self._wake()
+
+    def _wake(self):
+        """
+        Wake the first waiter for a free slot
+        """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def _evict(self):
+        """
+        Close the oldest idle connections once past idle_timeout
+        """
+        now = time.monotonic()
+        while self._idle and not self._usable(self._idle[0], now):
+            self.stats['evicted'] += 1
+            self._idle.popleft()[1].close()
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        while self._idle:
+            self._idle.popleft()[1].close()
+
+    def report(self):
+        """
+        Return a dictionary of pool statistics including the connection reuse rate
+        """
+        used = self.stats['connects'] + self.stats['reuses']
+        report = dict(self.stats)
+        report.update({'idle': len(self._idle), 'in_use': self._in_use,
+                       'reuse_rate': self.stats['reuses'] / used if used else 0})
+        return report
+
+class _UpstreamBody(ResponseBody):
+    """
+    Response body streamed from an upstream connection by proxy
+
+    The connection goes back to the pool once the body has been copied, or
+    is closed if that fails or this is dropped before being written.
+    """
+    def __init__(self, pool, reader, writer, headers, body, reuse):
+        self._headers = headers
+        self._body = body
+        self._reuse = reuse
+        self._lease = [pool, reader, writer]
+        import weakref
+        weakref.finalize(self, _UpstreamBody._release, self._lease, False)
+
+    @staticmethod
+    def _release(lease, reuse):
+        if lease:
+            pool, reader, writer = lease
+            del lease[:]
+            pool.release(reader, writer, reuse)
+
+    async def _head(self, headers):
+        # Reusable if the upstream sent no body either
+        self._release(self._lease, self._reuse and await self._body.read() == b'')
+
+    async def _write(self, writer):
+        reuse = False
+        chunked = 'Transfer-Encoding' in self._headers
+        try:
+            while True:
+                data = await self._body.read()
+                if not data:
+                    break
+                if chunked:
+                    _write_chunk(writer, data)
+                else:
+                    writer.write(data)
+                await writer.drain()
+            if chunked:
+                _write_chunk(writer, b'')
+                await writer.drain()
+            reuse = self._reuse
+        finally:
+            self._release(self._lease, reuse)
+
+def proxy(app, base_url, upstream, methods=['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'],
+          max_size=10, idle_timeout=30, retry_after=1, ssl_context=None, chunk_size=1 << 16):
+    """
+    Forward requests under base_url to an upstream HTTP server
+
+    Parameters:
+
+        * app: Grole application object
+        * base_url: Base URL to forward from, e.g. /api
+        * upstream: URL of the upstream, e.g. http://127.0.0.1:8080/v1
+        * methods: HTTP methods to forward
+        * max_size: Maximum number of upstream connections
+        * idle_timeout: Seconds to keep idle upstream connections open
+        * retry_after: Seconds to send 502 without trying after failing to connect
+        * ssl_context: SSL context for https upstreams, default is the system defaults
+        * chunk_size: Maximum size of reads when copying bodies
+
+    Request and response bodies are streamed rather than buffered. Hop by
+    hop headers aren't forwarded, and repeated response headers are
+    combined. A 502 Bad Gateway is sent if the upstream can't be reached.
+
+    Returns the UpstreamPool used, its report() gives the connection reuse rate.
+    """
+    url = urllib.parse.urlsplit(upstream)
+    if url.scheme == 'https':
+        if ssl_context is None:
+            import ssl
+            ssl_context = ssl.create_default_context()
+    else:
+        ssl_context = None
+    pool = UpstreamPool(url.hostname, url.port or (443 if ssl_context else 80), ssl_context,
+                        max_size, idle_timeout, retry_after)
+    prefix = url.path.rstrip('/')
+
+    async def send(req, reader, writer, head):
+        writer.write(head)
+        while True:
+            data = await req.read(chunk_size)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        await writer.drain()
+        return await _read_response_head(reader)
+
+    @app.route(base_url + '(/.*)?', methods=methods, buffer=False)
+    async def forward(env, req):
+        """
+        Proxied to an upstream server
+        """
+        if req.location.startswith(base_url):
+            target = req.location[len(base_url):]
+        else:
+            target = urllib.parse.quote(req.match.group(1) or '')
+            if '?' in req.location:
+                target += '?' + req.location.split('?', 1)[1]
+        if not target.startswith('/'):
+            target = '/' + target
+
+        drop = set(_HOP_HEADERS)
+        drop.update(x.strip().lower() for x in req.headers.get('Connection', '').split(','))
+        drop.add('host')
+        lines = ['{} {}{} HTTP/1.1'.format(req.method, prefix, target), 'Host: ' + url.netloc]
+        lines += ['{}: {}'.format(k, v) for k, v in req.headers.items() if k.lower() not in drop]
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        while True:
+            try:
+                reader, writer, reused = await pool.acquire()
+            except OSError:
+                return Response(None, 502, 'Bad Gateway')
+            try:
+                version, code, reason, headers = await send(req, reader, writer, head)
+                break
+            except (OSError, EOFError, ValueError):
+                pool.release(reader, writer, False)
+                if reused and not req.headers.get('Content-Length'):
+                    pool.stats['retries'] += 1
+                    continue # Idle connection closed by the upstream, try another
+                return Response(None, 502, 'Bad Gateway')
+            except BaseException:
+                pool.release(reader, writer, False)
+                raise
+
+        body_headers = {}
+        forwarded = {}
+        length = None
+        chunked = False
+        reuse = version == 'HTTP/1.1'
+        for name, value in headers:
+            lower = name.lower()
+            if lower == 'connection':
+                reuse = reuse and 'close' not in value.lower()
+            elif lower == 'transfer-encoding':
+                chunked = 'chunked' in value.lower()
+            elif lower == 'content-length':
+                length = int(value)
+            elif lower == 'content-type':
+                body_headers['Content-Type'] = value
+            elif lower not in _HOP_HEADERS:
+                _add_header(forwarded, name, value)
+
+        if req.method == 'HEAD' or code in (204, 304) or code < 200:
+            if length is not None:
+                body_headers['Content-Length'] = length
+            length = 0 # No body follows
+        elif chunked:
+            length = None
+            body_headers['Transfer-Encoding'] = 'chunked'
+        elif length is not None:
+            body_headers['Content-Length'] = length
+        else:
+            reuse = False
+            body_headers['Transfer-Encoding'] = 'chunked'
+        body = _BodyReader(reader, length, chunked, chunk_size)
+        body = _UpstreamBody(pool, reader, writer, body_headers, body, reuse)
+        return Response(body, code, reason, forwarded)
+
+    return pool
+
+class _ASGIBody(ResponseBody):
+    """
+    Response body streamed from the http.response.body messages of an ASGI
+    app mounted with serve_asgi
+    """
+    def __init__(self, headers, messages, task, finished):
+        self._headers = headers
+        self._messages = messages
+        self._finished = finished
+        import weakref
+        weakref.finalize(self, task.cancel) # Body never written
+
+    async def _head(self, headers):
+        if not self._finished.done():
+            self._finished.set_result(None)
+
+    async def _write(self, writer):
+        chunked = 'Transfer-Encoding' in self._headers
+        try:
+            while True:
+                message = await self._messages.get()
+                if message is None:
+                    break # App finished
+                if message['type'] != 'http.response.body':
+                    continue
+                data = message.get('body', b'')
+                if data:
+                    if chunked:
+                        _write_chunk(writer, data)
+                    else:
+                        writer.write(data)
+                    await writer.drain()
+                if not message.get('more_body', False):
+                    break
+            if chunked:
+                _write_chunk(writer, b'')
+                await writer.drain()
+        finally:
+            if not self._finished.done():
+                self._finished.set_result(None) # App sees http.disconnect
+
+def serve_asgi(app, base_url, asgi_app,
+               methods=['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'],
+               chunk_size=1 << 16):
+    """
+    Dispatch requests under base_url to an ASGI application
+
+    Parameters:
+
+        * app: Grole application object
+        * base_url: Base URL to mount the ASGI app on, e.g. /legacy
+        * asgi_app: ASGI 3 application, a coroutine function (scope, receive, send)
+        * methods: HTTP methods to dispatch
+        * chunk_size: Maximum size of request body pieces sent to the app
+
+    The ASGI app sees base_url as root_path and the rest of the URL as
+    path. Request and response bodies are streamed.
+    """
+    from http import HTTPStatus
+
+    @app.route(base_url + '(/.*)?', methods=methods, buffer=False)
+    async def asgi(env, req):
+        """
+        Served by an ASGI application
+        """
+        if req.location.startswith(base_url):
+            target = req.location[len(base_url):]
+        else:
+            target = urllib.parse.quote(req.match.group(1) or '')
+            if '?' in req.location:
+                target += '?' + req.location.split('?', 1)[1]
+        raw_path, _, query = target.partition('?')
+        scope = {'type': 'http',
+                 'asgi': {'version': '3.0', 'spec_version': '2.1'},
+                 'http_version': req.version.split('/')[-1],
+                 'method': req.method,
+                 'scheme': 'http',
+                 'path': urllib.parse.unquote(raw_path or '/'),
+                 'raw_path': (raw_path or '/').encode('latin-1'),
+                 'query_string': query.encode('latin-1'),
+                 'root_path': base_url,
+                 'headers': [(k.lower().encode('latin-1'), str(v).encode('latin-1'))
+                             for k, v in req.headers.items()],
+                 'client': list(req.peer[:2]) if isinstance(req.peer, tuple) else None,
+                 'server': None}
+
+        loop = asyncio.get_event_loop()
+        messages = asyncio.Queue()
+        finished = loop.create_future()
+        sent = [False] # Request body sent
+
+        async def receive():
+            if sent[0]:
+                await asyncio.shield(finished)
+                return {'type': 'http.disconnect'}
+            data = await req.read(chunk_size)
+            sent[0] = req._remaining == 0
+            return {'type': 'http.request', 'body': data, 'more_body': not sent[0]}
+
+        async def send(message):
+            await messages.put(message)
+
+        def done(task):
+            messages.put_nowait(None)
+            if not task.cancelled() and task.exception() is not None:
+                app._logger.error('ASGI app at {} failed'.format(base_url), exc_info=task.exception())
+
+        task = asyncio.ensure_future(asgi_app(scope, receive, send))
+        task.add_done_callback(done)
+        try:
+            while True:
+                message = await messages.get()
+                if message is None:
+                    return Response(None, 500, 'Internal Server Error')
+                if message['type'] == 'http.response.start':
+                    break
+        except BaseException:
+            task.cancel()
+            raise
+
+        body_headers = {}
+        headers = {}
+        for name, value in message.get('headers', []):
+            name = name.decode('latin-1')
+            value = value.decode('latin-1')
+            lower = name.lower()
+            if lower == 'content-length':
+                body_headers['Content-Length'] = value
+            elif lower == 'content-type':
+                body_headers['Content-Type'] = value
+            elif lower not in _HOP_HEADERS:
+                _add_header(headers, name, value)
+        if 'Content-Length' not in body_headers:
+            body_headers['Transfer-Encoding'] = 'chunked'
+        status = message['status']
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ''
+        return Response(_ASGIBody(body_headers, messages, task, finished), status, reason, headers)
+
+async def _batch_call(app, req, sub, batch_url):
+    """
+    Run one sub-request of a serve_batch request through app
+
+    Returns the sub-response as a dictionary.
+    """
+    start = _perf_counter_ns()
+    path, _, query = sub['path'].partition('?')
+    if sub.get('query'):
+        extra = urllib.parse.urlencode(sub['query'], quote_via=urllib.parse.quote)
+        query = '&'.join(x for x in (query, extra) if x)
+    headers = {k: v for k, v in req.headers.items()
+               if k.lower() not in ('content-length', 'content-type', 'expect') and
+               k.lower() not in _HOP_HEADERS}
+    if 'json' in sub:
+        body = app.json.dumps(sub['json'])
+        headers['Content-Type'] = 'application/json'
+    else:
+        body = sub.get('body') or b''
+        if isinstance(body, str):
+            body = body.encode()
+    headers.update(sub.get('headers') or {})
+    if body:
+        headers['Content-Length'] = len(body)
+    if re.fullmatch(batch_url, urllib.parse.unquote(path)):
+        return {'status': 400, 'headers': {}, 'body': 'Nested batch', 'time': 0}
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+             'method': str(sub.get('method', 'GET')).upper(), 'scheme': 'http',
+             'path': urllib.parse.unquote(path), 'raw_path': path.encode('latin-1'),
+             'query_string': query.encode('latin-1'), 'root_path': '',
+             'headers': [(k.lower().encode('latin-1'), str(v).encode('latin-1'))
+                         for k, v in headers.items()],
+             'client': req.peer if isinstance(req.peer, tuple) else None, 'server': None}
+    sent = []
+    received = [False]
+
+    async def receive():
+        if received[0]:
+            return {'type': 'http.disconnect'}
+        received[0] = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    try:
+        await app(scope, receive, send)
+        data = b''.join(message.get('body', b'') for message in sent[1:])
+        headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in sent[0]['headers']}
+        ret = {'status': sent[0]['status'], 'headers': headers}
+        if data and headers.get('Content-Type', '').startswith('application/json'):
+            ret['json'] = app.json.loads(data)
+        else:
+            try:
+                ret['body'] = data.decode()
+            except UnicodeDecodeError:
+                import base64
+                ret['body'] = base64.b64encode(data).decode()
+                ret['encoding'] = 'base64'
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        import traceback
+        app._logger.error(traceback.format_exc())
+        ret = {'status': 500, 'headers': {}, 'body': ''}
+    ret['time'] = round((_perf_counter_ns() - start) / 1e6, 3)
+    return ret
+
+def serve_batch(app, url, max_requests=50, concurrency=10):
+    """
+    Serve an endpoint running several requests in one round trip
+
+    POST a json array of requests. Each is an object with path, which may
+    include a query string, and optionally method (default GET), query (an
+    object added to the query string), headers (an object) and either body
+    (a string) or json (an object sent json encoded). Headers of the batch
+    request, e.g. Authorization, are passed on to each request unless
+    overridden.
+
+    The requests are dispatched through the app's routes, with up to
+    concurrency running at once, and answered with a json array in the
+    same order. Each entry has the status, headers and time taken (ms) of
+    the response, and its body in json if it is json, otherwise in body as
+    text, or base64 encoded with encoding set to base64 if it isn't text.
+
+    Parameters:
+        * app: Grole application object
+        * url: URL to serve at
+        * max_requests: Most requests in a batch, larger batches get a 413
+        * concurrency: Most requests of a batch run at once
+    """
+    @app.route(url, methods=['POST'], doc=False)
+    async def batch(env, req):
+        try:
+            requests = req.json()
+        except ValueError:
+            requests = None
+        if not isinstance(requests, list) or \
+                not all(isinstance(sub, dict) and isinstance(sub.get('path'), str) for sub in requests):
+            return Response(None, 400, 'Bad Request')
+        if len(requests) > max_requests:
+            return Response(None, 413, 'Payload Too Large')
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(sub):
+            async with semaphore:
+                return await _batch_call(app, req, sub, url)
+
+        if req._slot:
+            app.fair_queue.release() # The requests take their own slots
+            req._slot = False
+            try:
+                return list(await asyncio.gather(*[run(sub) for sub in requests]))
+            finally:
+                # If cancelled while waiting the slot isn't held, so isn't released
+                await app.fair_queue.acquire(app.client_key(req))
+                req._slot = True
+        return list(await asyncio.gather(*[run(sub) for sub in requests]))
+
+def serve_doc(app, url):
+    """
+    Serve API documentation extracted from request handler docstrings
+
+    Parameters:
+        * app: Grole application object
+        * url: URL to serve at
+    """
+    @app.route(url, doc=False)
+    def index(env, req):
+        ret = ''
+        for d in env['doc']:
+            ret += 'URL: {url}, supported methods: {methods}{doc}\n'.format(**d)
+        return ret
+
+def serve_lag(app, url, token):
+    """
+    Serve event loop lag statistics from the app's LagMonitor as json
+
+    The report includes stack samples and request paths, so the page is
+    protected by token, given as for serve_profile.
+
+    Parameters:
+        * app: Grole application object, created with lag_threshold set
+        * url: URL to serve at
+        * token: Secret needed to view the page
+    """
+    @app.route(url, doc=False)
+    def lag(env, req):
+        if not _token_given(req, token):
+            return Response(None, 403, 'Forbidden')
+        if app.lag_monitor is None:
+            return Response(None, 404, 'Not Found')
+        return app.lag_monitor.report()
+
+def _token_given(req, token):
+    """
+    Check req carries token as ?token=... or in an "Authorization: Bearer ..." header
+    """
+    import hmac
+    given = req.query.get('token') or req.headers.get('Authorization', '')[len('Bearer '):]
+    return hmac.compare_digest(given.encode(), token.encode())
+
+def serve_connections(app, url, token):
+    """
+    Serve the buffer sizes of open connections as json, see Grole.connection_report
+
+    The report includes client addresses, so the page is protected by
+    token, given as for serve_profile.
+
+    Parameters:
+        * app: Grole application object
+        * url: URL to serve at
+        * token: Secret needed to view the page
+    """
+    @app.route(url, doc=False)
+    def connections(env, req):
+        if not _token_given(req, token):
+            return Response(None, 403, 'Forbidden')
+        return app.connection_report()
+
+def serve_profile(app, url, token):
+    """
+    Serve per route timing and sampled profiles as plain text
+
+    Timing requires the app to be created with timing=True and profiles with
+    profile_every set. The page is protected by token, which must be given
+    as ?token=... or in an "Authorization: Bearer ..." header.
+
+    Parameters:
+        * app: Grole application object
+        * url: URL to serve at
+        * token: Secret needed to view the page
+    """
+    @app.route(url, doc=False)
+    def profile(env, req):
+        if not _token_given(req, token):
+            return Response(None, 403, 'Forbidden')
+        ret = io.StringIO()
+        ret.write('Route timings in ms (count / mean / max):\n')
+        for route, phases in sorted(app.timings.items(), key=lambda x: str(x[0])):
+            ret.write('{}\n'.format(route))
+            for phase, (count, total, peak) in phases.items():
+                ret.write('  {:10} {:8} {:10.3f} {:10.3f}\n'.format(phase, count, total / count / 1e6, peak / 1e6))
+        if app.profile_stats is not None:
+            ret.write('\nProfile of {} sampled requests:\n'.format(app.profile_stats.requests))
+            app.profile_stats.stream = ret
+            app.profile_stats.sort_stats('cumulative').print_stats(50)
+        return ResponseString(ret.getvalue(), 'text/plain')
+
+class LagMonitor:
+    """
+    Watchdog measuring event loop scheduling lag
+
+    A coroutine sleeps for interval and measures how late it wakes up. A
+    helper thread watches for the loop failing to wake within threshold and
+    samples the stack of the loop thread, so that the blocking code and the
+    request being handled can be reported through the logger.
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float('inf'))
+
+    def __init__(self, threshold=0.1, interval=0.05, describe=None):
+        """
+        Create a monitor, call start from the event loop thread to begin
+
+        Parameters:
+
+            * threshold: Lag in seconds above which the loop is considered blocked
+            * interval: Seconds between lag measurements
+            * describe: Function given the running asyncio task returning what it is doing
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.describe = describe
+        self.histogram = Counter() # Upper bucket bound -> count
+        self.offenders = Counter() # Description -> times blocked
+        self.samples = deque(maxlen=10) # Recent blocking events
+        self.max_lag = 0
+        self._logger = logging.getLogger('grole')
+        self._beat = None
+        self._sampled = None
+        self._sample = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        Start monitoring the current event loop
+        """
+        self._loop = asyncio.get_event_loop()
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._task = self._loop.create_task(self._measure())
+        self._thread = threading.Thread(target=self._watch, name='grole-lag', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop monitoring
+        """
+        self._stop.set()
+        self._task.cancel()
+
+    async def _measure(self):
+        """
+        Measure how late the loop wakes up from sleeping
+        """
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0, time.monotonic() - self._beat - self.interval)
+            self.max_lag = max(self.max_lag, lag)
+            self.histogram[next(b for b in self.BUCKETS if lag <= b)] += 1
+            if lag > self.threshold:
+                self._blocked(lag)
+
+    def _blocked(self, lag):
+        """
+        Record the loop being blocked for lag seconds
+        """
+        what, stack = self._sample or ('unknown', '')
+        self._sample = None
+        self.offenders[what] += 1
+        self.samples.append({'lag': lag, 'during': what, 'stack': stack})
+        self._logger.warning('Event loop blocked for {:.3f}s during {}\n{}'.format(lag, what, stack))
+
+    def _watch(self):
+        """
+        Helper thread, sample the loop thread's stack when it is blocked
+        """
+        while not self._stop.wait(self.threshold / 4):
+            beat = self._beat
+            if beat is None or beat == self._sampled:
+                continue
+            if time.monotonic() - beat > self.interval + self.threshold:
+                self._sampled = beat
+                frame = sys._current_frames().get(self._loop_thread)
+                import traceback
+                stack = ''.join(traceback.format_stack(frame)) if frame else ''
+                what = 'unknown'
+                if self.describe is not None:
+                    try:
+                        what = self.describe(_current_task(self._loop)) or what
+                    except RuntimeError:
+                        pass # State changed under us, loop is no longer blocked
+                self._sample = (what, stack)
+
+    def report(self):
+        """
+        Lag statistics as a dictionary
+        """
+        return {'threshold': self.threshold,
+                'max_lag': self.max_lag,
+                'histogram': [[bound if bound != float('inf') else None, self.histogram[bound]]
+                              for bound in self.BUCKETS],
+                'offenders': dict(self.offenders),
+                'samples': list(self.samples)}
+
+async def _wait_for(coro, timeout):
+    """
+    Await coro, raising asyncio.TimeoutError after timeout seconds unless timeout is None
+    """
+    if timeout is None:
+        return await coro
+    return await asyncio.wait_for(coro, timeout)
+
+def _current_task(loop=None):
+    """
+    Return the running asyncio task
+    """
+    if hasattr(asyncio, 'current_task'):
+        return asyncio.current_task(loop)
+    return asyncio.Task.current_task(loop) # Python < 3.7
+
+class RateLimit:
+    """
+    Token bucket rate limiter, see Grole and Grole.route
+
+    Each client gets a bucket of burst tokens refilled at rate tokens per
+    second, and a request is rejected with 429 Too Many Requests when its
+    bucket is empty. Buckets live in a table of at most max_clients,
+    dropping the least recently seen; a bucket is also dropped once it
+    has been idle long enough to have refilled, as it is then no
+    different to a new one.
+    """
+    def __init__(self, rate, burst=None, key=None, max_clients=10000):
+        """
+        Parameters:
+
+            * rate: Requests per second allowed per client
+            * burst: Bucket size, the number of requests allowed at once, default max(1, rate)
+            * key: Function of the request returning the client key, default is the Grole client_key (peer address)
+            * max_clients: Maximum number of buckets kept
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.key = key
+        self.max_clients = max_clients
+        self._refill = self.burst / rate # Seconds for an empty bucket to fill
+        self._buckets = OrderedDict() # key -> [tokens, time of last update], least recent first
+        self._rejections = {} # Retry-After seconds -> _Prebuilt 429
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if len(buckets) <= self.max_clients and now - bucket[1] < self._refill:
+                break
+            del buckets[key]
+
+    def check(self, key, now=None):
+        """
+        Take a token for key, returns 0 if allowed or the seconds until a token is available
+        """
+        if now is None:
+            now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            self._evict(now)
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / self.rate
+
+    def rejection(self, wait):
+        """
+        Return a 429 response telling the client to retry after wait seconds
+        """
+        retry = max(1, int(-(-wait // 1)))
+        res = self._rejections.get(retry)
+        if res is None:
+            res = _Prebuilt(Response(None, 429, 'Too Many Requests', {'Retry-After': retry}))
+            if len(self._rejections) < 100:
+                self._rejections[retry] = res
+        return res.copy()
+
+class CachePolicy:
+    """
+    HTTP caching policy, see Grole.route and Grole.cache_policy
+
+    Sets Cache-Control, Expires and Vary on responses which aren't errors,
+    leaving any headers the handler set itself. Vary also gets
+    Accept-Encoding when the response has a Content-Encoding.
+
+    With server set, GET responses are also kept server side for max_age
+    seconds, keyed on the location and the request headers listed in vary.
+    For a further stale_while_revalidate seconds the stale response is
+    still sent, while the handler is run again in the background to
+    refresh it, with a GET request copying the request line and headers of
+    the one which found the response stale. Only 200 responses with an
+    unstreamed body are kept, so if the refresh fails the stale response
+    is used until it runs out. Responses are never kept for private or
+    no_store policies, or for requests with Authorization or Cookie
+    headers, as they may be specific to one user.
+    """
+    def __init__(self, max_age=None, s_maxage=None, public=False, private=False,
+                 no_cache=False, no_store=False, immutable=False,
+                 stale_while_revalidate=None, stale_if_error=None, vary=(),
+                 server=False, max_entries=1024):
+        """
+        Parameters:
+
+            * max_age: Seconds the response is fresh for, also sets Expires
+            * s_maxage: Seconds the response is fresh for in shared caches (e.g. a CDN)
+            * public: Shared caches may keep the response
+            * private: Only the client may keep the response
+            * no_cache: Caches must revalidate the response before using it
+            * no_store: The response must not be kept at all
+            * immutable: The response never changes, e.g. for assets with a hash in their name
+            * stale_while_revalidate: Seconds a stale response may be used while it is refreshed
+            * stale_if_error: Seconds a stale response may be used when refreshing it fails
+            * vary: Request headers the response depends on
+            * server: Keep responses server side, see above
+            * max_entries: Maximum number of responses kept server side
+        """
+        self.max_age = max_age
+        self.private = private
+        self.no_store = no_store
+        self.stale_while_revalidate = stale_while_revalidate
+        self.vary = list(vary)
+        self.server = server
+        self.max_entries = max_entries
+        directives = [('public', public), ('private', private), ('no-cache', no_cache),
+                      ('no-store', no_store), ('max-age', max_age), ('s-maxage', s_maxage),
+                      ('stale-while-revalidate', stale_while_revalidate),
+                      ('stale-if-error', stale_if_error), ('immutable', immutable)]
+        self.cache_control = ', '.join(
+            name if value is True else '{}={}'.format(name, int(value))
+            for name, value in directives if value is not None and value is not False)
+        self._entries = OrderedDict() # key -> (_Prebuilt, time stored), least recent first
+        self._refreshing = {} # key -> refresh task
+
+    def _apply(self, res):
+        """
+        Add the policy's headers to res, a Response or _Prebuilt
+        """
+        from email.utils import formatdate
+        headers = res.headers
+        existing = res.template.headers if isinstance(res, _Prebuilt) else headers
+        if self.cache_control and 'Cache-Control' not in existing:
+            headers['Cache-Control'] = self.cache_control
+        if self.max_age is not None and 'Expires' not in existing:
+            age = int(headers.get('Age', 0))
+            headers['Expires'] = formatdate(time.time() + self.max_age - age, usegmt=True)
+        vary = [v.strip() for v in existing.get('Vary', '').split(',') if v.strip()]
+        known = {v.lower() for v in vary}
+        missing = []
+        for name in self.vary + (['Accept-Encoding'] if 'Content-Encoding' in existing else []):
+            if name.lower() not in known:
+                known.add(name.lower())
+                missing.append(name)
+        if missing:
+            # Prebuilt headers can't be changed, an extra Vary line is equivalent
+            headers['Vary'] = ', '.join(missing if existing is not headers else vary + missing)
+
+    def _shared(self, req):
+        """
+        Whether the response to req may be kept server side and sent to anyone
+        """
+        if not self.server or self.private or self.no_store:
+            return False
+        return not any(name.lower() in ('authorization', 'cookie') for name in req.headers)
+
+    def _key(self, req):
+        """
+        Server side cache key of req
+        """
+        if not self.vary:
+            return req.location
+        headers = {k.lower(): v for k, v in req.headers.items()}
+        return (req.location,) + tuple(headers.get(name.lower()) for name in self.vary)
+
+    def _store(self, key, res):
+        """
+        Keep res server side, if it is a 200 with an unstreamed body
+        """
+        if res.code != 200 or getattr(res.data, '_data', None) is None:
+            return
+        self._entries[key] = (_Prebuilt(res), time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+class FairQueue:
+    """
+    Share handler execution fairly between clients, see Grole
+
+    At most concurrency handlers run at once. When requests are waiting,
+    free slots go to each waiting client in turn rather than in arrival
+    order, so a client with many requests can't starve the others.
+    """
+    def __init__(self, concurrency=10):
+        self.concurrency = concurrency
+        self._free = concurrency
+        self._queues = OrderedDict() # key -> deque of waiting futures
+
+    async def acquire(self, key):
+        """
+        Wait for a slot for client key
+        """
+        if self._free > 0 and not self._queues:
+            self._free -= 1
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+        queue.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release() # Got the slot as we were cancelled
+            elif waiter in queue:
+                queue.remove(waiter)
+                if not queue and self._queues.get(key) is queue:
+                    del self._queues[key]
+            raise
+
+    def release(self):
+        """
+        Free a slot, giving it to the next client waiting
+        """
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._free += 1
+
+class SharedCache:
+    """
+    Fixed size cache of byte values shared by worker processes
+
+    The table lives in a memory mapped file, every process opening the same
+    path (e.g. workers started with Listener(reuse_port=True)) sees one
+    cache, so its memory use and hit rate don't depend on the number of
+    workers. With no path an unlinked temporary file is used, shared with
+    processes forked after the cache is created.
+
+    The table is set associative: a key hashes to a set of ways slots and
+    when the set is full the slot replaced is chosen by the clock
+    algorithm. Reads take no lock, each slot has a sequence number which
+    is odd while the slot is being written and a read overlapping a write
+    is retried. Writers lock one of stripes byte ranges of the file (with
+    fcntl.lockf, where available) shared by every stripes'th set.
+
+    Keys are str or bytes, values bytes. Values too large for a slot are
+    not cached. stats counts this process's hits, misses, sets, evictions
+    and values too large, see also report().
+    """
+    MAGIC = b'GROLEC02'
+    _HEADER = struct.Struct('<8sIIII') # magic, sets, ways, slot size, stripes
+    _SLOT = struct.Struct('<QQdHIB') # seq, key hash, expiry time (0 for none), key length, value length, referenced
+    _REFERENCED = _SLOT.size - 1
+    _RETRIES = 100 # Reads overlapping a write before giving up
+
+    def __init__(self, path=None, slots=8192, slot_size=512, ways=8, stripes=64):
+        """
+        Open the cache in path, creating it if the file is empty or missing
+
+        Parameters:
+
+            * path: File to map, default an unlinked temporary file
+            * slots: Number of entries, a multiple of ways
+            * slot_size: Bytes per entry, holding the key, value and a 31 byte header
+            * ways: Slots per set, at most 255
+            * stripes: Number of write locks, the same in every process opening path
+        """
+        import mmap
+        import hashlib
+        if slots % ways or not 0 < ways < 256:
+            raise ValueError('slots must be a multiple of ways, which must be 1 to 255')
+        if slot_size <= self._SLOT.size:
+            raise ValueError('slot_size must be over {}'.format(self._SLOT.size))
+        self.sets = slots // ways
+        self.ways = ways
+        self.slot_size = slot_size
+        self.stripes = stripes
+        self.stats = Counter()
+        if hasattr(hashlib, 'blake2b'):
+            self._digest = lambda key: hashlib.blake2b(key, digest_size=8).digest()
+        else: # Python < 3.6, md5 isn't available on FIPS builds
+            self._digest = lambda key: hashlib.md5(key).digest()[:8]
+        self._hands = self._HEADER.size # One clock hand byte per set
+        self._slots = self._hands + (self.sets + 7) // 8 * 8
+        size = self._slots + slots * slot_size
+        try:
+            import fcntl
+            self._fcntl = fcntl
+        except ImportError:
+            self._fcntl = None # Only safe within one process
+        self._locks = [threading.Lock() for i in range(stripes)]
+
+        if path is None:
+            import tempfile
+            self._file = tempfile.TemporaryFile()
+        else:
+            self._file = open(os.open(path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b')
+        header = self._HEADER.pack(self.MAGIC, self.sets, ways, slot_size, stripes)
+        stripe = self._lock(stripes) # Guard creation with the lock after the stripes
+        try:
+            existing = os.fstat(self._file.fileno()).st_size
+            if existing == 0:
+                self._file.truncate(size)
+                self._file.write(header)
+                self._file.flush()
+            else:
+                self._file.seek(0)
+                if existing != size or self._file.read(len(header)) != header:
+                    raise ValueError('{} holds a cache of a different layout'.format(path))
+        except:
+            self._unlock(stripe)
+            self._file.close()
+            raise
+        self._unlock(stripe)
+        self._mm = mmap.mmap(self._file.fileno(), size)
+
+    def _lock(self, stripe):
+        self._locks[stripe % len(self._locks)].acquire()
+        if self._fcntl is not None:
+            self._fcntl.lockf(self._file.fileno(), self._fcntl.LOCK_EX, 1, stripe)
+        return stripe
+
+    def _unlock(self, stripe):
+        if self._fcntl is not None:
+            self._fcntl.lockf(self._file.fileno(), self._fcntl.LOCK_UN, 1, stripe)
+        self._locks[stripe % len(self._locks)].release()
+
+    def _key(self, key):
+        """
+        Return the key as bytes and its hash, which is the same in every process
+        """
+        if isinstance(key, str):
+            key = key.encode()
+        if not key:
+            raise ValueError('Empty key')
+        return key, int.from_bytes(self._digest(key), 'little') or 1
+
+    def _offset(self, index):
+        return self._slots + index * self.slot_size
+
+    def _find(self, first, key, key_hash):
+        """
+        Index of the slot holding key in the set starting at first, or None
+
+        Called with the set's stripe locked.
+        """
+        for index in range(first, first + self.ways):
+            offset = self._offset(index)
+            _, slot_hash, _, key_len, _, _ = self._SLOT.unpack_from(self._mm, offset)
+            if slot_hash == key_hash and key_len == len(key):
+                start = offset + self._SLOT.size
+                if self._mm[start:start + key_len] == key:
+                    return index
+        return None
+
+    def _victim(self, set_index, now):
+        """
+        Choose the slot to replace in a set, an empty or expired one if there is one
+        """
+        first = set_index * self.ways
+        for index in range(first, first + self.ways):
+            _, _, expires, key_len, _, _ = self._SLOT.unpack_from(self._mm, self._offset(index))
+            if key_len == 0 or (expires and expires <= now):
+                return index
+        # Clock: skip slots referenced since the hand last passed, clearing them
+        hand = self._hands + set_index
+        while True:
+            index = first + self._mm[hand]
+            self._mm[hand] = (self._mm[hand] + 1) % self.ways
+            referenced = self._offset(index) + self._REFERENCED
+            if self._mm[referenced]:
+                self._mm[referenced] = 0
+            else:
+                self.stats['evictions'] += 1
+                return index
+
+    def _write(self, index, key_hash, expires, key, value):
+        """
+        Replace the contents of a slot, seqlock style
+        """
+        offset = self._offset(index)
+        seq = self._SLOT.unpack_from(self._mm, offset)[0]
+        struct.pack_into('<Q', self._mm, offset, seq + 1) # Odd, readers retry
+        start = offset + self._SLOT.size
+        self._mm[start:start + len(key) + len(value)] = key + value
+        self._SLOT.pack_into(self._mm, offset, seq + 1, key_hash, expires, len(key), len(value), 0)
+        struct.pack_into('<Q', self._mm, offset, seq + 2)
+
+    def get(self, key, default=None):
+        """
+        Return the value of key, or default if it isn't cached or has expired
+        """
+        key, key_hash = self._key(key)
+        first = key_hash % self.sets * self.ways
+        for index in range(first, first + self.ways):
+            offset = self._offset(index)
+            for attempt in range(self._RETRIES):
+                seq, slot_hash, expires, key_len, value_len, referenced = \
+                    self._SLOT.unpack_from(self._mm, offset)
+                if seq & 1:
+                    continue # Being written
+                if slot_hash != key_hash or key_len != len(key):
+                    break
+                start = offset + self._SLOT.size
+                data = self._mm[start:start + key_len + value_len]
+                if struct.unpack_from('<Q', self._mm, offset)[0] != seq:
+                    continue # Changed while reading
+                if data[:key_len] != key:
+                    break
+                if expires and expires <= time.time():
+                    self.stats['misses'] += 1
+                    return default
+                if not referenced:
+                    self._mm[offset + self._REFERENCED] = 1
+                self.stats['hits'] += 1
+                return data[key_len:]
+        self.stats['misses'] += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache value for key, for ttl seconds or until evicted
+
+        Returns False if the value is too large to cache.
+        """
+        key, key_hash = self._key(key)
+        if self._SLOT.size + len(key) + len(value) > self.slot_size:
+            self.stats['too_large'] += 1
+            return False
+        now = time.time()
+        expires = now + ttl if ttl is not None else 0
+        set_index = key_hash % self.sets
+        stripe = self._lock(set_index % self.stripes)
+        try:
+            index = self._find(set_index * self.ways, key, key_hash)
+            if index is None:
+                index = self._victim(set_index, now)
+            self._write(index, key_hash, expires, key, bytes(value))
+        finally:
+            self._unlock(stripe)
+        self.stats['sets'] += 1
+        return True
+
+    def delete(self, key):
+        """
+        Remove key from the cache, returns whether it was there
+        """
+        key, key_hash = self._key(key)
+        set_index = key_hash % self.sets
+        stripe = self._lock(set_index % self.stripes)
+        try:
+            index = self._find(set_index * self.ways, key, key_hash)
+            if index is not None:
+                self._write(index, 0, 0, b'', b'')
+        finally:
+            self._unlock(stripe)
+        return index is not None
+
+    def clear(self):
+        """
+        Remove every entry
+        """
+        for set_index in range(self.sets):
+            stripe = self._lock(set_index % self.stripes)
+            try:
+                for index in range(set_index * self.ways, (set_index + 1) * self.ways):
+                    self._write(index, 0, 0, b'', b'')
+            finally:
+                self._unlock(stripe)
+
+    def report(self):
+        """
+        Return a dictionary of this process's cache statistics including the hit rate
+        """
+        lookups = self.stats['hits'] + self.stats['misses']
+        report = dict(self.stats)
+        report.update({'slots': self.sets * self.ways, 'bytes': len(self._mm),
+                       'hit_rate': self.stats['hits'] / lookups if lookups else 0})
+        return report
+
+    def close(self):
+        """
+        Unmap the cache, the file is left for other processes
+        """
+        self._mm.close()
+        self._file.close()
+
+class _Connection:
+    """
+    State of a client connection, tracked for graceful shutdown
+    """
+    def __init__(self, writer, reader=None):
+        self.writer = writer
+        self.reader = reader
+        self.task = _current_task()
+        self.handler_task = None # Task running the handler, when not run in task
+        self.busy = False # True while a request is being handled
+        self.request = None # Request being handled
+
+    def close(self):
+        """
+        Close the connection and stop its handler
+        """
+        self.writer.close()
+        if self.task is not None and self.task is not _current_task():
+            self.task.cancel()
+
+    def buffered(self):
+        """
+        Return (bytes received but not yet read, bytes written but not yet sent)
+        """
+        transport = getattr(self.writer, 'transport', None)
+        return (len(getattr(self.reader, '_buffer', b'')),
+                transport.get_write_buffer_size() if transport is not None else 0)
+
+class _Route:
+    """
+    A registered handler and its options
+    """
+    def __init__(self, path_regex, func, buffer=True, rate_limit=None, validate=None,
+                 constant=False, cache=None):
+        self.regex = re.compile(path_regex)
+        self.func = func
+        import inspect
+        self.is_async = inspect.iscoroutinefunction(func)
+        self.buffer = buffer
+        self.rate_limit = rate_limit
+        self.validate = validate
+        self.constant = constant
+        self.prebuilt = None # _Prebuilt response of a constant route
+        self.cache = cache
+
+class _NullWriter:
+    """
+    Writer discarding all data, used for warmup
+    """
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def get_extra_info(self, name):
+        return None
+
+    def close(self):
+        pass
+
+class _BytesReader:
+    """
+    Reader returning lines from a byte string, used for warmup
+    """
+    def __init__(self, data):
+        self._io = io.BytesIO(data)
+
+    async def readline(self):
+        return self._io.readline()
+
+    async def readexactly(self, n):
+        return self._io.read(n)
+
+    def at_eof(self):
+        return self._io.tell() == len(self._io.getbuffer())
+
+class TLSContext:
+    """
+    A server SSL context tuned for HTTP/1.1 with certificate reloading and
+    handshake metrics
+
+    Pass it as the ssl_context of a Listener (or Grole.run). The context
+    allows TLS 1.2 and later with forward secret AEAD ciphers, keeps
+    session tickets and the session cache enabled so returning clients can
+    resume, and advertises http/1.1 with ALPN.
+
+    The certificate files are checked for changes at most every
+    reload_interval seconds when a client connects. Changed files are
+    loaded into a new context on the file thread pool, which replaces
+    context on the event loop only if loading succeeded, so a certificate
+    and key that don't match (e.g. half way through a renewal) leave the
+    old certificate in use. New handshakes switch to the current context,
+    so they get the new certificate without a restart. Sessions from
+    before a reload can't be resumed, those clients make a full handshake
+    once. Call reload() to force it.
+
+    stats() reports the handshakes completed, how many resumed a session,
+    failures and handshake durations. Use one TLSContext per listener to
+    get per listener figures.
+    """
+    CIPHERS = 'ECDHE+AESGCM:ECDHE+CHACHA20:DHE+AESGCM:DHE+CHACHA20:!aNULL:!MD5:!DSS'
+
+    def __init__(self, certfile, keyfile=None, password=None, alpn=('http/1.1',),
+                 ciphers=CIPHERS, tickets=2, reload_interval=1.0):
+        """
+        Create the context and load the certificate
+
+        Parameters:
+
+            * certfile: Certificate chain file (PEM)
+            * keyfile: Private key file, default is to look in certfile
+            * password: Password for the private key
+            * alpn: Protocols to advertise with ALPN, add h2 (first) for a Grole with http2 set
+            * ciphers: OpenSSL cipher string for TLS 1.2
+            * tickets: Session tickets sent to TLS 1.3 clients after a handshake
+            * reload_interval: Seconds between checks for changed certificate files, None disables them
+        """
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.password = password
+        self.alpn = alpn
+        self.ciphers = ciphers
+        self.tickets = tickets
+        self.reload_interval = reload_interval
+        self.reloads = 0
+        self.metrics = Counter() # handshakes, resumed, handshake_time (seconds)
+        self.max_handshake = 0
+
+        self.context = None
+        self._loaded = None
+        self._checked = time.monotonic()
+        self._checking = None # Future of the running check for changed files
+        self.reload()
+        self._session_context = self.context # Where handshakes start, counting them
+
+    def _mtimes(self):
+        return tuple(os.stat(f).st_mtime_ns for f in (self.certfile, self.keyfile) if f)
+
+    def _create(self):
+        """
+        Return a new context holding the certificate, raising if it can't be loaded
+        """
+        import ssl
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        if hasattr(ctx, 'minimum_version'):
+            ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+        else:
+            ctx.options |= ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
+        ctx.options |= ssl.OP_NO_COMPRESSION | ssl.OP_CIPHER_SERVER_PREFERENCE
+        ctx.options &= ~ssl.OP_NO_TICKET
+        ctx.set_ciphers(self.ciphers)
+        if hasattr(ctx, 'num_tickets'):
+            ctx.num_tickets = self.tickets
+        if self.alpn:
+            ctx.set_alpn_protocols(list(self.alpn))
+        if hasattr(ctx, 'sni_callback'):
+            ctx.sni_callback = self._client_hello
+        else:
+            ctx.set_servername_callback(self._client_hello)
+        ctx.load_cert_chain(self.certfile, self.keyfile, self.password)
+        return ctx
+
+    def reload(self):
+        """
+        Load the certificate and key files into a new context for new connections
+
+        The current context is kept if they can't be loaded.
+        """
+        mtimes = self._mtimes()
+        self._use(self._create(), mtimes)
+
+    def _use(self, ctx, mtimes):
+        """
+        Make ctx, loaded from files with mtimes, the context for new handshakes
+        """
+        if self.context is not None:
+            self.reloads += 1
+        self.context = ctx
+        self._loaded = mtimes
+
+    def _client_hello(self, ssl_object, server_name, context):
+        """
+        Called by ssl as the handshake starts, before the certificate is chosen
+        """
+        ssl_object._grole_hello = time.perf_counter()
+        self._session_context = context
+        if context is not self.context:
+            ssl_object.context = self.context # Reloaded since the listener started
+        now = time.monotonic()
+        if (self.reload_interval is not None and now - self._checked >= self.reload_interval and
+                (self._checking is None or self._checking.done())):
+            self._checked = now
+            self._checking = _file_executor().submit(self._reload_changed,
+                                                     asyncio.get_event_loop())
+
+    def _reload_changed(self, loop):
+        """
+        Reload the certificate if its files have changed, run on the file thread pool
+
+        The new context is handed to loop, the context in use is only changed there.
+        """
+        try:
+            mtimes = self._mtimes()
+            if mtimes != self._loaded:
+                loop.call_soon_threadsafe(self._use, self._create(), mtimes)
+        except Exception:
+            # Keep serving the old certificate, e.g. files half written
+            logging.getLogger('grole').exception('Failed to reload certificate')
+
+    def _connected(self, writer):
+        """
+        Record a completed handshake for the connection writer belongs to
+        """
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is None:
+            return
+        self.metrics['handshakes'] += 1
+        if ssl_object.session_reused:
+            self.metrics['resumed'] += 1
+        start = getattr(ssl_object, '_grole_hello', None)
+        if start is not None:
+            elapsed = time.perf_counter() - start
+            self.metrics['handshake_time'] += elapsed
+            self.max_handshake = max(self.max_handshake, elapsed)
+
+    def stats(self):
+        """
+        Return a dictionary of handshake metrics
+
+        failed counts handshakes OpenSSL started but didn't complete, so
+        includes any in progress.
+        """
+        session = self._session_context.session_stats()
+        handshakes = self.metrics['handshakes']
+        return {'handshakes': handshakes,
+                'resumed': self.metrics['resumed'],
+                'resumption_rate': self.metrics['resumed'] / handshakes if handshakes else 0,
+                'failed': session['accept'] - session['accept_good'],
+                'mean_handshake': self.metrics['handshake_time'] / handshakes if handshakes else 0,
+                'max_handshake': self.max_handshake,
+                'reloads': self.reloads}
+
+class Listener:
+    """
+    An address for Grole.run to accept connections on
+
+    One of a TCP host and port, a Unix domain socket path, or an already
+    open listening socket file descriptor (e.g. from socket activation).
+    """
+    def __init__(self, host='localhost', port=1234, path=None, fd=None,
+                 ssl_context=None, mode=None, backlog=100, nodelay=None,
+                 fastopen=None, reuse_port=False):
+        """
+        Describe the listener
+
+        Parameters:
+
+            * host: The host to listen on (TCP)
+            * port: The port to listen on (TCP)
+            * path: Unix domain socket path to listen on instead of TCP
+            * fd: Listening socket file descriptor to use instead of binding, or a list of them
+            * ssl_context: The SSL context passed to asyncio, or a TLSContext
+            * mode: Permissions to set on the Unix domain socket, e.g. 0o660
+            * backlog: Maximum number of queued connections
+            * nodelay: Set TCP_NODELAY on connections, default is the asyncio default
+            * fastopen: TCP_FASTOPEN queue length, default off
+            * reuse_port: Set SO_REUSEPORT so several processes can bind the same port
+        """
+        self.host = host
+        self.port = port
+        self.path = path
+        self.fd = fd
+        self.ssl_context = ssl_context
+        self.mode = mode
+        self.backlog = backlog
+        self.nodelay = nodelay
+        self.fastopen = fastopen
+        self.reuse_port = reuse_port
+        self.server = None
+        self._servers = [] # All servers, one per fd if there are several
+
+    def __str__(self):
+        if self.fd is not None:
+            return 'fd {}'.format(self.fd)
+        if self.path is not None:
+            return 'unix:{}'.format(self.path)
+        return '{}:{}'.format(self.host, self.port)
+
+    async def _start(self, handler, limit=None):
+        """
+        Start an asyncio server for handler on this listener
+
+        limit is the StreamReader buffer limit, default the asyncio default
+        """
+        import socket
+        ssl_context = self.ssl_context
+        if self.nodelay is not None or isinstance(ssl_context, TLSContext):
+            handler = self._wrap(handler)
+        if isinstance(ssl_context, TLSContext):
+            ssl_context = ssl_context.context
+        kwargs = {'ssl': ssl_context, 'backlog': self.backlog}
+        if limit is not None:
+            kwargs['limit'] = limit
+        if self.fd is not None:
+            for fd in self.fd if isinstance(self.fd, (list, tuple)) else [self.fd]:
+                sock = socket.socket(fileno=fd)
+                if sock.family == getattr(socket, 'AF_UNIX', None):
+                    self._servers.append(await asyncio.start_unix_server(handler, sock=sock, **kwargs))
+                else:
+                    self._servers.append(await asyncio.start_server(handler, sock=sock, **kwargs))
+            self.server = self._servers[0]
+        elif self.path is not None:
+            try:
+                if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                    os.unlink(self.path) # Stale socket from a previous run
+            except FileNotFoundError:
+                pass
+            self.server = await asyncio.start_unix_server(handler, self.path, **kwargs)
+            self._servers = [self.server]
+            if self.mode is not None:
+                os.chmod(self.path, self.mode)
+        else:
+            if self.reuse_port:
+                kwargs['reuse_port'] = True
+            self.server = await asyncio.start_server(handler, self.host, self.port, **kwargs)
+            self._servers = [self.server]
+        if self.fastopen and hasattr(socket, 'TCP_FASTOPEN'):
+            for sock in self.sockets():
+                if sock.family != getattr(socket, 'AF_UNIX', None):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN, self.fastopen)
+        return self.server
+
+    def sockets(self):
+        """
+        Return the listening sockets, there may be several e.g. for IPv4 and IPv6
+        """
+        return [sock for server in self._servers for sock in server.sockets]
+
+    def _stop(self):
+        """
+        Stop accepting connections
+        """
+        for server in self._servers:
+            server.close()
+
+    def _wrap(self, handler):
+        """
+        Wrap handler to apply per connection socket options and record TLS handshakes
+        """
+        import socket
+        nodelay = self.nodelay
+        tls = self.ssl_context if isinstance(self.ssl_context, TLSContext) else None
+        def configure(reader, writer):
+            if tls is not None:
+                tls._connected(writer)
+            sock = writer.get_extra_info('socket')
+            if nodelay is not None and sock is not None and sock.family != getattr(socket, 'AF_UNIX', None):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+            return handler(reader, writer)
+        return configure
+
+    async def _close(self, unlink=True):
+        """
+        Stop accepting connections, removing any Unix domain socket file
+        """
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        if unlink and self.path is not None and self.fd is None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+class _ASGIReader:
+    """
+    Reader of an ASGI request body, from the app's receive callable
+    """
+    def __init__(self, receive):
+        self._receive = receive
+        self._buffer = bytearray() # Deleting from the front is cheap
+        self._more = True
+
+    async def _fill(self):
+        message = await self._receive()
+        if message['type'] == 'http.disconnect':
+            self._more = False
+            return
+        self._buffer += message.get('body', b'')
+        self._more = message.get('more_body', False)
+
+    async def read(self, n=-1):
+        while self._more and (n < 0 or not self._buffer):
+            await self._fill()
+        if n < 0:
+            n = len(self._buffer)
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    async def readexactly(self, n):
+        while self._more and len(self._buffer) < n:
+            await self._fill()
+        if len(self._buffer) < n:
+            raise asyncio.IncompleteReadError(bytes(self._buffer), n)
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    async def _buffer_all(self, limit=None):
+        """
+        Receive the whole body, or stop once more than limit bytes are buffered
+
+        Returns the number of bytes buffered.
+        """
+        while self._more and (limit is None or len(self._buffer) <= limit):
+            await self._fill()
+        return len(self._buffer)
+
+    def at_eof(self):
+        return not self._more and not self._buffer
+
+class _ASGIWriter:
+    """
+    Writer sending a response body as ASGI http.response.body messages
+
+    Data is sent on each drain, the ASGI server does any chunked framing.
+    """
+    def __init__(self, send):
+        self._send = send
+        self._buffer = []
+
+    def write(self, data):
+        if data:
+            self._buffer.append(bytes(data))
+
+    def write_chunk(self, data):
+        self.write(data)
+
+    async def drain(self):
+        if self._buffer:
+            body = b''.join(self._buffer)
+            self._buffer = []
+            await self._send({'type': 'http.response.body', 'body': body, 'more_body': True})
+
+    async def finish(self):
+        body = b''.join(self._buffer)
+        self._buffer = []
+        await self._send({'type': 'http.response.body', 'body': body, 'more_body': False})
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def close(self):
+        pass
+
+_HPACK_STATIC = [(name.encode(), value.encode()) for name, value in [
+    (':authority', ''), (':method', 'GET'), (':method', 'POST'), (':path', '/'),
+    (':path', '/index.html'), (':scheme', 'http'), (':scheme', 'https'), (':status', '200'),
+    (':status', '204'), (':status', '206'), (':status', '304'), (':status', '400'),
+    (':status', '404'), (':status', '500'), ('accept-charset', ''),
+    ('accept-encoding', 'gzip, deflate'), ('accept-language', ''), ('accept-ranges', ''),
+    ('accept', ''), ('access-control-allow-origin', ''), ('age', ''), ('allow', ''),
+    ('authorization', ''), ('cache-control', ''), ('content-disposition', ''),
+    ('content-encoding', ''), ('content-language', ''), ('content-length', ''),
+    ('content-location', ''), ('content-range', ''), ('content-type', ''), ('cookie', ''),
+    ('date', ''), ('etag', ''), ('expect', ''), ('expires', ''), ('from', ''), ('host', ''),
+    ('if-match', ''), ('if-modified-since', ''), ('if-none-match', ''), ('if-range', ''),
+    ('if-unmodified-since', ''), ('last-modified', ''), ('link', ''), ('location', ''),
+    ('max-forwards', ''), ('proxy-authenticate', ''), ('proxy-authorization', ''),
+    ('range', ''), ('referer', ''), ('refresh', ''), ('retry-after', ''), ('server', ''),
+    ('set-cookie', ''), ('strict-transport-security', ''), ('transfer-encoding', ''),
+    ('user-agent', ''), ('vary', ''), ('via', ''), ('www-authenticate', '')]]
+_HPACK_STATIC_INDEX = {}
+for _index, _entry in reversed(list(enumerate(_HPACK_STATIC, 1))):
+    _HPACK_STATIC_INDEX[_entry] = _index # Header -> index
+    _HPACK_STATIC_INDEX[_entry[0]] = _index # Name -> first index
+
+# HPACK Huffman code lengths of bytes 0 to 255 and EOS, the code is canonical
+_HUFFMAN_LENGTHS = [
+    13, 23, 28, 28, 28, 28, 28, 28, 28, 24, 30, 28, 28, 30, 28, 28,
+    28, 28, 28, 28, 28, 28, 30, 28, 28, 28, 28, 28, 28, 28, 28, 28,
+    6, 10, 10, 12, 13, 6, 8, 11, 10, 10, 8, 11, 8, 6, 6, 6,
+    5, 5, 5, 6, 6, 6, 6, 6, 6, 6, 7, 8, 15, 6, 12, 10,
+    13, 6, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7,
+    7, 7, 7, 7, 7, 7, 7, 7, 8, 7, 8, 13, 19, 13, 14, 6,
+    15, 5, 6, 5, 6, 5, 6, 6, 6, 5, 7, 7, 6, 6, 6, 5,
+    6, 7, 6, 5, 5, 6, 7, 7, 7, 7, 7, 15, 11, 14, 13, 28,
+    20, 22, 20, 20, 22, 22, 22, 23, 22, 23, 23, 23, 23, 23, 24, 23,
+    24, 24, 22, 23, 24, 23, 23, 23, 23, 21, 22, 23, 22, 23, 23, 24,
+    22, 21, 20, 22, 22, 23, 23, 21, 23, 22, 22, 24, 21, 22, 23, 23,
+    21, 21, 22, 21, 23, 22, 23, 23, 20, 22, 22, 22, 23, 22, 22, 23,
+    26, 26, 20, 19, 22, 23, 22, 25, 26, 26, 26, 27, 27, 26, 24, 25,
+    19, 21, 26, 27, 27, 26, 27, 24, 21, 21, 26, 26, 28, 27, 27, 27,
+    20, 24, 20, 21, 22, 21, 21, 23, 22, 22, 25, 25, 24, 24, 26, 23,
+    26, 27, 26, 26, 27, 27, 27, 27, 27, 28, 27, 27, 27, 27, 27, 26,
+    30]
+_huffman_codes = None # (1 << length | code) -> symbol, built on first use
+
+class _HTTP2Error(Exception):
+    """
+    HTTP/2 connection error, code is the error code sent with GOAWAY
+    """
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+def _huffman_decode(data):
+    """
+    Decode a Huffman coded HPACK string
+    """
+    global _huffman_codes
+    if _huffman_codes is None:
+        codes = {}
+        code = length = 0
+        for bits, symbol in sorted((bits, symbol) for symbol, bits in enumerate(_HUFFMAN_LENGTHS)):
+            code <<= bits - length
+            length = bits
+            codes[1 << length | code] = symbol
+            code += 1
+        _huffman_codes = codes
+    codes = _huffman_codes
+    out = bytearray()
+    key = 1 # Bits read so far, after a leading 1
+    for byte in data:
+        for shift in range(7, -1, -1):
+            key = key << 1 | byte >> shift & 1
+            symbol = codes.get(key)
+            if symbol is not None:
+                if symbol == 256:
+                    raise _HTTP2Error(_HTTP2Connection.COMPRESSION_ERROR, 'EOS in Huffman string')
+                out.append(symbol)
+                key = 1
+    # Padding is up to 7 bits of the EOS code, which is all ones
+    if key.bit_length() > 8 or key != (1 << key.bit_length()) - 1:
+        raise _HTTP2Error(_HTTP2Connection.COMPRESSION_ERROR, 'Bad Huffman padding')
+    return bytes(out)
+
+def _hpack_int(value, prefix, flags=0):
+    """
+    Encode an HPACK integer with a prefix bit prefix, the other bits of the first byte are flags
+    """
+    limit = (1 << prefix) - 1
+    if value < limit:
+        return bytes([flags | value])
+    out = bytearray([flags | limit])
+    value -= limit
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def _hpack_encode(headers):
+    """
+    Encode a header list of (name, value) bytes as an HPACK header block
+
+    Headers in the static table are indexed, others are sent as literals
+    without indexing, so no dynamic table state is kept.
+    """
+    out = bytearray()
+    for name, value in headers:
+        index = _HPACK_STATIC_INDEX.get((name, value))
+        if index is not None:
+            out += _hpack_int(index, 7, 0x80)
+            continue
+        index = _HPACK_STATIC_INDEX.get(name)
+        if index is None:
+            out += b'\x00' + _hpack_int(len(name), 7) + name
+        else:
+            out += _hpack_int(index, 4)
+        out += _hpack_int(len(value), 7) + value
+    return bytes(out)
+
+class _HPACKDecoder:
+    """
+    Decoder of the HPACK header blocks of one connection, see RFC 7541
+    """
+    def __init__(self, max_size=4096):
+        self.max_size = max_size # Limit we advertised
+        self.size_limit = max_size # Limit set by the encoder
+        self.size = 0
+        self._table = deque() # Dynamic table, newest first
+
+    def _int(self, data, pos, prefix):
+        limit = (1 << prefix) - 1
+        value = data[pos] & limit
+        pos += 1
+        if value == limit:
+            shift = 0
+            while True:
+                byte = data[pos]
+                pos += 1
+                value += (byte & 0x7f) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+                if shift > 28:
+                    raise _HTTP2Error(_HTTP2Connection.COMPRESSION_ERROR, 'HPACK integer too large')
+        return value, pos
+
+    def _string(self, data, pos):
+        huffman = data[pos] & 0x80
+        length, pos = self._int(data, pos, 7)
+        if pos + length > len(data):
+            raise IndexError()
+        value = bytes(data[pos:pos + length])
+        return _huffman_decode(value) if huffman else value, pos + length
+
+    def _entry(self, index):
+        if 0 < index <= len(_HPACK_STATIC):
+            return _HPACK_STATIC[index - 1]
+        if len(_HPACK_STATIC) < index <= len(_HPACK_STATIC) + len(self._table):
+            return self._table[index - len(_HPACK_STATIC) - 1]
+        raise _HTTP2Error(_HTTP2Connection.COMPRESSION_ERROR, 'Bad HPACK index {}'.format(index))
+
+    def _evict(self):
+        while self.size > self.size_limit:
+            name, value = self._table.pop()
+            self.size -= len(name) + len(value) + 32
+
+    def decode(self, data, max_size=None, max_count=None):
+        """
+        Return the list of (name, value) bytes in a header block
+
+        Returns None if the list is larger than max_size bytes (counted as
+        for SETTINGS_MAX_HEADER_LIST_SIZE, 32 bytes more than the name and
+        value of each header) or has more than max_count headers. The whole
+        block is still decoded, to keep the dynamic table in step.
+        """
+        headers = []
+        list_size = 0
+        too_large = False
+        pos = 0
+        try:
+            while pos < len(data):
+                byte = data[pos]
+                if byte & 0x80: # Indexed
+                    index, pos = self._int(data, pos, 7)
+                    header = self._entry(index)
+                    if not too_large:
+                        list_size += len(header[0]) + len(header[1]) + 32
+                        headers.append(header)
+                        too_large = ((max_size is not None and list_size > max_size) or
+                                     (max_count is not None and len(headers) > max_count))
+                    continue
+                if byte & 0xe0 == 0x20: # Dynamic table size update
+                    size, pos = self._int(data, pos, 5)
+                    if size > self.max_size:
+                        raise _HTTP2Error(_HTTP2Connection.COMPRESSION_ERROR, 'HPACK table too large')
+                    self.size_limit = size
+                    self._evict()
+                    continue
+                index, pos = self._int(data, pos, 6 if byte & 0x40 else 4)
+                if index:
+                    name = self._entry(index)[0]
+                else:
+                    name, pos = self._string(data, pos)
+                value, pos = self._string(data, pos)
+                if not too_large:
+                    list_size += len(name) + len(value) + 32
+                    headers.append((name, value))
+                    too_large = ((max_size is not None and list_size > max_size) or
+                                 (max_count is not None and len(headers) > max_count))
+                if byte & 0x40: # With incremental indexing
+                    self._table.appendleft((name, value))
+                    self.size += len(name) + len(value) + 32
+                    self._evict()
+        except IndexError:
+            raise _HTTP2Error(_HTTP2Connection.COMPRESSION_ERROR, 'Truncated HPACK block')
+        return None if too_large else headers
+
+class _HTTP2Stream:
+    """
+    A stream of an HTTP/2 connection, run as an ASGI request
+
+    receive and send are the ASGI callables of the request.
+    """
+    def __init__(self, conn, stream_id):
+        self.conn = conn
+        self.id = stream_id
+        self.window = conn.initial_window # Send window
+        self.recv_window = conn.RECV_WINDOW
+        self.remote_closed = False # Whole request received
+        self.reset = False
+        self.task = None
+        self._incoming = deque() # ASGI receive messages
+        self._waiter = None
+
+    def _feed(self, message):
+        self._incoming.append(message)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def receive(self):
+        while not self._incoming:
+            self._waiter = asyncio.get_event_loop().create_future()
+            await self._waiter
+        message = self._incoming.popleft()
+        flow = message.pop('flow', 0)
+        if flow:
+            # Only let the client send more once the handler has read it
+            self.conn._consumed(self, flow)
+        return message
+
+    async def send(self, message):
+        await self.conn._send(self, message)
+
+class _HTTP2Connection:
+    """
+    A server side HTTP/2 connection, see Grole and HTTP2Settings
+
+    Streams are multiplexed on the connection, each is run as an ASGI
+    request through Grole.__call__, so handlers get the same Request and
+    Response objects as over HTTP/1.1. A request body is only acknowledged
+    to the client (with WINDOW_UPDATE) as the handler reads it, and
+    response bodies are sent as the client's flow control windows allow.
+    Header blocks are decoded with a dynamic table, responses are encoded
+    without one. Server push and priorities are not implemented.
+    """
+    PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+    DATA, HEADERS, PRIORITY, RST_STREAM, SETTINGS, PUSH_PROMISE, PING, GOAWAY, WINDOW_UPDATE, \
+        CONTINUATION = range(10)
+    END_STREAM = ACK = 0x1
+    END_HEADERS = 0x4
+    PADDED = 0x8
+    PRIORITY_FLAG = 0x20
+    NO_ERROR, PROTOCOL_ERROR, INTERNAL_ERROR, FLOW_CONTROL_ERROR, SETTINGS_TIMEOUT, \
+        STREAM_CLOSED, FRAME_SIZE_ERROR, REFUSED_STREAM, CANCEL, COMPRESSION_ERROR = range(10)
+    MAX_FRAME = 16384 # Largest frame accepted
+    RECV_WINDOW = 65535
+    MAX_WINDOW = 2 ** 31 - 1
+    # Connection specific headers, not sent over HTTP/2
+    HOP_HEADERS = {b'connection', b'keep-alive', b'proxy-connection', b'transfer-encoding',
+                   b'upgrade', b'http2-settings'}
+
+    def __init__(self, app, reader, writer, conn=None):
+        """
+        Parameters:
+
+            * app: The Grole app handling requests
+            * reader, writer: The connection's asyncio streams
+            * conn: The app's _Connection record, marked busy while streams are open
+        """
+        self.app = app
+        self.reader = reader
+        self.writer = writer
+        self.conn = conn
+        self.decoder = _HPACKDecoder()
+        self.streams = {} # id -> _HTTP2Stream
+        self.last_stream = 0
+        self.window = 65535 # Connection send window
+        self.recv_window = self.RECV_WINDOW
+        self.initial_window = 65535 # Stream send window from the client's SETTINGS
+        self.max_frame = 16384 # From the client's SETTINGS
+        self.going_away = False
+        self._window_changed = None
+        peer = writer.get_extra_info('peername')
+        self.peer = tuple(peer) if isinstance(peer, (tuple, list)) else None
+        sock = writer.get_extra_info('sockname')
+        self.sockname = tuple(sock) if isinstance(sock, (tuple, list)) else None
+
+    def _frame(self, kind, flags, stream_id, payload=b''):
+        self.writer.write(struct.pack('>IBI', len(payload) << 8 | kind, flags, stream_id) + payload)
+
+    async def _read_frame(self, timeout=None):
+        """
+        Read a frame, returns (type, flags, stream id, payload)
+        """
+        head = await _wait_for(self.reader.readexactly(9), timeout)
+        length_kind, flags, stream_id = struct.unpack('>IBI', head)
+        length = length_kind >> 8
+        if length > self.MAX_FRAME:
+            raise _HTTP2Error(self.FRAME_SIZE_ERROR, 'Frame too large')
+        payload = await self.reader.readexactly(length) if length else b''
+        return length_kind & 0xff, flags, stream_id & 0x7fffffff, payload
+
+    def _goaway(self, code):
+        if not self.going_away or code:
+            self._frame(self.GOAWAY, 0, 0, struct.pack('>II', self.last_stream, code))
+        self.going_away = True
+
+    async def run(self, upgrade=None, preface=True):
+        """
+        Serve the connection until it closes
+
+        Parameters:
+
+            * upgrade: Request upgraded from HTTP/1.1 with Upgrade: h2c, answered on stream 1
+            * preface: Read the client connection preface first, false if it already has been
+        """
+        self._window_changed = asyncio.Event()
+        settings = struct.pack('>HI', 3, self.app.http2.max_streams)
+        if self.app.limits.max_header_size is not None:
+            settings += struct.pack('>HI', 6, self.app.limits.max_header_size) # MAX_HEADER_LIST_SIZE
+        self._frame(self.SETTINGS, 0, 0, settings)
+        try:
+            if upgrade is not None:
+                import base64
+                settings = upgrade.headers.get('HTTP2-Settings', '')
+                try:
+                    settings = base64.urlsafe_b64decode(settings + '=' * (-len(settings) % 4))
+                except ValueError:
+                    raise _HTTP2Error(self.PROTOCOL_ERROR, 'Bad HTTP2-Settings')
+                self._settings(settings)
+                headers = [(b':method', upgrade.method.encode()), (b':path', upgrade.location.encode()),
+                           (b':scheme', b'http')]
+                headers += [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                            for k, v in upgrade.headers.items()]
+                self.last_stream = 1
+                self._open(1, headers, True)
+            if preface and await self.reader.readexactly(len(self.PREFACE)) != self.PREFACE:
+                raise _HTTP2Error(self.PROTOCOL_ERROR, 'Bad connection preface')
+            while not (self.going_away and not self.streams):
+                timeout = None if self.streams else self.app.timeouts.header
+                frame = await self._read_frame(timeout)
+                if frame[0] == self.HEADERS:
+                    frame = await self._continuations(frame)
+                self._handle_frame(*frame)
+                await self.writer.drain()
+        except _HTTP2Error as e:
+            self.app._logger.debug('HTTP/2 error from {}: {}'.format(self.peer, e))
+            self._goaway(e.code)
+        except asyncio.TimeoutError:
+            self._goaway(self.NO_ERROR)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for stream in list(self.streams.values()):
+                stream.task.cancel()
+            self.writer.close()
+
+    async def _continuations(self, frame):
+        """
+        Read the CONTINUATION frames following HEADERS, returns the combined frame
+        """
+        kind, flags, stream_id, payload = frame
+        while not flags & self.END_HEADERS:
+            more, more_flags, more_id, more_payload = await self._read_frame()
+            if more != self.CONTINUATION or more_id != stream_id:
+                raise _HTTP2Error(self.PROTOCOL_ERROR, 'Expected CONTINUATION')
+            if len(payload) + len(more_payload) > self.app.http2.max_header_block:
+                raise _HTTP2Error(self.PROTOCOL_ERROR, 'Header block too large')
+            payload += more_payload
+            flags |= more_flags & self.END_HEADERS
+        return kind, flags, stream_id, payload
+
+    def _unpad(self, flags, payload):
+        if flags & self.PADDED:
+            if not payload or payload[0] >= len(payload):
+                raise _HTTP2Error(self.PROTOCOL_ERROR, 'Bad padding')
+            payload = payload[1:len(payload) - payload[0]]
+        return payload
+
+    def _handle_frame(self, kind, flags, stream_id, payload):
+        if kind == self.DATA:
+            self._data(flags, stream_id, payload)
+        elif kind == self.HEADERS:
+            if stream_id == 0:
+                raise _HTTP2Error(self.PROTOCOL_ERROR, 'HEADERS on stream 0')
+            block = self._unpad(flags, payload)
+            if flags & self.PRIORITY_FLAG:
+                block = block[5:]
+            # Always decoded, to keep the table in step
+            headers = self.decoder.decode(block, self.app.limits.max_header_size, self.app.limits.max_headers)
+            stream = self.streams.get(stream_id)
+            if stream is not None:
+                # Trailers, ignored apart from ending the request
+                if not flags & self.END_STREAM:
+                    raise _HTTP2Error(self.PROTOCOL_ERROR, 'HEADERS without END_STREAM')
+                stream.remote_closed = True
+                stream._feed({'type': 'http.request', 'body': b'', 'more_body': False})
+            elif stream_id % 2 == 0 or stream_id <= self.last_stream:
+                raise _HTTP2Error(self.PROTOCOL_ERROR, 'Bad stream id {}'.format(stream_id))
+            else:
+                self.last_stream = stream_id
+                if self.going_away or self.app._closing or len(self.streams) >= self.app.http2.max_streams:
+                    self._frame(self.RST_STREAM, 0, stream_id, struct.pack('>I', self.REFUSED_STREAM))
+                elif headers is None:
+                    self.app.metrics['headers_too_large'] += 1
+                    self._frame(self.HEADERS, self.END_STREAM | self.END_HEADERS, stream_id,
+                                _hpack_encode([(b':status', b'431')]))
+                else:
+                    self._open(stream_id, headers, flags & self.END_STREAM)
+        elif kind == self.RST_STREAM:
+            stream = self.streams.pop(stream_id, None)
+            if stream is not None:
+                stream.reset = True
+                stream.task.cancel()
+        elif kind == self.SETTINGS:
+            if stream_id != 0:
+                raise _HTTP2Error(self.PROTOCOL_ERROR, 'SETTINGS on a stream')
+            if not flags & self.ACK:
+                self._settings(payload)
+                self._frame(self.SETTINGS, self.ACK, 0)
+        elif kind == self.PING:
+            if len(payload) != 8:
+                raise _HTTP2Error(self.FRAME_SIZE_ERROR, 'Bad PING')
+            if not flags & self.ACK:
+                self._frame(self.PING, self.ACK, 0, payload)
+        elif kind == self.GOAWAY:
+            self.going_away = True # Finish the open streams then close
+        elif kind == self.WINDOW_UPDATE:
+            if len(payload) != 4:
+                raise _HTTP2Error(self.FRAME_SIZE_ERROR, 'Bad WINDOW_UPDATE')
+            increment = struct.unpack('>I', payload)[0] & 0x7fffffff
+            if stream_id == 0:
+                if increment == 0:
+                    raise _HTTP2Error(self.PROTOCOL_ERROR, 'Zero WINDOW_UPDATE')
+                self.window += increment
+                if self.window > self.MAX_WINDOW:
+                    raise _HTTP2Error(self.FLOW_CONTROL_ERROR, 'Window too large')
+            elif stream_id in self.streams:
+                self.streams[stream_id].window += increment
+            self._window_changed.set()
+        elif kind in (self.CONTINUATION, self.PUSH_PROMISE):
+            raise _HTTP2Error(self.PROTOCOL_ERROR, 'Unexpected frame {}'.format(kind))
+        # PRIORITY and unknown frames are ignored
+
+    def _data(self, flags, stream_id, payload):
+        if stream_id == 0:
+            raise _HTTP2Error(self.PROTOCOL_ERROR, 'DATA on stream 0')
+        self.recv_window -= len(payload)
+        if self.recv_window < 0:
+            raise _HTTP2Error(self.FLOW_CONTROL_ERROR, 'Connection window exceeded')
+        stream = self.streams.get(stream_id)
+        if stream is None or stream.remote_closed:
+            if stream_id > self.last_stream:
+                raise _HTTP2Error(self.PROTOCOL_ERROR, 'DATA on idle stream')
+            # Stream already finished, drop the data and give the window back
+            if payload:
+                self._frame(self.WINDOW_UPDATE, 0, 0, struct.pack('>I', len(payload)))
+                self.recv_window += len(payload)
+            return
+        stream.recv_window -= len(payload)
+        if stream.recv_window < 0:
+            raise _HTTP2Error(self.FLOW_CONTROL_ERROR, 'Stream window exceeded')
+        end = bool(flags & self.END_STREAM)
+        stream.remote_closed = end
+        stream._feed({'type': 'http.request', 'body': self._unpad(flags, payload),
+                      'more_body': not end, 'flow': len(payload)})
+
+    def _settings(self, payload):
+        if len(payload) % 6:
+            raise _HTTP2Error(self.FRAME_SIZE_ERROR, 'Bad SETTINGS')
+        for pos in range(0, len(payload), 6):
+            setting, value = struct.unpack_from('>HI', payload, pos)
+            if setting == 4: # INITIAL_WINDOW_SIZE
+                if value > self.MAX_WINDOW:
+                    raise _HTTP2Error(self.FLOW_CONTROL_ERROR, 'Window too large')
+                for stream in self.streams.values():
+                    stream.window += value - self.initial_window
+                self.initial_window = value
+                if self._window_changed is not None:
+                    self._window_changed.set()
+            elif setting == 5: # MAX_FRAME_SIZE
+                if not 16384 <= value <= 16777215:
+                    raise _HTTP2Error(self.PROTOCOL_ERROR, 'Bad MAX_FRAME_SIZE')
+                self.max_frame = value
+            # Others don't affect a server which doesn't push or index headers it sends
+
+    def _open(self, stream_id, headers, end):
+        """
+        Start handling a new stream with request headers
+        """
+        pseudo = {}
+        regular = []
+        cookies = []
+        for name, value in headers:
+            if name.startswith(b':'):
+                pseudo[name] = value
+            elif name == b'cookie':
+                cookies.append(value)
+            elif name not in self.HOP_HEADERS:
+                regular.append((name, value))
+        if cookies:
+            regular.append((b'cookie', b'; '.join(cookies)))
+        method, path = pseudo.get(b':method'), pseudo.get(b':path')
+        if not method or not path:
+            self._frame(self.RST_STREAM, 0, stream_id, struct.pack('>I', self.PROTOCOL_ERROR))
+            return
+        if b':authority' in pseudo and not any(name == b'host' for name, _ in regular):
+            regular.append((b'host', pseudo[b':authority']))
+        raw_path, _, query = path.partition(b'?')
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '2',
+                 'method': method.decode('latin-1'),
+                 'scheme': pseudo.get(b':scheme', b'http').decode('latin-1'),
+                 'path': urllib.parse.unquote(raw_path.decode('latin-1')), 'raw_path': raw_path,
+                 'query_string': query, 'root_path': '', 'headers': regular,
+                 'client': self.peer, 'server': self.sockname}
+        stream = self.streams[stream_id] = _HTTP2Stream(self, stream_id)
+        if end:
+            stream.remote_closed = True
+            stream._feed({'type': 'http.request', 'body': b'', 'more_body': False})
+        if self.conn is not None:
+            self.conn.busy = True
+        stream.task = asyncio.ensure_future(self._run_stream(stream, scope))
+
+    async def _run_stream(self, stream, scope):
+        try:
+            await self.app(scope, stream.receive, stream.send)
+            if not stream.remote_closed:
+                # Response sent, the rest of the request isn't wanted
+                self._frame(self.RST_STREAM, 0, stream.id, struct.pack('>I', self.NO_ERROR))
+        except asyncio.CancelledError:
+            pass # Reset by the client or connection closed
+        except Exception as e:
+            self.app._logger.error('HTTP/2 stream error ({}) from {}'.format(e, self.peer))
+            if not stream.reset:
+                self._frame(self.RST_STREAM, 0, stream.id, struct.pack('>I', self.INTERNAL_ERROR))
+        finally:
+            self.streams.pop(stream.id, None)
+            if self.conn is not None:
+                self.conn.busy = bool(self.streams)
+            if self.app._closing:
+                self._goaway(self.NO_ERROR)
+            if self.going_away and not self.streams:
+                self.writer.close() # Ends run
+
+    def _consumed(self, stream, n):
+        """
+        Give the client back window for n bytes read by the handler
+        """
+        self.recv_window += n
+        self._frame(self.WINDOW_UPDATE, 0, 0, struct.pack('>I', n))
+        if not stream.remote_closed:
+            stream.recv_window += n
+            self._frame(self.WINDOW_UPDATE, 0, stream.id, struct.pack('>I', n))
+
+    async def _send(self, stream, message):
+        """
+        Send an ASGI response message on stream
+        """
+        if message['type'] == 'http.response.start':
+            headers = [(b':status', str(message['status']).encode())]
+            headers += [(name.lower(), value) for name, value in message.get('headers', [])
+                        if name.lower() not in self.HOP_HEADERS]
+            block = _hpack_encode(headers)
+            kind = self.HEADERS
+            while True:
+                piece, block = block[:self.max_frame], block[self.max_frame:]
+                self._frame(kind, 0 if block else self.END_HEADERS, stream.id, piece)
+                kind = self.CONTINUATION
+                if not block:
+                    break
+            await self.writer.drain()
+            return
+        body = memoryview(message.get('body', b''))
+        end = not message.get('more_body', False)
+        pos = 0
+        while True:
+            size = min(len(body) - pos, self.max_frame)
+            while size and min(self.window, stream.window) <= 0:
+                self._window_changed.clear()
+                await self._window_changed.wait()
+            size = min(size, self.window, stream.window)
+            pos += size
+            self.window -= size
+            stream.window -= size
+            last = end and pos == len(body)
+            if size or last:
+                self._frame(self.DATA, self.END_STREAM if last else 0, stream.id,
+                            bytes(body[pos - size:pos]))
+            await self.writer.drain()
+            if pos == len(body):
+                break
+
+class _MemoryWriter:
+    """
+    Server side writer of a TestClient connection, data goes straight to
+    the client's reader
+    """
+    def __init__(self, reader, peer):
+        self._reader = reader
+        self._peer = peer
+        self.closed = False
+
+    def write(self, data):
+        if not self.closed:
+            self._reader.feed_data(data)
+
+    async def drain(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return self._peer if name == 'peername' else default
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._reader.feed_eof()
+
+class TestResponse:
+    """
+    A response received by TestClient
+
+    The following members are populated:
+
+      * version: The response version, e.g. HTTP/1.1
+      * code:    The response code
+      * reason:  The response reason
+      * headers: Dictionary of response headers, repeated headers are combined
+      * data:    The body, once read
+
+    Unless the request was made with stream=True the body has already been
+    read. Otherwise read it with read(), or iterate over the pieces with
+    async for as they arrive.
+    """
+    __test__ = False # Not a test case
+
+    def __init__(self, version, code, reason, headers, body, done):
+        self.version = version
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.data = b''
+        self._body = body
+        self._done = done # Called once the body has been read
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self._body.read()
+        if not data:
+            if self._done is not None:
+                self._done()
+                self._done = None
+            raise StopAsyncIteration
+        return data
+
+    async def read(self):
+        """
+        Read the rest of the body into data and return it
+        """
+        parts = [self.data]
+        while True:
+            try:
+                parts.append(await self.__anext__())
+            except StopAsyncIteration:
+                break
+        self.data = b''.join(parts)
+        return self.data
+
+    def text(self):
+        """
+        Return the body decoded as a string
+        """
+        return self.data.decode()
+
+    def json(self):
+        """
+        Return the body decoded from json
+        """
+        import json
+        return json.loads(self.data.decode())
+
+class TestConnection:
+    """
+    A virtual keep-alive connection to a Grole app, see TestClient.connection
+
+    Requests on one connection are sent one after the other through the
+    app's connection handling, as they would be over a socket.
+    """
+    __test__ = False # Not a test case
+
+    def __init__(self, app, peer):
+        self._app = app
+        self._peer = peer
+        self._task = None
+        self._busy = False
+
+    @property
+    def closed(self):
+        """
+        True once either side has closed the connection
+        """
+        return self._task is not None and (self._writer.closed or self._task.done())
+
+    async def request(self, method, path, headers={}, data=None, json=None, stream=False):
+        """
+        Send a request and wait for the response, returns a TestResponse
+
+        Parameters:
+
+            * method: The request method
+            * path: The request location, including any query string
+            * headers: Dictionary of request headers
+            * data: Body as bytes, a string, or an iterable or async iterable of bytes (a Content-Length header is then required)
+            * json: Object to send as a json body instead of data
+            * stream: Return once the headers are received, leaving the body to be read from the response
+        """
+        if self._busy:
+            raise RuntimeError('A request is already in progress on this connection')
+        if self.closed:
+            raise ConnectionError('Connection closed')
+        if self._task is None:
+            self._server_reader = asyncio.StreamReader()
+            self._client_reader = asyncio.StreamReader()
+            self._writer = _MemoryWriter(self._client_reader, self._peer)
+            self._task = asyncio.ensure_future(self._app._handle(self._server_reader, self._writer))
+        self._busy = True
+        try:
+            headers = dict(headers)
+            if json is not None:
+                data = self._app.json.dumps(json)
+                headers.setdefault('Content-Type', 'application/json')
+            if isinstance(data, str):
+                data = data.encode()
+            if isinstance(data, bytes):
+                headers['Content-Length'] = len(data)
+            elif data is not None and 'Content-Length' not in headers:
+                raise ValueError('A Content-Length header is needed to stream a request body')
+            headers.setdefault('Host', 'testclient')
+            head = '{} {} HTTP/1.1\r\n'.format(method, path)
+            head += ''.join('{}: {}\r\n'.format(k, v) for k, v in headers.items()) + '\r\n'
+            feed = self._server_reader.feed_data
+            feed(head.encode())
+            if isinstance(data, bytes):
+                feed(data)
+            elif hasattr(data, '__aiter__'):
+                async for part in data:
+                    feed(part)
+                    await asyncio.sleep(0) # Let the app read it
+            elif data is not None:
+                for part in data:
+                    feed(part)
+                    await asyncio.sleep(0)
+
+            version, code, reason, raw = await _read_response_head(self._client_reader)
+            headers = {}
+            length = None
+            chunked = False
+            for name, value in raw:
+                headers[name] = headers[name] + ', ' + value if name in headers else value
+                if name.lower() == 'content-length':
+                    length = int(value)
+                elif name.lower() == 'transfer-encoding':
+                    chunked = 'chunked' in value.lower()
+            if method == 'HEAD' or code in (204, 304) or code < 200:
+                length = 0
+            elif chunked:
+                length = None
+            body = _BodyReader(self._client_reader, length, chunked)
+        except BaseException:
+            self._busy = False
+            raise
+
+        res = TestResponse(version, code, reason, headers, body, self._finished)
+        if not stream:
+            await res.read()
+        return res
+
+    def _finished(self):
+        self._busy = False
+
+    async def close(self):
+        """
+        Close the connection and wait for the app to finish with it
+        """
+        if self._task is not None:
+            self._server_reader.feed_eof()
+            await self._task
+            self._writer.close()
+
+class TestClient:
+    """
+    Send requests to a Grole app in memory, see Grole.test_client
+
+    Requests go through the same parsing, dispatch and response writing as
+    requests from a socket. Each request uses an idle virtual connection if
+    there is one, or opens another, so concurrent requests run on
+    connections of their own and sequential ones are kept alive. Use
+    connection() for an explicit keep-alive sequence.
+
+    request and the get, post etc. shortcuts are coroutines. close (or
+    leaving async with) closes the connections.
+    """
+    __test__ = False # Not a test case
+
+    def __init__(self, app):
+        self.app = app
+        self._idle = []
+        self._connections = []
+
+    def connection(self):
+        """
+        Return a new TestConnection
+        """
+        conn = TestConnection(self.app, ('testclient', len(self._connections)))
+        self._connections.append(conn)
+        return conn
+
+    async def request(self, method, path, **kwargs):
+        """
+        Send a request, see TestConnection.request for the parameters
+
+        Returns a TestResponse.
+        """
+        while self._idle:
+            conn = self._idle.pop()
+            if not conn.closed:
+                break
+        else:
+            conn = self.connection()
+        res = await conn.request(method, path, **kwargs)
+        done = res._done
+        def finished():
+            if done is not None:
+                done()
+            if not conn.closed:
+                self._idle.append(conn)
+        if done is None:
+            finished() # Body already read
+        else:
+            res._done = finished
+        return res
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def head(self, path, **kwargs):
+        return self.request('HEAD', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request('PATCH', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def options(self, path, **kwargs):
+        return self.request('OPTIONS', path, **kwargs)
+
+    async def close(self):
+        """
+        Close all connections
+        """
+        for conn in self._connections:
+            await conn.close()
+        self._connections = []
+        self._idle = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+def _peer_address(req):
+    """
+    Default client key, the peer host for TCP or the whole peer address otherwise
+    """
+    return req.peer[0] if isinstance(req.peer, tuple) else req.peer
+
+class Timeouts:
+    """
+    Time limits protecting a Grole against slow clients and runaway handlers
+
+    Times are in seconds, None (the default) disables them. Expiries are
+    counted in Grole.metrics.
+    """
+    def __init__(self, header=None, body=None, min_body_rate=None, handler=None, write=None):
+        """
+        Parameters:
+
+            * header: Time to receive the request line and headers, also bounds idle keep-alive connections. The connection is closed on expiry.
+            * body: Time to receive the request body, a 408 is sent on expiry
+            * min_body_rate: Extend the body timeout by the time the body takes at this many bytes per second
+            * handler: Time async handlers may run before being cancelled and a 504 sent
+            * write: Time to write the response, the connection is closed on expiry
+        """
+        self.header = header
+        self.body = body
+        self.min_body_rate = min_body_rate
+        self.handler = handler
+        self.write = write
+
+class Limits:
+    """
+    Bounds on the size of requests a Grole accepts and the memory each connection can use
+
+    See Grole.connection_report for the buffered sizes of open connections.
+    """
+    def __init__(self, read_limit=None, max_header_size=64 * 1024, max_headers=100,
+                 max_body_size=None, write_limits=None):
+        """
+        Parameters:
+
+            * read_limit: StreamReader limit in bytes (default 64KiB), the longest line accepted. Up to twice this is buffered before reading from the socket is paused.
+            * max_header_size: Maximum total size of the request line and headers, larger requests get a 414 or 431 and are closed
+            * max_headers: Maximum number of request headers, more get a 431
+            * max_body_size: Requests with a larger Content-Length get a 413 without their body being read, None for no limit
+            * write_limits: (high, low) transport write buffer water marks in bytes (default (64KiB, 16KiB)). Writing a response waits while more than high bytes are waiting to be sent, until it falls to low.
+        """
+        self.read_limit = read_limit
+        self.max_header_size = max_header_size
+        self.max_headers = max_headers
+        self.max_body_size = max_body_size
+        self.write_limits = write_limits
+
+class HTTP2Settings:
+    """
+    Options for HTTP/2 connections, see Grole
+    """
+    def __init__(self, max_streams=100, max_header_block=64 * 1024):
+        """
+        Parameters:
+
+            * max_streams: Concurrent streams allowed per connection
+            * max_header_block: Largest compressed header block accepted, the decoded size is bounded by Limits.max_header_size
+        """
+        self.max_streams = max_streams
+        self.max_header_block = max_header_block
+
+class Grole:
+    """
+    A Grole Webserver
+    """
+    def __init__(self, env={}, json_backend=None, timeouts=None, limits=None,
+                 lag_threshold=None, timing=False, profile_every=None,
+                 rate_limit=None, fair_queue=None, client_key=None, http2=None):
+        """
+        Initialise a server
+
+        env is passed to request handlers to provide shared state.
+        Note, env by default contains doc which is populated from
+        registered route docstrings.
+
+        json_backend selects the module used to encode objects returned by
+        handlers and to decode Request.json(). It may be a JSONBackend or a
+        module name (e.g. orjson, or auto for the fastest available). The
+        default is the stdlib json module.
+
+        timeouts is a Timeouts limiting the time to receive the request,
+        run handlers and write the response. By default there are none.
+        limits is a Limits bounding request sizes and the memory each
+        connection can use, by default 64KiB and 100 headers per request.
+
+        Setting lag_threshold (seconds) enables a LagMonitor in lag_monitor
+        which reports handlers that block the event loop for longer, see
+        also serve_lag.
+
+        With timing set, the time spent parsing, dispatching, reading the
+        body, in the handler and serializing is sent in a Server-Timing
+        header and aggregated per route (including writing) in timings.
+        Setting profile_every to N runs one in N requests under cProfile,
+        merged into profile_stats. See serve_profile.
+
+        rate_limit is a RateLimit applied to all requests, routes can have
+        their own as well (see route). Rejected requests are counted in
+        metrics. Setting fair_queue to N runs at most N handlers at once,
+        sharing them between clients in turn (see FairQueue). Clients are
+        told apart by client_key, a function of the request, by default
+        the peer address.
+
+        Requests are checked before their body is read: those with no
+        route, with a Content-Length over limits.max_body_size (413) or
+        rejected by the route's validate hook are answered straight away
+        without reading the body. Clients sending Expect: 100-continue are
+        only told to continue once the request has passed these checks.
+
+        With http2 set to an HTTP2Settings (or True for the defaults),
+        HTTP/2 is used with clients which start with its connection preface
+        (prior knowledge), which ask to upgrade a request without a body
+        with Upgrade: h2c, or which select h2 with TLS ALPN (see
+        TLSContext). Streams are handled concurrently by the same routes as
+        HTTP/1.1 requests.
+
+        Caching headers are set by CachePolicy objects, given to route or
+        to cache_policy for paths matching a regex. Server side caching is
+        counted in metrics as cache_hits, cache_stale and cache_misses.
+        """
+        if isinstance(json_backend, str):
+            json_backend = JSONBackend(json_backend)
+        self.json = json_backend or _default_json
         self._handlers = defaultdict(list)
         self.env = {'doc': []}
         self.env.update(env)
         self._logger = logging.getLogger('grole')
+        self._connections = {} # writer -> _Connection
+        self._closing = False
+        self._handed_over = False
+        self.timeouts = timeouts or Timeouts()
+        self.limits = limits or Limits()
+        self.metrics = Counter()
+        self.lag_monitor = None
+        if lag_threshold is not None:
+            self.lag_monitor = LagMonitor(lag_threshold, describe=self._describe_task)
+        self.timing = timing
+        self.timings = defaultdict(dict) # route -> phase -> [count, total ns, max ns]
+        self.profile_every = profile_every
+        self.profile_stats = None
+        self._profile_count = 0
+        self._profiling = False
+        self.rate_limit = rate_limit
+        self.fair_queue = FairQueue(fair_queue) if fair_queue else None
+        self.client_key = client_key or _peer_address
+        self._options_route = _Route('.*', self._options)
+        self._static = {} # path -> _Route of static_response
+        self.http2 = HTTP2Settings() if http2 is True else http2 or None
+        self._cache_policies = [] # (compiled regex, CachePolicy)
 
-    def route(self, path_regex, methods=['GET'], doc=True):
+    def route(self, path_regex, methods=['GET'], doc=True, buffer=True, rate_limit=None,
+              validate=None, constant=False, cache=None):
         """
         Decorator to register a handler
 
@@ -321,6 +4007,11 @@ class Grole:
             * path_regex: Request path regex to match against for running the handler
             * methods: HTTP methods to use this handler for
             * doc: Add to internal doc structure
+            * buffer: Read the request body into req.data before calling the handler. If False the handler reads it with req.read() or req.multipart().
+            * rate_limit: RateLimit for this route, applied as well as the server wide one
+            * validate: Function (env, req), or coroutine function, called with the headers before the body is read. Return None to accept the request, or a Response (or raise HTTPError) to reject it.
+            * constant: The handler always returns the same response. It is run for the first request and the serialized response written as is to later ones, until invalidate is called. Responses with a streamed or file body, and errors, aren't kept.
+            * cache: CachePolicy for responses from this route, used instead of any from cache_policy
         """
         def register_func(func):
             """
@@ -328,11 +4019,95 @@ class Grole:
             """
             if doc:
                 self.env['doc'].append({'url': path_regex, 'methods': ', '.join(methods), 'doc': func.__doc__})
+            route = _Route(path_regex, func, buffer, rate_limit, validate, constant, cache)
             for method in methods:
-                self._handlers[method].append((re.compile(path_regex), func))
+                self._handlers[method].append(route)
             return func # Return the original function
         return register_func # Decorator
 
+    def static_response(self, path, body=b'', headers={}, code=200, reason='OK'):
+        """
+        Answer GET requests for path with a fixed response
+
+        The response is serialized here, requests are answered by writing
+        it in one go without running a handler. Calling again with the same
+        path replaces the response. The path is found before any route
+        regexes are tried, so it takes precedence over them.
+
+        Parameters:
+
+            * path: Request path to answer, matched exactly rather than as a regex
+            * body: Response body, converted as a handler's return value would be
+            * headers: Extra response headers
+            * code: The response code, default 200
+            * reason: The response reason, default OK
+        """
+        if not isinstance(body, (ResponseBody, bytes, str)) and body is not None:
+            body = ResponseJSON(body, backend=self.json)
+        res = Response(body, code, reason, headers)
+        if getattr(res.data, '_data', None) is None:
+            raise ValueError('static_response body must not be streamed')
+        prebuilt = _Prebuilt(res)
+        route = self._static.get(path)
+        if route is None:
+            route = self._static[path] = _Route(re.escape(path), None, constant=True)
+            self._handlers['GET'].append(route)
+        route.func = lambda env, req: prebuilt.response()
+        route.prebuilt = prebuilt
+
+    def cache_policy(self, path_regex, policy):
+        """
+        Use policy for responses to requests whose path matches path_regex
+
+        Policies are tried in the order they were added, and are overridden
+        by a route's own. This sets caching for several routes at once, e.g.
+        for parts of a static file tree:
+
+            app.cache_policy('/static/.*[.][0-9a-f]{8}[.](js|css)', CachePolicy(max_age=31536000, public=True, immutable=True))
+            app.cache_policy('.*[.]html', CachePolicy(no_cache=True))
+
+        Parameters:
+
+            * path_regex: Request path regex to match against
+            * policy: The CachePolicy
+        """
+        self._cache_policies.append((re.compile(path_regex), policy))
+
+    def _find_cache_policy(self, req, route):
+        """
+        The CachePolicy for req, None if there isn't one
+        """
+        if route is not None and route.cache is not None:
+            return route.cache
+        for regex, policy in self._cache_policies:
+            if regex.fullmatch(req.path):
+                return policy
+        return None
+
+    def _apply_cache(self, req, route, res):
+        """
+        Set the caching headers of res, unless it is an error
+        """
+        if res.code < 400 and (route is not None or self._cache_policies):
+            policy = self._find_cache_policy(req, route)
+            if policy is not None:
+                policy._apply(res)
+
+    def invalidate(self, path_regex=None):
+        """
+        Throw away the kept responses of constant routes
+
+        Their handlers are run again on the next request.
+
+        Parameters:
+
+            * path_regex: Only invalidate routes registered with this regex, default all of them
+        """
+        for routes in self._handlers.values():
+            for route in routes:
+                if route.constant and (path_regex is None or route.regex.pattern == path_regex):
+                    route.prebuilt = None
+
     async def _handle(self, reader, writer):
         """
         Handle a single TCP connection
@@ -341,86 +4116,724 @@ class Grole:
         """
         peer = writer.get_extra_info('peername')
         self._logger.debug('New connection from {}'.format(peer))
+        conn = self._connections[writer] = _Connection(writer, reader)
+        if self.limits.write_limits is not None:
+            transport = getattr(writer, 'transport', None)
+            if transport is not None:
+                transport.set_write_buffer_limits(*self.limits.write_limits)
         try:
+            if self.http2:
+                ssl_object = writer.get_extra_info('ssl_object')
+                if ssl_object is not None and ssl_object.selected_alpn_protocol() == 'h2':
+                    await _HTTP2Connection(self, reader, writer, conn).run()
+                    return
             # Loop handling requests
             while True:
                 # Read the request
-                req = Request()
-                await req._read(reader)
-
-                # Find and execute handler
-                res = None
-                for path_regex, handler in self._handlers.get(req.method, []):
-                    match = path_regex.fullmatch(req.path)
-                    if match:
-                        req.match = match
-                        try:
-                            if inspect.iscoroutinefunction(handler):
-                                res = await handler(self.env, req)
-                            else:
-                                res = handler(self.env, req)
-                            if not isinstance(res, Response):
-                                res = Response(data=res)
-                        except:
-                            # Error - log it and return 500
-                            self._logger.error(traceback.format_exc())
-                            res = Response(code=500, reason='Internal Server Error')
-                        break
-
-                # No handler - send 404
-                if res == None:
-                    res = Response(code=404, reason='Not Found')
+                req = Request(self.json)
+                req.peer = peer
+                if self.timing:
+                    req.timing = []
+                try:
+                    await _wait_for(req._read_head(reader, self.limits.max_header_size,
+                                                   self.limits.max_headers),
+                                    self.timeouts.header)
+                except asyncio.TimeoutError:
+                    self.metrics['header_timeouts'] += 1
+                    self._logger.debug('Header timeout from {}'.format(peer))
+                    writer.close()
+                    break
+                except HTTPError as e:
+                    self.metrics['headers_too_large'] += 1
+                    self._logger.info('{}: headers too large -> {}'.format(peer, e.code))
+                    res = Response(code=e.code, reason=e.reason, headers={'Connection': 'close'})
+                    try:
+                        await _wait_for(res._write(writer), self.timeouts.write)
+                    except asyncio.TimeoutError:
+                        self.metrics['write_timeouts'] += 1
+                    writer.close()
+                    break
+                if self.http2 and req.method == 'PRI' and req.version == 'HTTP/2.0':
+                    # Prior knowledge, the request line was the start of the preface
+                    if await reader.readexactly(6) == b'SM\r\n\r\n':
+                        await _HTTP2Connection(self, reader, writer, conn).run(preface=False)
+                    writer.close()
+                    break
+                if (self.http2 and req.headers.get('Upgrade', '').lower() == 'h2c' and
+                        'HTTP2-Settings' in req.headers and
+                        not int(req.headers.get('Content-Length', 0))):
+                    writer.write(b'HTTP/1.1 101 Switching Protocols\r\n'
+                                 b'Connection: Upgrade\r\nUpgrade: h2c\r\n\r\n')
+                    await _HTTP2Connection(self, reader, writer, conn).run(upgrade=req)
+                    break
+                conn.busy = True
+                conn.request = req
+                req._conn = conn
+                close = False
+
+                # Find the handler, read the body and execute the handler
+                if req.timing is not None:
+                    req._mark('parse')
+                route = self._find_route(req)
+                if req.timing is not None:
+                    req._mark('dispatch')
+                res = self._rate_limited(req, route) or await self._check(req, route)
+                waiting = req.headers.get('Expect', '').lower() == '100-continue'
+                try:
+                    if res is not None:
+                        req._stream_body(reader) # Rejected, leave the body unread
+                    else:
+                        if waiting and route.prebuilt is None:
+                            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                            waiting = False
+                        if route.prebuilt is not None:
+                            # Constant response, no handler to run
+                            req._stream_body(reader)
+                            res = route.prebuilt.copy()
+                        elif route.buffer:
+                            await _wait_for(req._buffer_body(reader), self._body_timeout(req))
+                        else:
+                            req._stream_body(reader)
+                        if res is None:
+                            if req.timing is not None:
+                                req._mark('body')
+                            res = await self._dispatch(req, route)
+                    if req._remaining:
+                        # Body left unread by the handler
+                        if res.code >= 400:
+                            close = True # Don't waste time reading it
+                        elif waiting:
+                            close = True # Not told to continue, the client won't send it
+                        else:
+                            await _wait_for(req._discard_body(), self._body_timeout(req))
+                except asyncio.TimeoutError:
+                    self.metrics['body_timeouts'] += 1
+                    res = Response(code=408, reason='Request Timeout')
+                    close = True
 
                 # Respond
-                await res._write(writer)
+                self._apply_cache(req, route, res)
+                close = close or self._closing
+                if close:
+                    res.headers['Connection'] = 'close'
+                if req.timing is not None:
+                    res.headers['Server-Timing'] = ', '.join(
+                        '{};dur={:.3f}'.format(phase, dur / 1e6) for phase, dur in req._phases())
+                try:
+                    await _wait_for(res._write(writer, req.method == 'HEAD'), self.timeouts.write)
+                except asyncio.TimeoutError:
+                    self.metrics['write_timeouts'] += 1
+                    self._logger.info('{}: {} -> write timeout'.format(peer, req.path))
+                    writer.close()
+                    break
                 self._logger.info('{}: {} -> {}'.format(peer, req.path,  res.code))
+                if req.timing is not None:
+                    req._mark('write')
+                    self._record_timing(req)
+                conn.busy = False
+                if close:
+                    writer.close()
+                    break
         except EOFError:
             self._logger.debug('Connection closed from {}'.format(peer))
         except Exception as e:
             self._logger.error('Connection error ({}) from {}'.format(e, peer))
             writer.close()
+        finally:
+            self._connections.pop(writer, None)
+
+    def connection_report(self):
+        """
+        Return the buffer sizes of open connections
+
+        read is bytes received but not yet parsed and write bytes waiting
+        to be sent, per connection and in total.
+        """
+        connections = []
+        for conn in list(self._connections.values()):
+            read, write = conn.buffered()
+            connections.append({'peer': conn.writer.get_extra_info('peername'), 'busy': conn.busy,
+                                'read': read, 'write': write})
+        return {'connections': len(connections),
+                'busy': sum(c['busy'] for c in connections),
+                'read': sum(c['read'] for c in connections),
+                'write': sum(c['write'] for c in connections),
+                'max_read': max([c['read'] for c in connections] + [0]),
+                'max_write': max([c['write'] for c in connections] + [0]),
+                'per_connection': connections}
+
+    async def __call__(self, scope, receive, send):
+        """
+        ASGI 3 application interface, to run the app under an ASGI server
+
+        http requests are dispatched to the registered handlers with request
+        and response bodies streamed. A lifespan startup runs warmup.
+        """
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await self.warmup()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type {}'.format(scope['type']))
+
+        req = Request(self.json)
+        req.peer = tuple(scope['client']) if scope.get('client') else None
+        if self.timing:
+            req.timing = []
+            req._mark('start')
+        path = scope['path']
+        root_path = scope.get('root_path', '')
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        location = urllib.parse.quote(path)
+        if scope.get('query_string'):
+            location += '?' + scope['query_string'].decode('latin-1')
+        req._set_start(scope['method'], location, 'HTTP/' + scope.get('http_version', '1.1'))
+        values = defaultdict(list)
+        for name, value in scope.get('headers', []):
+            name = '-'.join(x.capitalize() for x in name.decode('latin-1').split('-'))
+            values[name].append(value.decode('latin-1'))
+        req.headers = {name: ', '.join(value) for name, value in values.items()}
+        req.data = b''
+
+        reader = _ASGIReader(receive)
+        too_large = False
+        if 'Content-Length' not in req.headers:
+            # Without a length the server has de-chunked the body, read it all
+            max_body_size = self.limits.max_body_size
+            length = await reader._buffer_all(max_body_size)
+            if max_body_size is not None and length > max_body_size:
+                too_large = True
+            elif length:
+                req.headers['Content-Length'] = str(length)
+
+        if req.timing is not None:
+            req._mark('parse')
+        route = self._find_route(req)
+        if req.timing is not None:
+            req._mark('dispatch')
+        res = self._rate_limited(req, route)
+        if res is not None:
+            res = res.response()
+        elif too_large:
+            self.metrics['body_too_large'] += 1
+            res = Response(code=413, reason='Payload Too Large')
+        else:
+            res = await self._check(req, route)
+        if res is None and route.prebuilt is not None:
+            res = route.prebuilt.response()
+        try:
+            if res is None:
+                if route.buffer:
+                    await _wait_for(req._buffer_body(reader), self._body_timeout(req))
+                else:
+                    req._stream_body(reader)
+                if req.timing is not None:
+                    req._mark('body')
+                res = await self._dispatch(req, route)
+        except asyncio.TimeoutError:
+            self.metrics['body_timeouts'] += 1
+            res = Response(code=408, reason='Request Timeout')
+        if isinstance(res, _Prebuilt):
+            res = res.response()
+        self._apply_cache(req, route, res)
+
+        if req.timing is not None:
+            res.headers['Server-Timing'] = ', '.join(
+                '{};dur={:.3f}'.format(phase, dur / 1e6) for phase, dur in req._phases())
+        head = req.method == 'HEAD'
+        if head:
+            await res.data._head(res.headers)
+        headers = [(str(k).encode('latin-1'), str(v).encode('latin-1'))
+                   for k, values in res.headers.items() if k.lower() != 'transfer-encoding'
+                   for v in (values if isinstance(values, list) else [values])]
+        await send({'type': 'http.response.start', 'status': res.code, 'headers': headers})
+        writer = _ASGIWriter(send)
+        if not head:
+            await res.data._write(writer)
+        await writer.finish()
+        self._logger.info('{}: {} -> {}'.format(scope.get('client'), req.path, res.code))
+        if req.timing is not None:
+            req._mark('write')
+            self._record_timing(req)
+
+    def test_client(self):
+        """
+        Return a TestClient sending requests to this app in memory
+        """
+        return TestClient(self)
+
+    async def warmup(self):
+        """
+        Do one-off initialisation to reduce the cost of the first request
+
+        Loads the mimetypes database, starts the file thread pool and runs a
+        request, using a method with no handlers, through the connection
+        handling path. Route regexes are compiled, and whether handlers are
+        coroutines resolved, when they are registered. Handlers aren't run,
+        so the first request still costs more than later ones. The warmup
+        request isn't counted in metrics, timings or rate limits. Called by
+        run before serving.
+        """
+        import mimetypes
+        mimetypes.init()
+        self.json.loads(self.json.dumps({'warm': [1, 'up']}))
+        await _in_file_pool(os.getpid)
+        saved = (self._logger.disabled, self.metrics, self.timings, self.rate_limit)
+        # Don't log or account for the warmup request
+        self._logger.disabled = True
+        self.metrics, self.timings, self.rate_limit = Counter(), defaultdict(dict), None
+        try:
+            await self._handle(_BytesReader(b'WARMUP /%20?warm=up HTTP/1.1\r\nHost: warmup\r\n\r\n'),
+                               _NullWriter())
+        finally:
+            self._logger.disabled, self.metrics, self.timings, self.rate_limit = saved
+
+    def _describe_task(self, task):
+        """
+        Describe the request being handled by task, for LagMonitor
+        """
+        for conn in list(self._connections.values()):
+            if (conn.task is task or conn.handler_task is task) and conn.busy:
+                req = conn.request
+                match = getattr(req, 'match', None)
+                route = match.re.pattern if match else None
+                return '{} {} (route {})'.format(req.method, req.path, route)
+        return None
+
+    def _body_timeout(self, req):
+        """
+        Time allowed to receive the body of req
+        """
+        length = int(req.headers.get('Content-Length', 0))
+        timeouts = self.timeouts
+        if timeouts.min_body_rate is None or (length == 0 and timeouts.body is None):
+            return timeouts.body
+        return (timeouts.body or 0) + length / timeouts.min_body_rate
+
+    def _find_route(self, req):
+        """
+        Find the route for req, setting req.match
+
+        Returns None if there is no matching route. Paths of static_response
+        are looked up before any GET route regexes.
+        """
+        if req.method == 'GET' and req.path in self._static:
+            return self._static_route(req)
+        for route in self._handlers.get(req.method, []):
+            match = route.regex.fullmatch(req.path)
+            if match:
+                req.match = match
+                return route
+        if req.method == 'HEAD':
+            # Answer HEAD with the GET handler, the body isn't sent
+            if req.path in self._static:
+                return self._static_route(req)
+            for route in self._handlers.get('GET', []):
+                match = route.regex.fullmatch(req.path)
+                if match:
+                    req.match = match
+                    return route
+        elif req.method == 'OPTIONS' and self._allowed(req.path):
+            req.match = self._options_route.regex.fullmatch(req.path)
+            return self._options_route
+        return None
+
+    def _static_route(self, req):
+        route = self._static[req.path]
+        req.match = route.regex.fullmatch(req.path)
+        return route
+
+    def _allowed(self, path):
+        """
+        Return the sorted methods with a route for path, or any route if path is *
+        """
+        methods = set()
+        for method, routes in self._handlers.items():
+            if path == '*' or any(route.regex.fullmatch(path) for route in routes):
+                methods.add(method)
+        if methods:
+            methods.add('OPTIONS')
+            if 'GET' in methods:
+                methods.add('HEAD')
+        return sorted(methods)
+
+    def _options(self, env, req):
+        """
+        Handler answering OPTIONS for paths without an OPTIONS route
+        """
+        return Response(None, 200, 'OK', {'Allow': ', '.join(self._allowed(req.path))})
+
+    async def _dispatch(self, req, route):
+        """
+        Execute the handler of route for req
+
+        Returns the Response to send
+        """
+        if route is None:
+            # No handler - send 404
+            return Response(code=404, reason='Not Found')
+        if req.method in ('GET', 'HEAD'):
+            policy = self._find_cache_policy(req, route)
+            if policy is not None and policy._shared(req):
+                return await self._cached_call(req, route, policy)
+        return await self._queued_call(req, route)
+
+    async def _queued_call(self, req, route):
+        """
+        Run the handler of route for req, waiting for the fair queue if there is one
+        """
+        if self.fair_queue is None:
+            return await self._call(req, route)
+        await self.fair_queue.acquire(self.client_key(req))
+        req._slot = True
+        try:
+            return await self._call(req, route)
+        finally:
+            if req._slot: # Handlers may hand it back, see serve_batch
+                self.fair_queue.release()
+                req._slot = False
+
+    async def _cached_call(self, req, route, policy):
+        """
+        Answer req from the server side cache of policy if possible, otherwise run the handler
+
+        Stale responses are answered while a refresh runs in the background.
+        """
+        key = policy._key(req)
+        entry = policy._entries.get(key)
+        if entry is not None:
+            prebuilt, stored = entry
+            age = time.monotonic() - stored
+            if age < (policy.max_age or 0) + (policy.stale_while_revalidate or 0):
+                if age < (policy.max_age or 0):
+                    self.metrics['cache_hits'] += 1
+                else:
+                    self.metrics['cache_stale'] += 1
+                    if key not in policy._refreshing:
+                        policy._refreshing[key] = asyncio.ensure_future(
+                            self._refresh(self._refresh_request(req), route, policy, key))
+                policy._entries.move_to_end(key)
+                res = prebuilt.copy()
+                res.headers['Age'] = int(age)
+                return res
+        self.metrics['cache_misses'] += 1
+        res = await self._queued_call(req, route)
+        policy._store(key, res)
+        return res
 
-    def run(self, host='localhost', port=1234, ssl_context=None):
+    def _refresh_request(self, req):
+        """
+        A copy of the request line and headers of req, to refresh its cached response
+        """
+        fresh = Request(self.json)
+        fresh.peer = req.peer
+        fresh._set_start('GET', req.location, req.version)
+        fresh.headers = dict(req.headers)
+        fresh.data = b''
+        fresh.match = req.match
+        return fresh
+
+    async def _refresh(self, req, route, policy, key):
+        """
+        Run the handler again for a stale cached response
+        """
+        try:
+            policy._store(key, await self._queued_call(req, route))
+        finally:
+            del policy._refreshing[key]
+
+    async def _check(self, req, route):
+        """
+        Check req can be handled before its body is read
+
+        Returns the response rejecting it, or None to go ahead
+        """
+        if route is None:
+            return Response(code=404, reason='Not Found')
+        if self.limits.max_body_size is not None:
+            if int(req.headers.get('Content-Length', 0)) > self.limits.max_body_size:
+                self.metrics['body_too_large'] += 1
+                return Response(code=413, reason='Payload Too Large')
+        if route.validate is not None:
+            try:
+                res = route.validate(self.env, req)
+                import inspect
+                if inspect.isawaitable(res):
+                    res = await res
+            except HTTPError as e:
+                res = Response(code=e.code, reason=e.reason)
+            return res
+        return None
+
+    def _rate_limited(self, req, route):
+        """
+        Check the rate limits for req
+
+        Returns a 429 response if over a limit, otherwise None
+        """
+        for limit in (self.rate_limit, route and route.rate_limit):
+            if limit is not None:
+                wait = limit.check((limit.key or self.client_key)(req))
+                if wait:
+                    self.metrics['rate_limited'] += 1
+                    return limit.rejection(wait)
+        return None
+
+    async def _call(self, req, route):
+        """
+        Run the handler of route for req, converting the result to a Response
+        """
+        profile = self._profile_start() if self.profile_every else None
+        try:
+            if route.is_async:
+                res = await self._run_async(route.func, req)
+            else:
+                res = route.func(self.env, req)
+            if req.timing is not None:
+                req._mark('handler')
+            if not isinstance(res, Response):
+                if not (res is None or isinstance(res, (ResponseBody, bytes, str))):
+                    # For HEAD the lazily encoded streaming form avoids encoding at all
+                    res = ResponseJSON(res, backend=self.json, stream=req.method == 'HEAD')
+                res = Response(data=res)
+            if route.constant and getattr(res.data, '_data', None) is not None:
+                route.prebuilt = _Prebuilt(res)
+            if req.timing is not None:
+                req._mark('serialize')
+        except asyncio.CancelledError:
+            raise
+        except HTTPError as e:
+            res = Response(code=e.code, reason=e.reason)
+        except:
+            # Error - log it and return 500
+            import traceback
+            self._logger.error(traceback.format_exc())
+            res = Response(code=500, reason='Internal Server Error')
+        finally:
+            if profile is not None:
+                self._profile_stop(profile)
+        return res
+
+    def _record_timing(self, req):
+        """
+        Add the timing of req to the per route totals
+        """
+        match = getattr(req, 'match', None)
+        phases = self.timings[match.re.pattern if match else None]
+        for phase, duration in req._phases():
+            stats = phases.get(phase)
+            if stats is None:
+                phases[phase] = [1, duration, duration]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] = max(stats[2], duration)
+
+    def _profile_start(self):
+        """
+        Start profiling if this is one of the 1 in profile_every requests
+        """
+        self._profile_count += 1
+        if self._profiling or self._profile_count % self.profile_every:
+            return None
+        import cProfile
+        self._profiling = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def _profile_stop(self, profile):
+        """
+        Stop profiling and merge the results into profile_stats
+
+        Note, profiles of async handlers include any other work the event
+        loop did while the handler was waiting.
+        """
+        profile.disable()
+        import pstats
+        self._profiling = False
+        if self.profile_stats is None:
+            self.profile_stats = pstats.Stats(profile)
+            self.profile_stats.requests = 0
+        else:
+            self.profile_stats.add(profile)
+        self.profile_stats.requests += 1
+
+    async def _run_async(self, handler, req):
+        """
+        Run an async handler, cancelling it if it exceeds timeouts.handler
+        """
+        if self.timeouts.handler is None:
+            return await handler(self.env, req)
+        task = asyncio.ensure_future(handler(self.env, req))
+        if req._conn is not None:
+            req._conn.handler_task = task # So LagMonitor can name the request
+        try:
+            done, _ = await asyncio.wait([task], timeout=self.timeouts.handler)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if req._conn is not None:
+                req._conn.handler_task = None
+        if not done:
+            task.cancel()
+            self.metrics['handler_timeouts'] += 1
+            self._logger.warning('Handler timeout for {}'.format(req.path))
+            return Response(code=504, reason='Gateway Timeout')
+        return task.result()
+
+    async def shutdown(self, timeout=10):
+        """
+        Gracefully close client connections
+
+        Idle connections are closed straight away. In-flight requests are
+        given until timeout (seconds) to complete, after which their
+        connections are closed. Call after the listening server is closed.
+        """
+        self._closing = True
+        self._logger.info('Shutting down, {} connection(s) open'.format(len(self._connections)))
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while True:
+            for conn in list(self._connections.values()):
+                if not conn.busy:
+                    conn.close()
+                    self._connections.pop(conn.writer, None)
+            if not self._connections or loop.time() >= deadline:
+                break
+            await asyncio.sleep(0.05)
+        for conn in list(self._connections.values()):
+            self._logger.warning('Closing connection with request in progress')
+            conn.close()
+        self._connections.clear()
+
+    def _reload(self, loop, listeners):
+        """
+        Hand the listening sockets over to a new copy of this process and stop
+
+        The new process inherits the sockets so connections queue up
+        rather than being refused while it starts.
+        """
+        fds = [[sock.fileno() for sock in listener.sockets()] for listener in listeners]
+        env = dict(os.environ)
+        # Listeners separated by commas, the sockets of each by +
+        env['GROLE_LISTEN_FDS'] = ','.join('+'.join(str(fd) for fd in group) for group in fds)
+        try:
+            import subprocess
+            subprocess.Popen([sys.executable] + sys.argv, env=env,
+                             pass_fds=[fd for group in fds for fd in group])
+        except Exception as e:
+            self._logger.error('Could not reload: {}'.format(e))
+            return
+        self._logger.info('Reloading, handed over to new process')
+        self._handed_over = True
+        loop.stop()
+
+    def run(self, host='localhost', port=1234, ssl_context=None, shutdown_timeout=10,
+            listeners=None):
         """
         Launch the server. Will run forever accepting connections until interrupted.
 
+        On SIGTERM (or Ctrl-C) the server stops accepting connections and
+        drains existing ones, see shutdown. On SIGHUP a new copy of the
+        process is started which takes over the listening sockets before
+        this one drains and exits.
+
         Parameters:
 
             * host: The host to listen on
             * port: The port to listen on
-            * ssl_context: The SSL context passed to asyncio
+            * ssl_context: The SSL context passed to asyncio, or a TLSContext
+            * shutdown_timeout: Seconds to allow in-flight requests to finish when shutting down
+            * listeners: List of Listener objects to serve on, replaces host, port and ssl_context
         """
+        if listeners is None:
+            listeners = [Listener(host, port, ssl_context=ssl_context)]
+
+        # Take over sockets from the process we are reloading
+        fds = _inherited_fds()
+        if len(fds) == len(listeners):
+            for listener, fd in zip(listeners, fds):
+                listener.fd = fd[0] if len(fd) == 1 else fd
+
         # Setup loop
         loop = asyncio.get_event_loop()
-        coro = asyncio.start_server(self._handle, host, port, loop=loop, ssl=ssl_context)
+        loop.run_until_complete(self.warmup())
         try:
-            server = loop.run_until_complete(coro)
+            for listener in listeners:
+                loop.run_until_complete(listener._start(self._handle, self.limits.read_limit))
         except Exception as e:
             self._logger.error('Could not launch server: {}'.format(e))
+            for listener in listeners:
+                if listener.server is not None:
+                    loop.run_until_complete(listener._close())
             return
 
+        for signame, callback in (('SIGTERM', loop.stop),
+                                  ('SIGHUP', lambda: self._reload(loop, listeners))):
+            try:
+                loop.add_signal_handler(getattr(signal, signame), callback)
+            except (AttributeError, NotImplementedError):
+                pass # Not supported on this platform
+
         # Run the server
-        self._logger.info('Serving on {}'.format(server.sockets[0].getsockname()))
+        if self.lag_monitor is not None:
+            self.lag_monitor.start()
+        for listener in listeners:
+            for sock in listener.sockets():
+                self._logger.info('Serving on {}'.format(sock.getsockname()))
         try:
             loop.run_forever()
         except KeyboardInterrupt:
             pass
 
         # Close the server
-        server.close()
-        loop.run_until_complete(server.wait_closed())
+        if self.lag_monitor is not None:
+            self.lag_monitor.stop()
+        for listener in listeners:
+            listener._stop()
+        loop.run_until_complete(self.shutdown(shutdown_timeout))
+        for listener in listeners:
+            loop.run_until_complete(listener._close(unlink=not self._handed_over))
         loop.close()
 
+def _inherited_fds():
+    """
+    Listening socket file descriptors passed from a parent process during reload
+
+    Returns a list of the file descriptors of each listener.
+    """
+    fds = os.environ.pop('GROLE_LISTEN_FDS', '')
+    return [[int(fd) for fd in group.split('+')] for group in fds.split(',') if group]
+
 def parse_args(args=sys.argv[1:]):
     """
     Parse command line arguments for Grole server running as static file server
     """
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-a', '--address', help='address to listen on, default localhost',
                                 default='localhost')
     parser.add_argument('-p', '--port', help='port to listen on, default 1234',
                                 default=1234, type=int)
-    parser.add_argument('-d', '--directory', help='directory to serve, default .',
+    parser.add_argument('-u', '--unix', help='unix domain socket path to listen on, can be repeated',
+                                default=[], action='append')
+    parser.add_argument('-m', '--mode', help='permissions for unix domain sockets (octal), e.g. 660',
+                                default=None, type=lambda x: int(x, 8))
+    parser.add_argument('-f', '--fd', help='listening socket file descriptor to use, can be repeated',
+                                default=[], action='append', type=int)
+    parser.add_argument('-T', '--notcp', help='do not listen on the TCP address and port',
+                                default=False, action='store_true')
+    parser.add_argument('-b', '--backlog', help='maximum queued connections, default 100',
+                                default=100, type=int)
+    parser.add_argument('-d', '--directory', help='directory (or pack file) to serve, default .',
                                 default='.')
     parser.add_argument('-n', '--noindex', help='do not show directory indexes',
                                 default=False, action='store_true')
@@ -431,10 +4844,27 @@ def parse_args(args=sys.argv[1:]):
                                 default=False, action='store_true')
     return parser.parse_args(args)
 
+def parse_pack_args(args):
+    """
+    Parse command line arguments for packing static files
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='grole pack', description='Pack static files to serve with -d')
+    parser.add_argument('directory', help='directory of files to pack')
+    parser.add_argument('output', help='pack file to write')
+    parser.add_argument('-n', '--nocompress', help='do not store gzip compressed variants',
+                                default=False, action='store_true')
+    return parser.parse_args(args)
+
 def main(args=sys.argv[1:]):
     """
-    Run Grole static file server
+    Run Grole static file server, or with pack as the first argument pack static files
     """
+    if args[:1] == ['pack']:
+        args = parse_pack_args(args[1:])
+        count = pack(args.directory, args.output, not args.nocompress)
+        print('Packed {} files into {}'.format(count, args.output))
+        return
     args = parse_args(args)
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
@@ -444,7 +4874,10 @@ def main(args=sys.argv[1:]):
         logging.basicConfig(level=logging.INFO)
     app = Grole()
     serve_static(app, '', args.directory, not args.noindex)
-    app.run(args.address, args.port)
+    listeners = [] if args.notcp else [Listener(args.address, args.port, backlog=args.backlog)]
+    listeners += [Listener(path=path, mode=args.mode, backlog=args.backlog) for path in args.unix]
+    listeners += [Listener(fd=fd, backlog=args.backlog) for fd in args.fd]
+    app.run(listeners=listeners)
 
 if __name__ == '__main__':
     main()
@@ -4,14 +4,22 @@ import io
 a_wait = asyncio.new_event_loop().run_until_complete
 
 class FakeReader():
-    def __init__(self, data=b''):
+    def __init__(self, data=b'', block=False):
         self.io = io.BytesIO(data)
         self.len = len(data)
+        self.block = block # Wait forever for more data once empty
 
     async def readline(self):
+        if self.block and self.at_eof():
+            await asyncio.sleep(3600)
         return self.io.readline()
 
+    async def read(self, n):
+        return self.io.read(n)
+
     async def readexactly(self, n):
+        if self.block and self.len - self.io.tell() < n:
+            await asyncio.sleep(3600)
         data = self.io.read(n)
         if len(data) != n:
             raise asyncio.IncompleteReadError(data, n)
@@ -23,6 +31,7 @@ class FakeReader():
 class FakeWriter():
     def __init__(self):
         self.data = b''
+        self.closed = False
 
     async def drain(self):
         return
@@ -33,6 +42,13 @@ class FakeWriter():
     def get_extra_info(self, arg):
         return 'fake'
 
+    def close(self):
+        self.closed = True
+
+class SlowWriter(FakeWriter):
+    async def drain(self):
+        await asyncio.sleep(3600)
+
 class ErrorWriter():
     def __init__(self):
         self.closed = False
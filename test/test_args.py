@@ -12,6 +12,17 @@ class TestArgs(unittest.TestCase):
         self.assertEqual(args.noindex, False)
         self.assertEqual(args.verbose, False)
         self.assertEqual(args.quiet, False)
+        self.assertEqual(args.unix, [])
+        self.assertEqual(args.fd, [])
+        self.assertEqual(args.notcp, False)
+
+    def test_listeners(self):
+        args = grole.parse_args(['-u', 'a.sock', '-u', 'b.sock', '-m', '660', '-f', '3', '-T', '-b', '5'])
+        self.assertEqual(args.unix, ['a.sock', 'b.sock'])
+        self.assertEqual(args.mode, 0o660)
+        self.assertEqual(args.fd, [3])
+        self.assertEqual(args.notcp, True)
+        self.assertEqual(args.backlog, 5)
 
     def test_override(self):
         args = grole.parse_args(['-a', 'foo', '-p', '27', '-d', 'bar', '-n', '-v'])
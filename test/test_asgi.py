@@ -0,0 +1,236 @@
+import unittest
+import asyncio
+from helpers import a_wait, FakeReader, FakeWriter
+
+import grole
+
+class Harness:
+    """
+    Minimal stdlib ASGI server side, checking the messages an app sends
+    """
+    def __init__(self, test):
+        self.test = test
+
+    def call(self, app, method, path, query=b'', headers=[], body=[b''], root_path=''):
+        """
+        Run one http request through app, body is a list of body pieces
+
+        Returns (status, headers, body bytes, body messages)
+        """
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+                 'method': method, 'scheme': 'http', 'path': path,
+                 'raw_path': path.encode(), 'query_string': query,
+                 'root_path': root_path, 'headers': headers,
+                 'client': ('127.0.0.1', 1234), 'server': ('127.0.0.1', 80)}
+        incoming = [{'type': 'http.request', 'body': part, 'more_body': i < len(body) - 1}
+                    for i, part in enumerate(body)]
+        sent = []
+
+        async def receive():
+            if incoming:
+                return incoming.pop(0)
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            self.test.assertIsInstance(message, dict)
+            if not sent:
+                self.test.assertEqual(message['type'], 'http.response.start')
+                self.test.assertIsInstance(message['status'], int)
+                for name, value in message['headers']:
+                    self.test.assertIsInstance(name, bytes)
+                    self.test.assertIsInstance(value, bytes)
+            else:
+                self.test.assertEqual(message['type'], 'http.response.body')
+                self.test.assertTrue(sent[-1].get('more_body', False) or sent[-1] is sent[0],
+                                     'Message sent after the body finished')
+                self.test.assertIsInstance(message.get('body', b''), bytes)
+            sent.append(message)
+
+        a_wait(app(scope, receive, send))
+        self.test.assertGreater(len(sent), 1)
+        self.test.assertFalse(sent[-1].get('more_body', False))
+        bodies = sent[1:]
+        headers = {k.decode(): v.decode() for k, v in sent[0]['headers']}
+        return sent[0]['status'], headers, b''.join(m.get('body', b'') for m in bodies), bodies
+
+    def lifespan(self, app):
+        incoming = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+        async def receive():
+            return incoming.pop(0)
+        async def send(message):
+            sent.append(message['type'])
+        a_wait(app({'type': 'lifespan', 'asgi': {'version': '3.0'}}, receive, send))
+        return sent
+
+def make_app():
+    app = grole.Grole()
+
+    @app.route('/hello')
+    def hello(env, req):
+        return 'Hello, ' + req.query.get('name', 'World')
+
+    @app.route('/echo', methods=['POST'])
+    def echo(env, req):
+        return grole.Response(req.data, headers={'X-Type': req.headers.get('Content-Type')})
+
+    @app.route('/count', methods=['POST'], buffer=False)
+    async def count(env, req):
+        total = 0
+        while True:
+            data = await req.read(100)
+            if not data:
+                return total
+            total += len(data)
+
+    @app.route('/stream')
+    def stream(env, req):
+        return grole.ResponseStream(['a', 'b', 'c'])
+
+    return app
+
+async def raw_app(scope, receive, send):
+    """
+    A plain ASGI app echoing the request in two body messages
+    """
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    await send({'type': 'http.response.start', 'status': 201,
+                'headers': [(b'content-type', b'text/plain'), (b'x-root', scope['root_path'].encode()),
+                            (b'x-client', str(scope['client']).encode()),
+                            (b'set-cookie', b'a=1; Expires=Wed, 21 Oct 2037 07:28:00 GMT'),
+                            (b'set-cookie', b'b=2')]})
+    await send({'type': 'http.response.body', 'body': scope['method'].encode() + b' ' +
+                scope['path'].encode() + b'?' + scope['query_string'], 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b' ' + body})
+
+async def broken_app(scope, receive, send):
+    raise Exception('broken')
+
+class TestASGIApp(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        self.harness = Harness(self)
+
+    def test_get(self):
+        status, headers, body, _ = self.harness.call(self.app, 'GET', '/hello', b'name=asgi')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'text/html')
+        self.assertEqual(body, b'Hello, asgi')
+
+    def test_root_path(self):
+        _, _, body, _ = self.harness.call(self.app, 'GET', '/app/hello', root_path='/app')
+        self.assertEqual(body, b'Hello, World')
+
+    def test_not_found(self):
+        status, _, _, _ = self.harness.call(self.app, 'GET', '/missing')
+        self.assertEqual(status, 404)
+
+    def test_body(self):
+        headers = [(b'content-type', b'text/plain'), (b'content-length', b'6')]
+        _, headers, body, _ = self.harness.call(self.app, 'POST', '/echo', headers=headers,
+                                                body=[b'foo', b'bar'])
+        self.assertEqual(body, b'foobar')
+        self.assertEqual(headers['X-Type'], 'text/plain')
+
+    def test_body_without_length(self):
+        _, _, body, _ = self.harness.call(self.app, 'POST', '/echo', body=[b'foo', b'bar'])
+        self.assertEqual(body, b'foobar')
+
+    def test_body_without_length_too_large(self):
+        self.app.limits.max_body_size = 5
+        status, _, _, _ = self.harness.call(self.app, 'POST', '/echo', body=[b'foo', b'bar', b'baz'])
+        self.assertEqual(status, 413)
+        self.assertEqual(self.app.metrics['body_too_large'], 1)
+        _, _, body, _ = self.harness.call(self.app, 'POST', '/echo', body=[b'foo', b'ba'])
+        self.assertEqual(body, b'fooba')
+
+    def test_reader(self):
+        parts = [{'type': 'http.request', 'body': b'abc', 'more_body': True},
+                 {'type': 'http.request', 'body': b'defg', 'more_body': False}]
+        async def receive():
+            return parts.pop(0)
+        async def run():
+            reader = grole._ASGIReader(receive)
+            return [await reader.read(2), await reader.readexactly(4), await reader.read()]
+        self.assertEqual(a_wait(run()), [b'ab', b'cdef', b'g'])
+
+    def test_streamed_body(self):
+        parts = [b'x' * 150] * 4
+        _, _, body, _ = self.harness.call(self.app, 'POST', '/count', body=parts,
+                                          headers=[(b'content-length', b'600')])
+        self.assertEqual(body, b'600')
+
+    def test_streamed_response(self):
+        _, headers, body, messages = self.harness.call(self.app, 'GET', '/stream')
+        self.assertEqual(body, b'abc')
+        self.assertNotIn('Transfer-Encoding', headers)
+        self.assertGreater(len(messages), 1)
+
+    def test_cache(self):
+        self.app.cache_policy('/hello', grole.CachePolicy(max_age=60, server=True))
+        self.harness.call(self.app, 'GET', '/hello')
+        status, headers, body, _ = self.harness.call(self.app, 'GET', '/hello')
+        self.assertEqual(body, b'Hello, World')
+        self.assertEqual(headers['Cache-Control'], 'max-age=60')
+        self.assertEqual(headers['Age'], '0')
+        self.assertEqual(self.app.metrics['cache_hits'], 1)
+
+    def test_lifespan(self):
+        self.assertEqual(self.harness.lifespan(self.app),
+                         ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+
+class TestServeASGI(unittest.TestCase):
+
+    def setUp(self):
+        self.app = grole.Grole()
+        grole.serve_asgi(self.app, '/raw', raw_app)
+        grole.serve_asgi(self.app, '/grole', make_app())
+        grole.serve_asgi(self.app, '/broken', broken_app)
+        self.client = self.app.test_client()
+        self.addCleanup(lambda: a_wait(self.client.close()))
+
+    def test_raw(self):
+        res = a_wait(self.client.post('/raw/x%20y?a=b', data=b'data'))
+        self.assertEqual(res.code, 201)
+        self.assertEqual(res.reason, 'Created')
+        self.assertEqual(res.headers['x-root'], '/raw')
+        self.assertEqual(res.headers['x-client'], "['testclient', 0]")
+        self.assertEqual(res.headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual(res.data, b'POST /x y?a=b data')
+
+    def test_raw_client_and_cookies(self):
+        async def run():
+            wr = FakeWriter()
+            await self.app._handle(FakeReader(b'GET /raw/ HTTP/1.1\r\n\r\n'), wr)
+            return wr.data.split(b'\r\n\r\n')[0].split(b'\r\n')
+        # FakeWriter has no peer address
+        lines = a_wait(run())
+        self.assertIn(b'x-client: None', lines)
+        self.assertIn(b'set-cookie: a=1; Expires=Wed, 21 Oct 2037 07:28:00 GMT', lines)
+        self.assertIn(b'set-cookie: b=2', lines)
+
+    def test_grole(self):
+        res = a_wait(self.client.get('/grole/hello?name=mount'))
+        self.assertEqual(res.data, b'Hello, mount')
+        self.assertEqual(res.headers['Content-Length'], '12')
+
+        res = a_wait(self.client.post('/grole/count', data=(b'y' * 1000 for i in range(100)),
+                                      headers={'Content-Length': 100000}))
+        self.assertEqual(res.data, b'100000')
+
+        res = a_wait(self.client.get('/grole/stream'))
+        self.assertEqual(res.data, b'abc')
+
+    def test_broken(self):
+        with self.assertLogs('grole', 'ERROR'):
+            res = a_wait(self.client.get('/broken/'))
+        self.assertEqual(res.code, 500)
+
+if __name__ == '__main__':
+    unittest.main()
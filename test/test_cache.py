@@ -0,0 +1,85 @@
+import unittest
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+import grole
+
+class TestSharedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = grole.SharedCache(slots=64, slot_size=128, ways=4, stripes=4)
+        self.addCleanup(self.cache.close)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.assertTrue(self.cache.set('a', b'1'))
+        self.assertTrue(self.cache.set(b'b', b'2'))
+        self.assertEqual(self.cache.get('a'), b'1')
+        self.assertEqual(self.cache.get('b'), b'2')
+        self.cache.set('a', b'replaced')
+        self.assertEqual(self.cache.get(b'a'), b'replaced')
+        self.assertTrue(self.cache.delete('a'))
+        self.assertFalse(self.cache.delete('a'))
+        self.assertEqual(self.cache.get('a', b'default'), b'default')
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('b'))
+        report = self.cache.report()
+        self.assertEqual(report['hits'], 3)
+        self.assertEqual(report['misses'], 3)
+        self.assertEqual(report['hit_rate'], 0.5)
+
+    def test_ttl(self):
+        self.cache.set('a', b'1', ttl=0.01)
+        self.cache.set('b', b'2', ttl=60)
+        self.assertEqual(self.cache.get('a'), b'1')
+        time.sleep(0.02)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), b'2')
+
+    def test_too_large(self):
+        self.assertFalse(self.cache.set('a', b'x' * 128))
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats['too_large'], 1)
+
+    def test_clock(self):
+        cache = grole.SharedCache(slots=4, ways=4)
+        self.addCleanup(cache.close)
+        for key in 'abcd':
+            cache.set(key, key.encode())
+        cache.get('a')
+        cache.get('c')
+        cache.set('e', b'e') # Evicts b, the first not referenced
+        cache.set('f', b'f') # Evicts d
+        self.assertEqual([cache.get(key) for key in 'abcdef'],
+                         [b'a', None, b'c', None, b'e', b'f'])
+        self.assertEqual(cache.stats['evictions'], 2)
+
+    def test_shared(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'cache')
+        cache = grole.SharedCache(path, slots=64, ways=4)
+        self.addCleanup(cache.close)
+        cache.set('parent', b'1')
+        code = ('import sys, grole; c = grole.SharedCache(sys.argv[1], slots=64, ways=4); '
+                'print(c.get("parent").decode()); c.set("child", b"2")')
+        root = str(pathlib.Path(__file__).parents[1])
+        out = subprocess.check_output([sys.executable, '-c', code, path], cwd=root)
+        self.assertEqual(out.strip(), b'1')
+        self.assertEqual(cache.get('child'), b'2')
+
+        with self.assertRaisesRegex(ValueError, 'different layout'):
+            grole.SharedCache(path, slots=128, ways=4)
+        # Processes must agree on the write locks as well as the table
+        with self.assertRaisesRegex(ValueError, 'different layout'):
+            grole.SharedCache(path, slots=64, ways=4, stripes=32)
+        # The failed opens released their locks
+        other = grole.SharedCache(path, slots=64, ways=4)
+        other.close()
+
+if __name__ == '__main__':
+    unittest.main()
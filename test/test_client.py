@@ -0,0 +1,109 @@
+import unittest
+import asyncio
+from helpers import a_wait
+
+import grole
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        self.app = grole.Grole()
+
+        @self.app.route('/hello')
+        def hello(env, req):
+            return 'Hello, ' + req.query.get('name', 'World')
+
+        @self.app.route('/echo', methods=['POST'])
+        def echo(env, req):
+            return req.json()
+
+        @self.app.route('/upload', methods=['POST'], buffer=False)
+        async def upload(env, req):
+            sizes = []
+            while True:
+                data = await req.read(1000)
+                if not data:
+                    break
+                sizes.append(len(data))
+            return sizes
+
+        @self.app.route('/stream')
+        def stream(env, req):
+            return grole.ResponseStream(str(i) for i in range(5))
+
+        @self.app.route('/slow')
+        async def slow(env, req):
+            await asyncio.sleep(0.01)
+            return 'slow'
+
+        self.client = self.app.test_client()
+        self.addCleanup(lambda: a_wait(self.client.close()))
+
+    def test_get(self):
+        res = a_wait(self.client.get('/hello?name=grole'))
+        self.assertEqual(res.code, 200)
+        self.assertEqual(res.reason, 'OK')
+        self.assertEqual(res.headers['Content-Type'], 'text/html')
+        self.assertEqual(res.text(), 'Hello, grole')
+
+    def test_not_found(self):
+        res = a_wait(self.client.get('/missing'))
+        self.assertEqual(res.code, 404)
+
+    def test_json(self):
+        res = a_wait(self.client.post('/echo', json={'a': [1, 2]}))
+        self.assertEqual(res.json(), {'a': [1, 2]})
+
+    def test_keep_alive(self):
+        async def run():
+            for i in range(100):
+                res = await self.client.get('/hello')
+                self.assertEqual(res.data, b'Hello, World')
+        a_wait(run())
+        self.assertEqual(len(self.client._connections), 1)
+
+    def test_concurrent(self):
+        async def run():
+            return await asyncio.gather(*[self.client.get('/slow') for i in range(10)])
+        for res in a_wait(run()):
+            self.assertEqual(res.data, b'slow')
+        self.assertEqual(len(self.client._connections), 10)
+
+    def test_stream_response(self):
+        async def run():
+            res = await self.client.get('/stream', stream=True)
+            self.assertEqual(res.headers['Transfer-Encoding'], 'chunked')
+            pieces = []
+            while True:
+                try:
+                    pieces.append(await res.__anext__())
+                except StopAsyncIteration:
+                    break
+            return pieces
+        self.assertEqual(a_wait(run()), [b'0', b'1', b'2', b'3', b'4'])
+        a_wait(self.client.get('/hello'))
+        self.assertEqual(len(self.client._connections), 1)
+
+    def test_stream_request(self):
+        res = a_wait(self.client.post('/upload', data=(b'x' * 600 for i in range(5)),
+                                      headers={'Content-Length': 3000}))
+        self.assertEqual(sum(res.json()), 3000)
+        with self.assertRaises(ValueError):
+            a_wait(self.client.post('/upload', data=iter([b'x'])))
+
+    def test_connection(self):
+        async def run():
+            conn = self.client.connection()
+            first = await conn.request('GET', '/hello')
+            second = await conn.request('POST', '/echo', json=[1])
+            task = conn._task
+            await conn.close()
+            return first, second, task, conn
+        first, second, task, conn = a_wait(run())
+        self.assertEqual(first.data, b'Hello, World')
+        self.assertEqual(second.json(), [1])
+        self.assertTrue(task.done())
+        self.assertTrue(conn.closed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,16 @@
 import unittest
+import unittest.mock
+import asyncio
 import pathlib
+import tempfile
+import json
+import gzip
+import email.utils
+import os
+import re
+import time
+import subprocess
+import sys
 from helpers import *
 
 import grole
@@ -31,6 +42,19 @@ class TestGrole(unittest.TestCase):
         data = wr.data.split(b'\r\n\r\n')[1]
         self.assertEqual(b'Hello, World!', data)
 
+    def test_json_backend(self):
+        app = grole.Grole(json_backend='auto')
+
+        @app.route('/')
+        def hello(env, req):
+            return {'foo': 'bar'}
+
+        rd = FakeReader(data=b'GET / HTTP/1.1\r\n\r\n')
+        wr = FakeWriter()
+        a_wait(app._handle(rd, wr))
+        data = wr.data.split(b'\r\n\r\n')[1]
+        self.assertEqual(app.json.loads(data), {'foo': 'bar'})
+
     def test_error(self):
         @self.app.route('/')
         def error(env, req):
@@ -63,6 +87,677 @@ class TestGrole(unittest.TestCase):
         data = wr.data.split(b'\r\n')[0]
         self.assertEqual(b'HTTP/1.1 404 Not Found', data)
 
+class TestShutdown(unittest.TestCase):
+
+    def setUp(self):
+        self.app = grole.Grole()
+
+        @self.app.route(r'/(\d+)')
+        async def sleep(env, req):
+            await asyncio.sleep(float(req.match.group(1)) / 10)
+            return 'done'
+
+    def _shutdown(self, request, timeout):
+        rd = FakeReader(data=request, block=True)
+        wr = FakeWriter()
+        async def run():
+            task = asyncio.ensure_future(self.app._handle(rd, wr))
+            await asyncio.sleep(0.01)
+            await self.app.shutdown(timeout)
+            await asyncio.sleep(0.01)
+            return task
+        task = a_wait(run())
+        self.assertTrue(wr.closed)
+        self.assertTrue(task.done())
+        self.assertEqual(self.app._connections, {})
+        return wr.data
+
+    def test_idle(self):
+        data = self._shutdown(b'', 1)
+        self.assertEqual(data, b'')
+
+    def test_in_flight(self):
+        data = self._shutdown(b'GET /1 HTTP/1.1\r\n\r\n', 1)
+        self.assertIn(b'Connection: close', data)
+        self.assertTrue(data.endswith(b'done'))
+
+    def test_deadline(self):
+        data = self._shutdown(b'GET /100 HTTP/1.1\r\n\r\n', 0.1)
+        self.assertEqual(data, b'')
+
+class TestTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        timeouts = grole.Timeouts(header=0.05, body=0.05, min_body_rate=1000,
+                                  handler=0.05, write=0.05)
+        self.app = grole.Grole(timeouts=timeouts)
+
+        @self.app.route('/', methods=['GET', 'POST'])
+        def hello(env, req):
+            return 'Hello, World!'
+
+        @self.app.route('/slow')
+        async def slow(env, req):
+            await asyncio.sleep(3600)
+
+    def _handle(self, data, wr=None):
+        rd = FakeReader(data=data, block=True)
+        wr = wr or FakeWriter()
+        a_wait(self.app._handle(rd, wr))
+        self.assertTrue(wr.closed)
+        self.assertEqual(self.app._connections, {})
+        return wr.data
+
+    def test_header(self):
+        data = self._handle(b'GET / HTTP/1.1\r\nfoo: ')
+        self.assertEqual(data, b'')
+        self.assertEqual(self.app.metrics['header_timeouts'], 1)
+
+    def test_idle(self):
+        data = self._handle(b'GET / HTTP/1.1\r\n\r\n')
+        self.assertTrue(data.endswith(b'Hello, World!'))
+        self.assertEqual(self.app.metrics['header_timeouts'], 1)
+
+    def test_body(self):
+        data = self._handle(b'POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\nfoo')
+        self.assertTrue(data.startswith(b'HTTP/1.1 408 Request Timeout'))
+        self.assertIn(b'Connection: close', data)
+        self.assertEqual(self.app.metrics['body_timeouts'], 1)
+
+    def test_body_rate(self):
+        self.app.timeouts.body = None
+        req = grole.Request()
+        req.headers = {'Content-Length': '500'}
+        self.assertAlmostEqual(self.app._body_timeout(req), 0.5)
+
+    def test_body_rate_without_body(self):
+        self.app.timeouts.body = None
+        req = grole.Request()
+        req.headers = {}
+        self.assertIsNone(self.app._body_timeout(req))
+        data = self._handle(b'GET / HTTP/1.1\r\n\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.1 200 OK'))
+        self.assertEqual(self.app.metrics['body_timeouts'], 0)
+
+    def test_handler(self):
+        data = self._handle(b'GET /slow HTTP/1.1\r\n\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.1 504 Gateway Timeout'))
+        self.assertEqual(self.app.metrics['handler_timeouts'], 1)
+
+    def test_write(self):
+        self._handle(b'GET / HTTP/1.1\r\n\r\n', SlowWriter())
+        self.assertEqual(self.app.metrics['write_timeouts'], 1)
+
+class TestLimits(unittest.TestCase):
+
+    def setUp(self):
+        limits = grole.Limits(read_limit=1024, max_header_size=200, max_headers=3,
+                              write_limits=(4096, 1024))
+        self.app = grole.Grole(limits=limits)
+
+        @self.app.route('/')
+        def hello(env, req):
+            return 'Hello, World!'
+
+        @self.app.route('/wait')
+        async def wait(env, req):
+            await self.release.wait()
+            return 'done'
+
+    def _handle(self, data):
+        wr = FakeWriter()
+        a_wait(self.app._handle(FakeReader(data=data), wr))
+        return wr.data
+
+    def test_header_count(self):
+        self.assertIn(b'Hello', self._handle(b'GET / HTTP/1.1\r\na: 1\r\nb: 2\r\nc: 3\r\n\r\n'))
+        data = self._handle(b'GET / HTTP/1.1\r\na: 1\r\nb: 2\r\nc: 3\r\nd: 4\r\n\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.1 431 Request Header Fields Too Large'))
+        self.assertIn(b'Connection: close', data)
+        self.assertEqual(self.app.metrics['headers_too_large'], 1)
+        self.assertEqual(self.app._connections, {})
+
+    def test_header_size(self):
+        data = self._handle(b'GET / HTTP/1.1\r\na: ' + b'x' * 200 + b'\r\n\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.1 431 Request Header Fields Too Large'))
+        data = self._handle(b'GET /' + b'x' * 200 + b' HTTP/1.1\r\n\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.1 414 URI Too Long'))
+
+    def test_socket(self):
+        self.app.limits.max_header_size = None
+        listener = grole.Listener('127.0.0.1', 0)
+        async def run():
+            self.release = asyncio.Event()
+            server = await listener._start(self.app._handle, self.app.limits.read_limit)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                # A line over the reader's limit
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(b'GET / HTTP/1.1\r\na: ' + b'x' * 2000 + b'\r\n\r\n')
+                long_line = await reader.read()
+                writer.close()
+
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(b'GET /wait HTTP/1.1\r\n\r\n')
+                await asyncio.sleep(0.05)
+                conn = list(self.app._connections.values())[0]
+                limits = conn.writer.transport.get_write_buffer_limits()
+                report = self.app.connection_report()
+                self.release.set()
+                await reader.readuntil(b'done')
+                writer.close()
+                await asyncio.sleep(0.01)
+                return long_line, limits, report
+            finally:
+                await listener._close()
+        long_line, limits, report = a_wait(run())
+        self.assertTrue(long_line.startswith(b'HTTP/1.1 431 Request Header Fields Too Large'))
+        self.assertEqual(limits, (1024, 4096))
+        self.assertEqual(report['connections'], 1)
+        self.assertEqual(report['busy'], 1)
+        self.assertEqual(report['per_connection'][0]['read'], 0)
+        self.assertEqual(report['write'], 0)
+
+    def test_serve_connections(self):
+        grole.serve_connections(self.app, '/connections', 'secret')
+        data = self._handle(b'GET /connections HTTP/1.1\r\n\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.1 403 Forbidden'))
+        data = self._handle(b'GET /connections?token=wrong HTTP/1.1\r\n\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.1 403 Forbidden'))
+        data = self._handle(b'GET /connections HTTP/1.1\r\nAuthorization: Bearer secret\r\n\r\n')
+        self.assertEqual(json.loads(data.split(b'\r\n\r\n', 1)[1].decode())['busy'], 1)
+
+class TestLag(unittest.TestCase):
+
+    def setUp(self):
+        self.app = grole.Grole(lag_threshold=0.05)
+
+        @self.app.route('/block')
+        def block(env, req):
+            time.sleep(0.3)
+            return 'done'
+
+        grole.serve_lag(self.app, '/lag', 'secret')
+
+    def _get(self, path):
+        rd = FakeReader(data=b'GET ' + path + b' HTTP/1.1\r\n\r\n')
+        wr = FakeWriter()
+        a_wait(self.app._handle(rd, wr))
+        return wr.data.split(b'\r\n\r\n', 1)[1]
+
+    def test_blocked(self):
+        monitor = self.app.lag_monitor
+        async def block():
+            monitor.start()
+            await asyncio.sleep(0.1)
+            await self.app._handle(FakeReader(b'GET /block HTTP/1.1\r\n\r\n'), FakeWriter())
+            await asyncio.sleep(0.1)
+            monitor.stop()
+        a_wait(block())
+        self.assertEqual(list(monitor.offenders), ['GET /block (route /block)'])
+        self.assertIn('time.sleep', monitor.samples[0]['stack'])
+        self.assertGreater(monitor.max_lag, 0.2)
+
+        report = json.loads(self._get(b'/lag?token=secret').decode())
+        self.assertEqual(report['offenders'], {'GET /block (route /block)': 1})
+        self.assertEqual(sum(count for bound, count in report['histogram']), sum(monitor.histogram.values()))
+
+    def test_token(self):
+        rd = FakeReader(data=b'GET /lag HTTP/1.1\r\n\r\n')
+        wr = FakeWriter()
+        a_wait(self.app._handle(rd, wr))
+        self.assertTrue(wr.data.startswith(b'HTTP/1.1 403 Forbidden'))
+        self.assertNotIn(b'offenders', wr.data)
+
+    def test_handler_task(self):
+        app = grole.Grole(lag_threshold=0.05, timeouts=grole.Timeouts(handler=5))
+
+        @app.route('/block')
+        async def block(env, req):
+            time.sleep(0.3)
+            return 'done'
+
+        monitor = app.lag_monitor
+        async def run():
+            monitor.start()
+            await asyncio.sleep(0.1)
+            await app._handle(FakeReader(b'GET /block HTTP/1.1\r\n\r\n'), FakeWriter())
+            await asyncio.sleep(0.1)
+            monitor.stop()
+        a_wait(run())
+        self.assertEqual(list(monitor.offenders), ['GET /block (route /block)'])
+
+    def test_disabled(self):
+        app = grole.Grole()
+        grole.serve_lag(app, '/lag', 'secret')
+        rd = FakeReader(data=b'GET /lag HTTP/1.1\r\nAuthorization: Bearer secret\r\n\r\n')
+        wr = FakeWriter()
+        a_wait(app._handle(rd, wr))
+        self.assertTrue(wr.data.startswith(b'HTTP/1.1 404 Not Found'))
+
+class TestTiming(unittest.TestCase):
+
+    def setUp(self):
+        self.app = grole.Grole(timing=True, profile_every=2)
+
+        @self.app.route('/')
+        def hello(env, req):
+            return {'hello': 'world'}
+
+        grole.serve_profile(self.app, '/profile', 'secret')
+
+    def _get(self, location, headers=b''):
+        rd = FakeReader(data=b'GET ' + location + b' HTTP/1.1\r\n' + headers + b'\r\n')
+        wr = FakeWriter()
+        a_wait(self.app._handle(rd, wr))
+        return wr.data
+
+    def test_server_timing(self):
+        data = self._get(b'/')
+        header = re.search(rb'Server-Timing: (.*)\r\n', data).group(1)
+        phases = [p.split(b';')[0] for p in header.split(b', ')]
+        self.assertEqual(phases, [b'parse', b'dispatch', b'body', b'handler', b'serialize'])
+        self.assertEqual(list(self.app.timings['/']),
+                         ['parse', 'dispatch', 'body', 'handler', 'serialize', 'write'])
+        self.assertEqual(self.app.timings['/']['write'][0], 1)
+
+    def test_disabled(self):
+        self.app.timing = False
+        self.assertNotIn(b'Server-Timing', self._get(b'/'))
+        self.assertEqual(self.app.timings, {})
+
+    def test_profile(self):
+        for i in range(4):
+            self._get(b'/')
+        self.assertEqual(self.app.profile_stats.requests, 2)
+        self.assertTrue(self._get(b'/profile').startswith(b'HTTP/1.1 403 Forbidden'))
+        data = self._get(b'/profile', b'Authorization: Bearer secret\r\n')
+        self.assertIn(b'Route timings', data)
+        self.assertIn(b'Profile of 2 sampled requests', data)
+        self.assertIn(b'hello', data)
+        data = self._get(b'/profile?token=secret')
+        self.assertTrue(data.startswith(b'HTTP/1.1 200 OK'))
+
+class TestRateLimit(unittest.TestCase):
+
+    def test_bucket(self):
+        limit = grole.RateLimit(1, burst=2)
+        self.assertEqual(limit.check('a', now=0), 0)
+        self.assertEqual(limit.check('a', now=0), 0)
+        self.assertAlmostEqual(limit.check('a', now=0.5), 0.5)
+        self.assertEqual(limit.check('a', now=1.5), 0)
+        self.assertEqual(limit.check('b', now=1.5), 0)
+
+    def test_table(self):
+        limit = grole.RateLimit(1, burst=2, max_clients=2)
+        for key in 'abc':
+            limit.check(key, now=0)
+        self.assertEqual(list(limit._buckets), ['b', 'c'])
+        limit.check('b', now=1)
+        limit.check('d', now=2.5) # c has refilled, so is dropped
+        self.assertEqual(list(limit._buckets), ['b', 'd'])
+
+    def _app(self, **kwargs):
+        app = grole.Grole(**kwargs)
+
+        @app.route('/', methods=['GET', 'POST'])
+        def index(env, req):
+            return 'index'
+
+        @app.route('/limited', rate_limit=grole.RateLimit(1, burst=1))
+        def limited(env, req):
+            return 'limited'
+
+        client = app.test_client()
+        self.addCleanup(lambda: a_wait(client.close()))
+        return app, client
+
+    def test_global(self):
+        app, client = self._app(rate_limit=grole.RateLimit(0.5, burst=2))
+        codes = [a_wait(client.get('/')).code for i in range(3)]
+        self.assertEqual(codes, [200, 200, 429])
+        res = a_wait(client.get('/'))
+        self.assertEqual(res.reason, 'Too Many Requests')
+        self.assertEqual(res.headers['Retry-After'], '2')
+        self.assertEqual(app.metrics['rate_limited'], 2)
+
+    def test_route(self):
+        app, client = self._app()
+        codes = [a_wait(client.get('/limited')).code for i in range(2)]
+        self.assertEqual(codes, [200, 429])
+        self.assertEqual(a_wait(client.get('/')).code, 200)
+
+    def test_key(self):
+        limit = grole.RateLimit(1, burst=1, key=lambda req: req.headers.get('X-Client'))
+        app, client = self._app(rate_limit=limit)
+        for name in ['a', 'b', 'c']:
+            self.assertEqual(a_wait(client.get('/', headers={'X-Client': name})).code, 200)
+        self.assertEqual(a_wait(client.get('/', headers={'X-Client': 'a'})).code, 429)
+
+    def test_body(self):
+        app, client = self._app(rate_limit=grole.RateLimit(1, burst=0))
+        rd = FakeReader(data=b'POST / HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc')
+        wr = FakeWriter()
+        a_wait(app._handle(rd, wr))
+        self.assertTrue(wr.data.startswith(b'HTTP/1.1 429 Too Many Requests\r\n'))
+        self.assertIn(b'\r\nConnection: close\r\n', wr.data)
+        self.assertTrue(wr.closed)
+
+    def test_fair(self):
+        order = []
+        app = grole.Grole(fair_queue=1, client_key=lambda req: req.headers['X-Client'])
+
+        @app.route('/')
+        async def index(env, req):
+            order.append(req.headers['X-Client'])
+            await asyncio.sleep(0.001)
+
+        async def run():
+            async with app.test_client() as client:
+                requests = [client.get('/', headers={'X-Client': 'a'}) for i in range(4)]
+                requests += [client.get('/', headers={'X-Client': 'b'}) for i in range(2)]
+                await asyncio.gather(*requests)
+        a_wait(run())
+        self.assertEqual(order, ['a', 'a', 'b', 'a', 'b', 'a'])
+
+class TestEarlyReject(unittest.TestCase):
+
+    def setUp(self):
+        self.app = grole.Grole(limits=grole.Limits(max_body_size=1000))
+
+        def owner_only(env, req):
+            if req.headers.get('X-User') != 'owner':
+                return grole.Response(code=403, reason='Forbidden')
+
+        async def not_full(env, req):
+            if env.get('full'):
+                raise grole.HTTPError(507, 'Insufficient Storage')
+
+        @self.app.route('/upload', methods=['POST'], validate=owner_only)
+        def upload(env, req):
+            return len(req.data)
+
+        @self.app.route('/async', methods=['POST'], validate=not_full)
+        def upload_async(env, req):
+            return len(req.data)
+
+        def moved(env, req):
+            return grole.Response(code=307, reason='Temporary Redirect',
+                                  headers={'Location': '/upload'})
+
+        @self.app.route('/moved', methods=['POST'], validate=moved)
+        def not_called(env, req):
+            return 'not called'
+
+    def _post(self, path, headers=b'', body=b'x' * 100):
+        request = (b'POST ' + path + b' HTTP/1.1\r\nContent-Length: ' + str(len(body)).encode() +
+                   b'\r\n' + headers + b'\r\n')
+        rd = FakeReader(data=request + body)
+        wr = FakeWriter()
+        a_wait(self.app._handle(rd, wr))
+        return wr, rd.io.tell() - len(request)
+
+    def test_accept(self):
+        wr, read = self._post(b'/upload', b'X-User: owner\r\n')
+        self.assertTrue(wr.data.startswith(b'HTTP/1.1 200 OK'))
+        self.assertEqual(read, 100)
+
+    def test_not_found(self):
+        wr, read = self._post(b'/missing')
+        self.assertTrue(wr.data.startswith(b'HTTP/1.1 404 Not Found'))
+        self.assertEqual(read, 0)
+        self.assertTrue(wr.closed)
+
+    def test_validate(self):
+        wr, read = self._post(b'/upload', b'Expect: 100-continue\r\n')
+        self.assertTrue(wr.data.startswith(b'HTTP/1.1 403 Forbidden'))
+        self.assertEqual(read, 0)
+
+        self.app.env['full'] = True
+        wr, read = self._post(b'/async')
+        self.assertTrue(wr.data.startswith(b'HTTP/1.1 507 Insufficient Storage'))
+        self.assertEqual(read, 0)
+
+    def test_validate_without_continue(self):
+        # The body isn't sent until the client is told to continue
+        rd = FakeReader(data=b'POST /moved HTTP/1.1\r\nContent-Length: 10\r\n'
+                             b'Expect: 100-continue\r\n\r\n', block=True)
+        wr = FakeWriter()
+        a_wait(asyncio.wait_for(self.app._handle(rd, wr), 1))
+        self.assertTrue(wr.data.startswith(b'HTTP/1.1 307 Temporary Redirect'))
+        self.assertNotIn(b'100 Continue', wr.data)
+        self.assertIn(b'Connection: close', wr.data)
+        self.assertTrue(wr.closed)
+
+    def test_too_large(self):
+        wr, read = self._post(b'/upload', b'X-User: owner\r\nExpect: 100-continue\r\n', b'x' * 1001)
+        self.assertTrue(wr.data.startswith(b'HTTP/1.1 413 Payload Too Large'))
+        self.assertEqual(read, 0)
+        self.assertEqual(self.app.metrics['body_too_large'], 1)
+
+    def test_continue(self):
+        wr, read = self._post(b'/upload', b'X-User: owner\r\nExpect: 100-continue\r\n')
+        self.assertTrue(wr.data.startswith(b'HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 200 OK'))
+        self.assertEqual(read, 100)
+
+        client = self.app.test_client()
+        res = a_wait(client.post('/upload', data=b'abc',
+                                 headers={'X-User': 'owner', 'Expect': '100-continue'}))
+        a_wait(client.close())
+        self.assertEqual(res.code, 200)
+        self.assertEqual(res.json(), 3)
+
+class TestHeadOptions(unittest.TestCase):
+
+    def setUp(self):
+        self.app = grole.Grole()
+        self.calls = 0
+
+        @self.app.route('/text', methods=['GET', 'POST'])
+        def text(env, req):
+            self.calls += 1
+            return 'Hello, World!'
+
+        @self.app.route('/json')
+        def obj(env, req):
+            return {'not': object()} # Fails if encoded
+
+        @self.app.route('/explicit', methods=['HEAD'])
+        def explicit(env, req):
+            return 'never sent'
+
+        grole.serve_static(self.app, '/static', str(pathlib.Path(__file__).parents[0]))
+
+    def _request(self, request):
+        wr = FakeWriter()
+        a_wait(self.app._handle(FakeReader(data=request), wr))
+        head, body = wr.data.split(b'\r\n\r\n', 1)
+        return head.decode(), body
+
+    def test_head(self):
+        head, body = self._request(b'HEAD /text HTTP/1.1\r\n\r\n')
+        self.assertTrue(head.startswith('HTTP/1.1 200 OK'))
+        self.assertIn('Content-Length: 13', head)
+        self.assertEqual(body, b'')
+        self.assertEqual(self.calls, 1)
+
+    def test_head_explicit(self):
+        head, body = self._request(b'HEAD /explicit HTTP/1.1\r\n\r\n')
+        self.assertIn('Content-Length: 10', head)
+        self.assertEqual(body, b'')
+
+    def test_head_file(self):
+        with unittest.mock.patch('grole._open_file', side_effect=AssertionError('opened')):
+            head, body = self._request(b'HEAD /static/test.dat HTTP/1.1\r\n\r\n')
+        self.assertTrue(head.startswith('HTTP/1.1 200 OK'))
+        self.assertIn('Content-Length: 4', head)
+        self.assertNotIn('Transfer-Encoding', head)
+        self.assertEqual(body, b'')
+
+    def test_head_json(self):
+        head, body = self._request(b'HEAD /json HTTP/1.1\r\n\r\n')
+        self.assertTrue(head.startswith('HTTP/1.1 200 OK'))
+        self.assertIn('Content-Type: application/json', head)
+        self.assertNotIn('Transfer-Encoding', head)
+        self.assertEqual(body, b'')
+
+    def test_head_missing(self):
+        head, _ = self._request(b'HEAD /missing HTTP/1.1\r\n\r\n')
+        self.assertTrue(head.startswith('HTTP/1.1 404'))
+
+    def test_options(self):
+        head, body = self._request(b'OPTIONS /text HTTP/1.1\r\n\r\n')
+        self.assertTrue(head.startswith('HTTP/1.1 200 OK'))
+        self.assertIn('Allow: GET, HEAD, OPTIONS, POST', head)
+        self.assertEqual(body, b'')
+        self.assertEqual(self.calls, 0)
+
+        head, _ = self._request(b'OPTIONS /explicit HTTP/1.1\r\n\r\n')
+        self.assertIn('Allow: HEAD, OPTIONS\r\n', head + '\r\n')
+
+        head, _ = self._request(b'OPTIONS * HTTP/1.1\r\n\r\n')
+        self.assertIn('Allow: GET, HEAD, OPTIONS, POST', head)
+
+        head, _ = self._request(b'OPTIONS /missing HTTP/1.1\r\n\r\n')
+        self.assertTrue(head.startswith('HTTP/1.1 404'))
+
+class TestConstant(unittest.TestCase):
+
+    def setUp(self):
+        self.app = grole.Grole()
+        self.calls = 0
+
+        @self.app.route('/version', constant=True)
+        def version(env, req):
+            self.calls += 1
+            return {'version': self.calls}
+
+        @self.app.route('/stream', constant=True)
+        def stream(env, req):
+            self.calls += 1
+            return grole.ResponseStream(['a'])
+
+    def _request(self, request):
+        wr = FakeWriter()
+        writes = []
+        write = wr.write
+        wr.write = lambda data: writes.append(data) or write(data)
+        a_wait(self.app._handle(FakeReader(data=request), wr))
+        return wr.data, writes
+
+    def test_constant(self):
+        first, _ = self._request(b'GET /version HTTP/1.1\r\n\r\n')
+        second, writes = self._request(b'GET /version HTTP/1.1\r\n\r\n')
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(second.endswith(b'\r\n\r\n{"version": 1}'))
+
+        self.app.invalidate('/version')
+        third, _ = self._request(b'GET /version HTTP/1.1\r\n\r\n')
+        self.assertEqual(self.calls, 2)
+        self.assertTrue(third.endswith(b'{"version": 2}'))
+
+    def test_keep_alive(self):
+        request = b'GET /version HTTP/1.1\r\n\r\n'
+        data, writes = self._request(request * 2 + b'HEAD /version HTTP/1.1\r\n\r\n')
+        self.assertEqual(self.calls, 1)
+        # Handler response as head then body, then one write per request
+        self.assertEqual(len(writes), 4)
+        self.assertEqual(writes[0] + writes[1], writes[2])
+        self.assertEqual(writes[3], writes[0])
+
+    def test_not_kept(self):
+        self._request(b'GET /stream HTTP/1.1\r\n\r\n')
+        data, _ = self._request(b'GET /stream HTTP/1.1\r\n\r\n')
+        self.assertEqual(self.calls, 2)
+        self.assertIn(b'Transfer-Encoding: chunked', data)
+
+    def test_static_response(self):
+        self.app.static_response('/robots.txt', 'User-agent: *', {'Cache-Control': 'max-age=60'})
+        data, writes = self._request(b'GET /robots.txt HTTP/1.1\r\n\r\n')
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(data.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'Cache-Control: max-age=60', data)
+        self.assertTrue(data.endswith(b'\r\n\r\nUser-agent: *'))
+
+        data, _ = self._request(b'GET /robotsxtxt HTTP/1.1\r\n\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.1 404'))
+
+        self.app.static_response('/robots.txt', b'Disallow: /')
+        self.app.invalidate()
+        data, _ = self._request(b'GET /robots.txt HTTP/1.1\r\n\r\n')
+        self.assertTrue(data.endswith(b'\r\n\r\nDisallow: /'))
+        self.assertNotIn(b'Cache-Control', data)
+        self.assertEqual(len(self.app._handlers['GET']), 3)
+
+        with self.assertRaises(ValueError):
+            self.app.static_response('/stream2', grole.ResponseStream(['a']))
+
+    def test_static_before_routes(self):
+        @self.app.route('/.*')
+        def catch_all(env, req):
+            return 'catch all'
+
+        self.app.static_response('/robots.txt', 'User-agent: *')
+        for method in [b'GET', b'HEAD']:
+            data, _ = self._request(method + b' /robots.txt HTTP/1.1\r\n\r\n')
+            self.assertIn(b'Content-Length: 13', data)
+            self.assertNotIn(b'catch all', data)
+        data, _ = self._request(b'GET /other HTTP/1.1\r\n\r\n')
+        self.assertTrue(data.endswith(b'catch all'))
+
+    def test_no_continue(self):
+        self.app.static_response('/ok', 'ok')
+        self.app._handlers['POST'] = self.app._handlers['GET']
+        # The body is held back, the response is sent without waiting for it
+        rd = FakeReader(data=b'POST /ok HTTP/1.1\r\nContent-Length: 10\r\n'
+                             b'Expect: 100-continue\r\n\r\n', block=True)
+        wr = FakeWriter()
+        a_wait(asyncio.wait_for(self.app._handle(rd, wr), 1))
+        self.assertNotIn(b'100 Continue', wr.data)
+        self.assertTrue(wr.data.startswith(b'HTTP/1.1 200 OK'))
+        self.assertTrue(wr.closed)
+
+    def test_body_discarded(self):
+        self.app.static_response('/ok', 'ok', code=202, reason='Accepted')
+        self.app._handlers['POST'] = self.app._handlers['GET']
+        data, _ = self._request(b'POST /ok HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc'
+                                b'GET /ok HTTP/1.1\r\n\r\n')
+        self.assertEqual(data.count(b'HTTP/1.1 202 Accepted'), 2)
+
+class TestStartup(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        code = 'import sys, grole; print(" ".join(sorted(sys.modules)))'
+        root = str(pathlib.Path(__file__).parents[1])
+        modules = subprocess.check_output([sys.executable, '-c', code], cwd=root).decode().split()
+        for module in ['argparse', 'mimetypes', 'pathlib', 'html', 'cProfile', 'pstats',
+                       'json', 'tempfile']:
+            self.assertNotIn(module, modules)
+
+    def test_warmup(self):
+        app = grole.Grole()
+        called = []
+
+        @app.route('/(.*)', methods=['GET', 'POST'])
+        def catch_all(env, req):
+            called.append(req)
+
+        a_wait(app.warmup())
+        self.assertEqual(called, [])
+        self.assertEqual(app._connections, {})
+        self.assertFalse(app._logger.disabled)
+
+    def test_warmup_not_counted(self):
+        limit = grole.RateLimit(10)
+        app = grole.Grole(timing=True, rate_limit=limit)
+        a_wait(app.warmup())
+        self.assertEqual(app.metrics, {})
+        self.assertEqual(dict(app.timings), {})
+        self.assertEqual(len(limit._buckets), 0)
+        self.assertIs(app.rate_limit, limit)
+
 class TestStatic(unittest.TestCase):
 
     def setUp(self):
@@ -95,6 +790,50 @@ class TestStatic(unittest.TestCase):
         data = wr.data.split(b'\r\n')[0]
         self.assertEqual(b'HTTP/1.1 200 OK', data)
 
+    def _get(self, location):
+        rd = FakeReader(data=b'GET ' + location + b' HTTP/1.1\r\n\r\n')
+        wr = FakeWriter()
+        a_wait(self.app._handle(rd, wr))
+        return wr.data
+
+    def _listing(self, n, **kwargs):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for i in range(n):
+            pathlib.Path(tmp.name, 'f{:02}'.format(i)).touch()
+        pathlib.Path(tmp.name, 'sub').mkdir()
+        grole.serve_static(self.app, '', tmp.name, index=True, **kwargs)
+        return tmp.name
+
+    def test_index_sorted(self):
+        self._listing(3)
+        data = self._get(b'/')
+        self.assertIn(b'Transfer-Encoding: chunked', data)
+        names = re.findall(rb'href="([^"]+)"', data)
+        self.assertEqual(names, [b'f00', b'f01', b'f02', b'sub/'])
+
+    def test_index_json(self):
+        self._listing(3, page_size=2)
+        data = self._get(b'/?format=json&page=2').split(b'\r\n\r\n', 1)[1]
+        listing = json.loads(data.decode())
+        self.assertEqual(listing['page'], 2)
+        self.assertEqual(listing['pages'], 2)
+        self.assertEqual(listing['entries'], [{'name': 'f02', 'dir': False},
+                                              {'name': 'sub', 'dir': True}])
+
+    def test_index_paged(self):
+        self._listing(5, page_size=2)
+        data = self._get(b'/?page=2')
+        names = re.findall(rb'href="([^"]+)"', data)
+        self.assertEqual(names, [b'?page=1', b'f02', b'f03', b'?page=3'])
+
+    def test_index_cache_invalidated(self):
+        path = self._listing(1)
+        self.assertNotIn(b'new', self._get(b'/'))
+        os.utime(path, ns=(0, 0)) # Make sure mtime changes
+        pathlib.Path(path, 'new').touch()
+        self.assertIn(b'new', self._get(b'/'))
+
     def test_notfound(self):
         testfolder = str(pathlib.Path(__file__).parents[0])
         grole.serve_static(self.app, '', testfolder, index=False)
@@ -104,6 +843,262 @@ class TestStatic(unittest.TestCase):
         data = wr.data.split(b'\r\n')[0]
         self.assertEqual(b'HTTP/1.1 404 Not Found', data)
 
+class TestStaticPack(unittest.TestCase):
+
+    def setUp(self):
+        self.app = grole.Grole()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        pathlib.Path(tmp.name, 'site', 'sub').mkdir(parents=True)
+        pathlib.Path(tmp.name, 'site', 'index.html').write_bytes(b'<p>home</p>')
+        pathlib.Path(tmp.name, 'site', 'sub', 'app.js').write_bytes(b'var x = 1;\n' * 100)
+        self.pack = os.path.join(tmp.name, 'site.pack')
+        self.assertEqual(grole.pack(os.path.join(tmp.name, 'site'), self.pack), 2)
+        grole.serve_static(self.app, '/static', self.pack)
+
+    def _get(self, location, headers=b''):
+        rd = FakeReader(data=b'GET ' + location + b' HTTP/1.1\r\n' + headers + b'\r\n')
+        wr = FakeWriter()
+        a_wait(self.app._handle(rd, wr))
+        return wr.data.split(b'\r\n\r\n', 1)
+
+    def test_file(self):
+        head, body = self._get(b'/static/sub/app.js')
+        self.assertTrue(head.startswith(b'HTTP/1.1 200 OK'))
+        self.assertRegex(head, rb'Content-Type: (application|text)/javascript')
+        self.assertIn(b'Vary: Accept-Encoding', head)
+        self.assertNotIn(b'Content-Encoding', head)
+        self.assertEqual(body, b'var x = 1;\n' * 100)
+
+    def test_gzip(self):
+        head, body = self._get(b'/static/sub/app.js', b'Accept-Encoding: br, gzip\r\n')
+        self.assertIn(b'Content-Encoding: gzip', head)
+        self.assertEqual(gzip.decompress(body), b'var x = 1;\n' * 100)
+        head, body = self._get(b'/static/sub/app.js', b'Accept-Encoding: gzip;q=0\r\n')
+        self.assertNotIn(b'Content-Encoding', head)
+
+    def test_index(self):
+        head, body = self._get(b'/static/')
+        self.assertIn(b'Content-Type: text/html', head)
+        self.assertNotIn(b'Vary', head) # Too small to compress
+        self.assertEqual(body, b'<p>home</p>')
+
+    def test_not_modified(self):
+        head, _ = self._get(b'/static/index.html')
+        etag = re.search(rb'ETag: ("[^"]+")', head).group(1)
+        head, body = self._get(b'/static/index.html', b'If-None-Match: "x", ' + etag + b'\r\n')
+        self.assertTrue(head.startswith(b'HTTP/1.1 304 Not Modified'))
+        self.assertEqual(body, b'')
+
+    def test_notfound(self):
+        head, _ = self._get(b'/static/missing')
+        self.assertTrue(head.startswith(b'HTTP/1.1 404 Not Found'))
+
+    def test_bad_pack(self):
+        with self.assertRaises(ValueError):
+            grole.StaticPack(__file__)
+
+class TestCachePolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.app = grole.Grole()
+        self.calls = 0
+
+        @self.app.route('/page', cache=grole.CachePolicy(max_age=60, public=True, vary=['Cookie']))
+        def page(env, req):
+            return 'page'
+
+        @self.app.route('/own', cache=grole.CachePolicy(max_age=60))
+        def own(env, req):
+            return grole.Response('own', headers={'Cache-Control': 'no-store', 'Content-Encoding': 'gzip'})
+
+        @self.app.route('/count', cache=grole.CachePolicy(max_age=0.05, stale_while_revalidate=60,
+                                                          vary=['Accept-Language'], server=True))
+        async def count(env, req):
+            self.calls += 1
+            return {'calls': self.calls, 'lang': req.headers.get('Accept-Language')}
+
+        self.client = self.app.test_client()
+        self.addCleanup(lambda: a_wait(self.client.close()))
+
+    def test_headers(self):
+        res = a_wait(self.client.get('/page'))
+        self.assertEqual(res.headers['Cache-Control'], 'public, max-age=60')
+        self.assertEqual(res.headers['Vary'], 'Cookie')
+        expires = email.utils.parsedate_to_datetime(res.headers['Expires']).timestamp()
+        self.assertAlmostEqual(expires, time.time() + 60, delta=2)
+        res = a_wait(self.client.get('/missing'))
+        self.assertNotIn('Cache-Control', res.headers)
+
+    def test_handler_headers(self):
+        res = a_wait(self.client.get('/own'))
+        self.assertEqual(res.headers['Cache-Control'], 'no-store')
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        self.assertIn('Expires', res.headers)
+
+    def test_directives(self):
+        policy = grole.CachePolicy(max_age=31536000, s_maxage=600, immutable=True,
+                                   stale_while_revalidate=30, stale_if_error=3600)
+        self.assertEqual(policy.cache_control, 'max-age=31536000, s-maxage=600, '
+                         'stale-while-revalidate=30, stale-if-error=3600, immutable')
+        self.assertEqual(grole.CachePolicy(private=True, no_cache=True).cache_control,
+                         'private, no-cache')
+
+    def test_static_patterns(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        pathlib.Path(tmp.name, 'index.html').write_bytes(b'<p>home</p>')
+        pathlib.Path(tmp.name, 'app.0123abcd.js').write_bytes(b'var x = 1;\n' * 100)
+        pack = os.path.join(tmp.name, 'site.pack')
+        grole.pack(tmp.name, pack)
+        grole.serve_static(self.app, '/static', pack)
+        self.app.cache_policy(r'/static/.*\.[0-9a-f]{8}\.js',
+                              grole.CachePolicy(max_age=31536000, public=True, immutable=True,
+                                                vary=['accept-encoding', 'Origin']))
+        self.app.cache_policy(r'/static/.*', grole.CachePolicy(no_cache=True))
+
+        res = a_wait(self.client.get('/static/app.0123abcd.js', headers={'Accept-Encoding': 'gzip'}))
+        self.assertEqual(res.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding, Origin')
+        res = a_wait(self.client.get('/static/app.0123abcd.js',
+                                     headers={'If-None-Match': res.headers['ETag'],
+                                              'Accept-Encoding': 'gzip'}))
+        self.assertEqual(res.code, 304)
+        self.assertIn('immutable', res.headers['Cache-Control'])
+
+        res = a_wait(self.client.get('/static/'))
+        self.assertEqual(res.headers['Cache-Control'], 'no-cache')
+        self.assertNotIn('Expires', res.headers)
+
+    def test_stale_while_revalidate(self):
+        async def run():
+            first = await self.client.get('/count')
+            hit = await self.client.get('/count')
+            await asyncio.sleep(0.06)
+            stale = await self.client.get('/count')
+            await asyncio.sleep(0.01) # Let the refresh finish
+            fresh = await self.client.get('/count')
+            other = await self.client.get('/count', headers={'Accept-Language': 'fr'})
+            return first, hit, stale, fresh, other
+        first, hit, stale, fresh, other = a_wait(run())
+        self.assertEqual(first.json()['calls'], 1)
+        self.assertEqual(hit.json()['calls'], 1)
+        self.assertEqual(hit.headers['Age'], '0')
+        self.assertEqual(stale.json()['calls'], 1)
+        self.assertEqual(fresh.json()['calls'], 2)
+        self.assertEqual(other.json(), {'calls': 3, 'lang': 'fr'})
+        self.assertEqual(hit.headers['Cache-Control'], 'max-age=0, stale-while-revalidate=60')
+        self.assertEqual(hit.headers['Vary'], 'Accept-Language')
+        self.assertEqual(self.app.metrics['cache_hits'], 2)
+        self.assertEqual(self.app.metrics['cache_stale'], 1)
+        self.assertEqual(self.app.metrics['cache_misses'], 2)
+
+    def test_refresh_request(self):
+        requests = []
+
+        @self.app.route('/req', methods=['GET', 'HEAD'],
+                        cache=grole.CachePolicy(max_age=0, stale_while_revalidate=60, server=True))
+        def req(env, req):
+            requests.append(req)
+            return 'req'
+
+        async def run():
+            await self.client.get('/req?a=1')
+            await self.client.request('HEAD', '/req?a=1')
+            await asyncio.sleep(0.01)
+        a_wait(run())
+        self.assertEqual(len(requests), 2)
+        stale, refresh = requests
+        self.assertIsNot(stale, refresh)
+        self.assertEqual((refresh.method, refresh.location, refresh.query), ('GET', '/req?a=1', {'a': '1'}))
+
+    def test_not_shared(self):
+        self.app.route('/private', cache=grole.CachePolicy(max_age=60, private=True, server=True))(
+            lambda env, req: str(time.perf_counter()))
+        async def run():
+            private = [(await self.client.get('/private')).data for _ in range(2)]
+            cookie = [(await self.client.get('/count', headers={'Cookie': 'user=' + str(i)})).json()
+                      for i in range(2)]
+            auth = await self.client.get('/count', headers={'authorization': 'Basic x'})
+            return private, cookie, auth.json()
+        private, cookie, auth = a_wait(run())
+        self.assertNotEqual(private[0], private[1])
+        self.assertEqual([c['calls'] for c in cookie], [1, 2])
+        self.assertEqual(auth['calls'], 3)
+        self.assertEqual(self.app.metrics['cache_misses'], 0)
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.app = grole.Grole(fair_queue=1)
+
+        @self.app.route('/user/(\\d+)')
+        async def user(env, req):
+            await asyncio.sleep(0.01 * int(req.match.group(1)))
+            return {'id': int(req.match.group(1)), 'auth': req.headers.get('Authorization'),
+                    'fields': req.query.get('fields')}
+
+        @self.app.route('/echo', methods=['POST'])
+        def echo(env, req):
+            return grole.Response(req.data, headers={'Content-Type': req.headers.get('Content-Type')})
+
+        @self.app.route('/binary')
+        def binary(env, req):
+            return b'\xff\x00'
+
+        grole.serve_batch(self.app, '/batch', max_requests=5)
+        self.client = self.app.test_client()
+        self.addCleanup(lambda: a_wait(self.client.close()))
+
+    def test_batch(self):
+        res = a_wait(self.client.post('/batch', headers={'Authorization': 'Bearer x'}, json=[
+            {'path': '/user/2?fields=name'},
+            {'path': '/user/1', 'query': {'fields': 'a b'}, 'headers': {'Authorization': 'other'}},
+            {'method': 'post', 'path': '/echo', 'body': 'text', 'headers': {'Content-Type': 'text/plain'}},
+            {'method': 'POST', 'path': '/echo', 'json': {'a': 1}},
+            {'path': '/binary'}]))
+        self.assertEqual(res.code, 200)
+        first, second, text, obj, binary = res.json()
+        self.assertEqual(first['status'], 200)
+        self.assertEqual(first['json'], {'id': 2, 'auth': 'Bearer x', 'fields': 'name'})
+        self.assertGreater(first['time'], 0)
+        self.assertEqual(second['json'], {'id': 1, 'auth': 'other', 'fields': 'a b'})
+        self.assertEqual(text['body'], 'text')
+        self.assertEqual(text['headers']['Content-Type'], 'text/plain')
+        self.assertEqual(obj['json'], {'a': 1})
+        self.assertEqual(binary['body'], '/wA=')
+        self.assertEqual(binary['encoding'], 'base64')
+
+    def test_cancelled_reacquire(self):
+        queue = self.app.fair_queue
+        body = b'[{"path": "/user/5"}]'
+        request = (b'POST /batch HTTP/1.1\r\nContent-Length: ' + str(len(body)).encode() +
+                   b'\r\n\r\n' + body)
+        async def run():
+            task = asyncio.ensure_future(self.app._handle(FakeReader(request, block=True),
+                                                          FakeWriter()))
+            await asyncio.sleep(0.01) # The sub-request has the slot
+            await queue.acquire('other') # Given the slot before the batch asks for it back
+            await asyncio.sleep(0.01)
+            task.cancel() # While the batch waits to reacquire
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            queue.release()
+        a_wait(run())
+        self.assertEqual(queue._free, 1)
+
+    def test_errors(self):
+        res = a_wait(self.client.post('/batch', json=[{'path': '/missing'}, {'path': '/batch'}]))
+        self.assertEqual([r['status'] for r in res.json()], [404, 400])
+        res = a_wait(self.client.post('/batch', json={'path': '/user/1'}))
+        self.assertEqual(res.code, 400)
+        res = a_wait(self.client.post('/batch', data=b'not json'))
+        self.assertEqual(res.code, 400)
+        res = a_wait(self.client.post('/batch', json=[{'path': '/user/0'}] * 6))
+        self.assertEqual(res.code, 413)
+
 class TestDoc(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,345 @@
+import unittest
+import asyncio
+import base64
+import struct
+from helpers import a_wait
+
+import grole
+
+H2 = grole._HTTP2Connection
+
+class TestHPACK(unittest.TestCase):
+
+    def test_int(self):
+        # RFC 7541 C.1
+        self.assertEqual(grole._hpack_int(10, 5), b'\x0a')
+        self.assertEqual(grole._hpack_int(1337, 5), b'\x1f\x9a\x0a')
+        self.assertEqual(grole._hpack_int(42, 8), b'\x2a')
+
+    def test_requests(self):
+        # RFC 7541 C.3, without Huffman coding
+        decoder = grole._HPACKDecoder()
+        self.assertEqual(decoder.decode(bytes.fromhex('828684410f7777772e6578616d706c652e636f6d')),
+                         [(b':method', b'GET'), (b':scheme', b'http'), (b':path', b'/'),
+                          (b':authority', b'www.example.com')])
+        self.assertEqual(decoder.decode(bytes.fromhex('828684be58086e6f2d6361636865')),
+                         [(b':method', b'GET'), (b':scheme', b'http'), (b':path', b'/'),
+                          (b':authority', b'www.example.com'), (b'cache-control', b'no-cache')])
+        self.assertEqual(decoder.decode(bytes.fromhex(
+            '828785bf400a637573746f6d2d6b65790c637573746f6d2d76616c7565')),
+            [(b':method', b'GET'), (b':scheme', b'https'), (b':path', b'/index.html'),
+             (b':authority', b'www.example.com'), (b'custom-key', b'custom-value')])
+        self.assertEqual(decoder.size, 164)
+
+    def test_huffman(self):
+        # RFC 7541 C.4 and C.6
+        decoder = grole._HPACKDecoder()
+        self.assertEqual(decoder.decode(bytes.fromhex('828684418cf1e3c2e5f23a6ba0ab90f4ff')),
+                         [(b':method', b'GET'), (b':scheme', b'http'), (b':path', b'/'),
+                          (b':authority', b'www.example.com')])
+        self.assertEqual(grole._huffman_decode(bytes.fromhex(
+            'd07abe941054d444a8200595040b8166e082a62d1bff')), b'Mon, 21 Oct 2013 20:13:21 GMT')
+        self.assertEqual(grole._huffman_decode(bytes.fromhex(
+            '94e7821dd7f2e6c7b335dfdfcd5b3960d5af27087f3672c1ab270fb5291f9587316065c003ed4ee5b1063d5007')),
+            b'foo=ASDJKHQKBZXOQWEOPIUAXQWEOIU; max-age=3600; version=1')
+        with self.assertRaises(grole._HTTP2Error):
+            grole._huffman_decode(b'\xf1\xe3\x00') # Padding not EOS
+
+    def test_table_size(self):
+        decoder = grole._HPACKDecoder(max_size=100)
+        decoder.decode(b'\x40\x01a\x01b' * 4) # 34 bytes each
+        self.assertEqual(decoder.size, 68)
+        decoder.decode(b'\x20')
+        self.assertEqual(decoder.size, 0)
+        with self.assertRaises(grole._HTTP2Error):
+            decoder.decode(b'\x3f\x46') # Over max_size
+        with self.assertRaises(grole._HTTP2Error):
+            decoder.decode(b'\xc0') # Index past the table
+        with self.assertRaises(grole._HTTP2Error):
+            decoder.decode(b'\x80') # Index 0
+        with self.assertRaises(grole._HTTP2Error):
+            grole._HPACKDecoder().decode(b'\xbe') # Empty dynamic table
+
+    def test_list_limits(self):
+        decoder = grole._HPACKDecoder()
+        block = b'\x40\x01a\x01b' + b'\xbe' * 10 # Added to the table, then repeated
+        self.assertIsNone(decoder.decode(block, max_size=34 * 10))
+        self.assertEqual(decoder.size, 34) # Still decoded
+        self.assertIsNone(decoder.decode(b'\xbe' * 4, max_count=3))
+        self.assertEqual(len(decoder.decode(b'\xbe' * 4, max_size=34 * 4, max_count=4)), 4)
+        # A table size update in the block doesn't affect the list size
+        self.assertEqual(len(decoder.decode(b'\xbe\x3f\xe1\x1f' + b'\x82' * 2, max_size=34 + 2 * 42)), 3)
+
+    def test_encode(self):
+        headers = [(b':status', b'200'), (b':status', b'201'), (b'content-type', b'text/html'),
+                   (b'x-custom', b'value')]
+        block = grole._hpack_encode(headers)
+        self.assertEqual(block[0], 0x88)
+        self.assertEqual(grole._HPACKDecoder().decode(block), headers)
+
+class Client:
+    """
+    Minimal HTTP/2 client, reading frames and gathering responses by stream
+    """
+    def __init__(self, reader, writer, settings=b''):
+        self.reader = reader
+        self.writer = writer
+        self.decoder = grole._HPACKDecoder()
+        self.frames = []
+        self.responses = {} # stream id -> {'headers': ..., 'body': ..., 'done': ...}
+        self.window_updates = []
+        self.window = 65535
+        self.settings = settings
+
+    def frame(self, kind, flags, stream_id, payload=b''):
+        self.writer.write(struct.pack('>IBI', len(payload) << 8 | kind, flags, stream_id) + payload)
+
+    def start(self, preface=True):
+        if preface:
+            self.writer.write(H2.PREFACE)
+        self.frame(H2.SETTINGS, 0, 0, self.settings)
+
+    def request(self, stream_id, method, path, body=None, headers=[]):
+        block = grole._hpack_encode([(b':method', method), (b':scheme', b'http'),
+                                     (b':path', path), (b':authority', b'test')] + headers)
+        self.frame(H2.HEADERS, H2.END_HEADERS | (0 if body else H2.END_STREAM), stream_id, block)
+        if body:
+            self.frame(H2.DATA, H2.END_STREAM, stream_id, body)
+
+    async def read_frame(self):
+        head = await asyncio.wait_for(self.reader.readexactly(9), 5)
+        length_kind, flags, stream_id = struct.unpack('>IBI', head)
+        payload = await self.reader.readexactly(length_kind >> 8)
+        frame = (length_kind & 0xff, flags, stream_id, payload)
+        self.frames.append(frame)
+        kind = frame[0]
+        if kind == H2.HEADERS:
+            self.responses[stream_id] = {'headers': dict(self.decoder.decode(payload)), 'body': b'',
+                                         'done': bool(flags & H2.END_STREAM)}
+        elif kind == H2.DATA:
+            self.responses[stream_id]['body'] += payload
+            self.responses[stream_id]['done'] = bool(flags & H2.END_STREAM)
+            if payload:
+                self.frame(H2.WINDOW_UPDATE, 0, 0, struct.pack('>I', len(payload)))
+        elif kind == H2.WINDOW_UPDATE:
+            self.window_updates.append((stream_id, struct.unpack('>I', payload)[0]))
+        return frame
+
+    async def wait(self, *stream_ids):
+        """
+        Read frames until the responses on stream_ids are complete, returns their completion order
+        """
+        order = []
+        while len(order) < len(stream_ids):
+            kind, flags, stream_id, _ = await self.read_frame()
+            if stream_id in stream_ids and stream_id not in order and flags & H2.END_STREAM and \
+                    kind in (H2.DATA, H2.HEADERS):
+                order.append(stream_id)
+        return order
+
+class TestHTTP2(unittest.TestCase):
+
+    def setUp(self):
+        self.app = grole.Grole(http2=True)
+
+        @self.app.route('/hello', methods=['GET', 'POST'])
+        def hello(env, req):
+            return grole.Response('Hello ' + req.version + ' ' + req.headers.get('Host', ''),
+                                  headers={'X-Query': req.query.get('q')})
+
+        @self.app.route('/slow')
+        async def slow(env, req):
+            await asyncio.sleep(0.05)
+            return 'slow'
+
+        @self.app.route('/upload', methods=['POST'], buffer=False)
+        async def upload(env, req):
+            total = 0
+            while True:
+                data = await req.read(10000)
+                if not data:
+                    return total
+                total += len(data)
+
+        @self.app.route('/big')
+        def big(env, req):
+            return b'x' * 100000
+
+        self.listener = grole.Listener('127.0.0.1', 0)
+
+    def _run(self, test, app=None):
+        """
+        Start the server and run test with a connected (reader, writer)
+        """
+        async def run():
+            server = await self.listener._start((app or self.app)._handle)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            try:
+                return await test(reader, writer)
+            finally:
+                writer.close()
+                await asyncio.sleep(0.01)
+                await self.listener._close()
+        return a_wait(run())
+
+    def test_prior_knowledge(self):
+        async def test(reader, writer):
+            client = Client(reader, writer)
+            client.start()
+            client.request(1, b'GET', b'/hello?q=a%20b')
+            client.request(3, b'HEAD', b'/hello')
+            client.request(5, b'GET', b'/missing')
+            await client.wait(1, 3, 5)
+            return client
+        client = self._run(test)
+        self.assertEqual(client.frames[0][0], H2.SETTINGS)
+        res = client.responses[1]
+        self.assertEqual(res['headers'][b':status'], b'200')
+        self.assertEqual(res['headers'][b'x-query'], b'a b')
+        self.assertEqual(res['headers'][b'content-length'], b'17')
+        self.assertEqual(res['body'], b'Hello HTTP/2 test')
+        self.assertEqual(client.responses[3]['headers'][b'content-length'], b'17')
+        self.assertEqual(client.responses[3]['body'], b'')
+        self.assertEqual(client.responses[5]['headers'][b':status'], b'404')
+
+    def test_settings(self):
+        self.app.http2 = grole.HTTP2Settings(max_streams=7)
+        async def test(reader, writer):
+            client = Client(reader, writer)
+            client.start()
+            client.request(1, b'GET', b'/hello')
+            await client.wait(1)
+            return client
+        client = self._run(test)
+        kind, _, _, payload = client.frames[0]
+        self.assertEqual(kind, H2.SETTINGS)
+        self.assertIn(struct.pack('>HI', 3, 7), payload)
+        self.assertIsNone(grole.Grole(http2=False).http2)
+
+    def test_header_list_too_large(self):
+        self.app.limits.max_headers = 10
+        async def test(reader, writer):
+            client = Client(reader, writer)
+            client.start()
+            client.request(1, b'GET', b'/hello', headers=[(b'x-a', b'1')] * 20)
+            client.request(3, b'GET', b'/hello', headers=[(b'x-a', b'1')] * 2)
+            await client.wait(1, 3)
+            return client
+        client = self._run(test)
+        settings = client.frames[0][3]
+        self.assertIn(struct.pack('>HI', 6, 64 * 1024), [settings[i:i + 6] for i in range(0, len(settings), 6)])
+        self.assertEqual(client.responses[1]['headers'][b':status'], b'431')
+        self.assertEqual(client.responses[3]['headers'][b':status'], b'200')
+        self.assertEqual(self.app.metrics['headers_too_large'], 1)
+
+    def test_multiplexed(self):
+        async def test(reader, writer):
+            client = Client(reader, writer)
+            client.start()
+            client.request(1, b'GET', b'/slow')
+            client.request(3, b'GET', b'/hello')
+            return client, await client.wait(1, 3)
+        client, order = self._run(test)
+        self.assertEqual(order, [3, 1])
+        self.assertEqual(client.responses[1]['body'], b'slow')
+
+    def test_upload_flow_control(self):
+        # Over the initial 65535 byte window, so needs WINDOW_UPDATEs from reading
+        data = b'y' * 100000
+        async def test(reader, writer):
+            client = Client(reader, writer)
+            client.start()
+            block = grole._hpack_encode([(b':method', b'POST'), (b':scheme', b'http'),
+                                         (b':path', b'/upload')])
+            client.frame(H2.HEADERS, H2.END_HEADERS, 1, block)
+            sent = 0
+            window = 65535
+            while sent < len(data):
+                size = min(16384, window, len(data) - sent)
+                if size == 0:
+                    while not any(s == 0 for s, _ in client.window_updates):
+                        await client.read_frame()
+                    window += sum(n for s, n in client.window_updates if s == 0)
+                    client.window_updates = []
+                    continue
+                end = H2.END_STREAM if sent + size == len(data) else 0
+                client.frame(H2.DATA, end, 1, data[sent:sent + size])
+                sent += size
+                window -= size
+            await client.wait(1)
+            return client
+        client = self._run(test)
+        self.assertEqual(client.responses[1]['body'], b'100000')
+
+    def test_response_flow_control(self):
+        async def test(reader, writer):
+            client = Client(reader, writer, settings=struct.pack('>HI', 4, 1000))
+            client.start()
+            client.request(1, b'GET', b'/big')
+            try:
+                while True:
+                    await asyncio.wait_for(client.read_frame(), 0.05)
+            except asyncio.TimeoutError:
+                pass # Nothing more until the window is opened
+            stalled = len(client.responses[1]['body'])
+            client.frame(H2.WINDOW_UPDATE, 0, 1, struct.pack('>I', 200000))
+            await client.wait(1)
+            return stalled, client
+        stalled, client = self._run(test)
+        self.assertEqual(stalled, 1000)
+        self.assertEqual(client.responses[1]['body'], b'x' * 100000)
+
+    def test_ping_settings(self):
+        async def test(reader, writer):
+            client = Client(reader, writer)
+            client.start()
+            client.frame(H2.PING, 0, 0, b'12345678')
+            while not any(f[0] == H2.PING for f in client.frames):
+                await client.read_frame()
+            return client
+        client = self._run(test)
+        kinds = [(f[0], f[1]) for f in client.frames]
+        self.assertIn((H2.SETTINGS, H2.ACK), kinds)
+        self.assertEqual(client.frames[-1], (H2.PING, H2.ACK, 0, b'12345678'))
+
+    def test_protocol_error(self):
+        async def test(reader, writer):
+            client = Client(reader, writer)
+            client.start()
+            client.frame(H2.DATA, 0, 0, b'data')
+            while not client.frames or client.frames[-1][0] != H2.GOAWAY:
+                await client.read_frame()
+            return client, await reader.read()
+        client, rest = self._run(test)
+        self.assertEqual(client.frames[-1][3], struct.pack('>II', 0, H2.PROTOCOL_ERROR))
+        self.assertEqual(rest, b'') # Closed
+
+    def test_upgrade(self):
+        settings = base64.urlsafe_b64encode(struct.pack('>HI', 4, 65535)).rstrip(b'=')
+        async def test(reader, writer):
+            writer.write(b'GET /hello?q=up HTTP/1.1\r\nHost: test\r\nConnection: Upgrade, HTTP2-Settings\r\n'
+                         b'Upgrade: h2c\r\nHTTP2-Settings: ' + settings + b'\r\n\r\n')
+            switching = await reader.readuntil(b'\r\n\r\n')
+            client = Client(reader, writer)
+            client.start()
+            await client.wait(1)
+            client.request(3, b'GET', b'/hello')
+            await client.wait(3)
+            return switching, client
+        switching, client = self._run(test)
+        self.assertTrue(switching.startswith(b'HTTP/1.1 101 Switching Protocols\r\n'))
+        self.assertIn(b'Upgrade: h2c', switching)
+        self.assertEqual(client.responses[1]['headers'][b'x-query'], b'up')
+        self.assertEqual(client.responses[1]['body'], b'Hello HTTP/2 test')
+        self.assertEqual(client.responses[3]['body'], b'Hello HTTP/2 test')
+
+    def test_disabled(self):
+        async def test(reader, writer):
+            writer.write(H2.PREFACE)
+            return await reader.readuntil(b'\r\n\r\n')
+        head = self._run(test, grole.Grole())
+        self.assertTrue(head.startswith(b'HTTP/1.1 404'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,34 @@
 import unittest
+import unittest.mock
+import tempfile
+import os
 
 import grole
 
 class TestMain(unittest.TestCase):
 
+    def setUp(self):
+        # Don't actually serve, that would run forever wherever port 80 can be bound
+        patcher = unittest.mock.patch.object(grole.Grole, 'run')
+        self.run = patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_launch(self):
-        # Success is that it doesn't do anything
         grole.main(['-p', '80'])
+        self.run.assert_called_once()
+        listener, = self.run.call_args[1]['listeners']
+        self.assertEqual((listener.host, listener.port), ('localhost', 80))
 
     def test_launch2(self):
-        # Success is that it doesn't do anything
         grole.main(['-p', '80', '-q'])
+        self.run.assert_called_once()
 
     def test_launch3(self):
-        # Success is that it doesn't do anything
         grole.main(['-p', '80', '-v'])
+        self.run.assert_called_once()
+
+    def test_pack(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'test.pack')
+            grole.main(['pack', os.path.dirname(__file__), output, '-n'])
+            self.assertIn('test.dat', grole.StaticPack(output).files)
@@ -0,0 +1,126 @@
+import unittest
+from helpers import FakeReader, FakeWriter, a_wait
+
+import grole
+
+CONTENT = b'--XyZ-in-content\r\n-' + bytes(range(256)) * 40
+
+BODY = b'\r\n'.join([b'preamble',
+                     b'--XyZ',
+                     b'Content-Disposition: form-data; name="field"',
+                     b'',
+                     b'value',
+                     b'--XyZ',
+                     b'Content-Disposition: form-data; name="upload"; filename="a \\"b\\".txt"',
+                     b'Content-Type: application/octet-stream',
+                     b'',
+                     CONTENT,
+                     b'--XyZ--',
+                     b'epilogue'])
+
+def parse(body=BODY, **kwargs):
+    req = grole.Request()
+    req.headers = {'Content-Type': 'multipart/form-data; boundary=XyZ'}
+    req.data = body
+    async def run():
+        parts = []
+        async for part in req.multipart(**kwargs):
+            parts.append(part)
+        return parts
+    return a_wait(run())
+
+class TestMultipart(unittest.TestCase):
+
+    def test_parts(self):
+        field, upload = parse()
+        self.assertEqual(field.name, 'field')
+        self.assertIsNone(field.filename)
+        self.assertEqual(field.text(), 'value')
+        self.assertEqual(upload.name, 'upload')
+        self.assertEqual(upload.filename, 'a "b".txt')
+        self.assertEqual(upload.content_type, 'application/octet-stream')
+        self.assertEqual(upload.read(), CONTENT)
+        self.assertEqual(upload.size, len(CONTENT))
+
+    def test_small_chunks(self):
+        for chunk_size in (1, 3, 7):
+            field, upload = parse(chunk_size=chunk_size)
+            self.assertEqual(field.read(), b'value')
+            self.assertEqual(upload.read(), CONTENT)
+
+    def test_spool(self):
+        field, upload = parse(spool_size=1000)
+        self.assertFalse(field.file._rolled)
+        self.assertTrue(upload.file._rolled) # Moved to disk
+        self.assertEqual(upload.read()[-256:], bytes(range(256)))
+        upload.close()
+
+    def test_max_parts(self):
+        with self.assertRaises(grole.MultipartError) as cm:
+            parse(max_parts=1)
+        self.assertEqual(cm.exception.code, 413)
+
+    def test_max_part_size(self):
+        with self.assertRaises(grole.MultipartError) as cm:
+            parse(max_part_size=1000)
+        self.assertEqual(cm.exception.code, 413)
+
+    def test_truncated(self):
+        with self.assertRaises(grole.MultipartError) as cm:
+            parse(BODY[:100])
+        self.assertEqual(cm.exception.code, 400)
+
+    def test_no_boundary(self):
+        req = grole.Request()
+        req.headers = {'Content-Type': 'multipart/form-data'}
+        with self.assertRaises(grole.MultipartError):
+            req.multipart()
+
+class TestStreamedUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.app = grole.Grole()
+
+        @self.app.route('/upload', methods=['POST'], buffer=False)
+        async def upload(env, req):
+            self.assertEqual(req.data, b'')
+            ret = []
+            async for part in req.multipart(chunk_size=100):
+                ret.append([part.name, part.size])
+            return ret
+
+        @self.app.route('/ignore', methods=['POST'], buffer=False)
+        def ignore(env, req):
+            return 'ignored'
+
+        @self.app.route('/reject', methods=['POST'], buffer=False)
+        def reject(env, req):
+            raise grole.HTTPError(413, 'Payload Too Large')
+
+    def _post(self, path):
+        head = 'POST {} HTTP/1.1\r\nContent-Type: multipart/form-data; boundary=XyZ\r\nContent-Length: {}\r\n\r\n'
+        return head.format(path, len(BODY)).encode() + BODY
+
+    def test_upload(self):
+        rd = FakeReader(data=self._post('/upload'))
+        wr = FakeWriter()
+        a_wait(self.app._handle(rd, wr))
+        data = wr.data.split(b'\r\n\r\n')[1]
+        self.assertEqual(data, '[["field", 5], ["upload", {}]]'.format(len(CONTENT)).encode())
+
+    def test_unread_body_discarded(self):
+        rd = FakeReader(data=self._post('/ignore') + self._post('/upload'))
+        wr = FakeWriter()
+        a_wait(self.app._handle(rd, wr))
+        self.assertEqual(wr.data.count(b'HTTP/1.1 200 OK'), 2)
+
+    def test_rejected_closes(self):
+        rd = FakeReader(data=self._post('/reject') + self._post('/upload'))
+        wr = FakeWriter()
+        a_wait(self.app._handle(rd, wr))
+        self.assertTrue(wr.data.startswith(b'HTTP/1.1 413 Payload Too Large'))
+        self.assertEqual(wr.data.count(b'HTTP/1.1'), 1)
+        self.assertTrue(wr.closed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import unittest
+import unittest.mock
+import asyncio
+import time
+from helpers import FakeReader, FakeWriter, a_wait
+
+import grole
+
+class TestProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = grole.Grole()
+
+        @self.upstream.route('/v1/echo', methods=['GET', 'POST'])
+        def echo(env, req):
+            return grole.Response(req.method.encode() + b' ' + req.location.encode() + b' ' + req.data,
+                                  headers={'X-Upstream': 'yes', 'X-Host': req.headers.get('Host')})
+
+        @self.upstream.route('/v1/stream')
+        def stream(env, req):
+            return grole.ResponseStream(str(i) for i in range(1000))
+
+        @self.upstream.route('/v1/slow')
+        async def slow(env, req):
+            await asyncio.sleep(0.05)
+            return 'slow'
+
+        self.listener = grole.Listener('127.0.0.1', 0)
+        self.app = grole.Grole()
+
+    def _run(self, test, **kwargs):
+        """
+        Start the upstream then run test with the proxy pool
+        """
+        async def run():
+            server = await self.listener._start(self.upstream._handle)
+            port = server.sockets[0].getsockname()[1]
+            pool = grole.proxy(self.app, '/api', 'http://127.0.0.1:{}/v1'.format(port), **kwargs)
+            try:
+                return await test(pool)
+            finally:
+                pool.close()
+                await asyncio.sleep(0.01)
+                await self.listener._close()
+        return a_wait(run())
+
+    async def _get(self, request):
+        wr = FakeWriter()
+        await self.app._handle(FakeReader(request), wr)
+        head, body = wr.data.split(b'\r\n\r\n', 1)
+        return head, body
+
+    def test_get(self):
+        async def test(pool):
+            first = await self._get(b'GET /api/echo?a=%20b HTTP/1.1\r\nConnection: keep-alive\r\n\r\n')
+            second = await self._get(b'GET /api/echo HTTP/1.1\r\n\r\n')
+            return pool, first, second
+        pool, (head, body), (_, body2) = self._run(test)
+        self.assertTrue(head.startswith(b'HTTP/1.1 200 OK'))
+        self.assertIn(b'X-Upstream: yes', head)
+        self.assertRegex(head, br'X-Host: 127\.0\.0\.1:\d+')
+        self.assertEqual(body, b'GET /v1/echo?a=%20b ')
+        self.assertEqual(body2, b'GET /v1/echo ')
+        report = pool.report()
+        self.assertEqual(report['connects'], 1)
+        self.assertEqual(report['reuses'], 1)
+        self.assertEqual(report['reuse_rate'], 0.5)
+        self.assertEqual(report['in_use'], 0)
+
+    def test_streaming(self):
+        data = bytes(range(256)) * 1000
+        async def test(pool):
+            post = await self._get(b'POST /api/echo HTTP/1.1\r\nContent-Length: ' +
+                                   str(len(data)).encode() + b'\r\n\r\n' + data)
+            stream = await self._get(b'GET /api/stream HTTP/1.1\r\n\r\n')
+            return pool, post, stream
+        pool, (head, body), (head2, body2) = self._run(test, chunk_size=4096)
+        self.assertIn(b'Content-Length: ' + str(len(data) + 14).encode(), head)
+        self.assertEqual(body, b'POST /v1/echo ' + data)
+        self.assertIn(b'Transfer-Encoding: chunked', head2)
+        chunks = []
+        while True:
+            size, body2 = body2.split(b'\r\n', 1)
+            size = int(size, 16)
+            chunks.append(body2[:size])
+            body2 = body2[size + 2:]
+            if size == 0:
+                break
+        self.assertEqual(b''.join(chunks), ''.join(str(i) for i in range(1000)).encode())
+        self.assertEqual(pool.report()['connects'], 1)
+
+    def test_head(self):
+        async def test(pool):
+            head = await self._get(b'HEAD /api/echo HTTP/1.1\r\n\r\n')
+            get = await self._get(b'GET /api/echo HTTP/1.1\r\n\r\n')
+            return pool, head, get
+        pool, (head, body), (_, body2) = self._run(test)
+        self.assertIn(b'Content-Length: 14', head)
+        self.assertEqual(body, b'')
+        self.assertEqual(body2, b'GET /v1/echo ')
+        self.assertEqual(pool.report()['reuses'], 1)
+
+    def test_max_size(self):
+        async def test(pool):
+            results = await asyncio.gather(*[self._get(b'GET /api/slow HTTP/1.1\r\n\r\n') for i in range(3)])
+            return pool, results
+        pool, results = self._run(test, max_size=1)
+        for head, body in results:
+            self.assertEqual(body, b'slow')
+        self.assertEqual(pool.report()['connects'], 1)
+        self.assertEqual(pool.report()['reuses'], 2)
+
+    def test_idle_timeout(self):
+        async def test(pool):
+            await self._get(b'GET /api/echo HTTP/1.1\r\n\r\n')
+            await asyncio.sleep(0.02)
+            await self._get(b'GET /api/echo HTTP/1.1\r\n\r\n')
+            return pool
+        pool = self._run(test, idle_timeout=0.01)
+        self.assertEqual(pool.report()['connects'], 2)
+        self.assertEqual(pool.report()['evicted'], 1)
+
+    def test_upstream_closed(self):
+        async def test(pool):
+            await self._get(b'GET /api/echo HTTP/1.1\r\n\r\n')
+            for conn in list(self.upstream._connections.values()):
+                conn.writer.close() # Upstream drops the idle connection
+            await asyncio.sleep(0.01)
+            return pool, await self._get(b'GET /api/echo HTTP/1.1\r\n\r\n')
+        pool, (head, body) = self._run(test)
+        self.assertEqual(body, b'GET /v1/echo ')
+        self.assertEqual(pool.report()['connects'], 2)
+
+    def test_set_cookie(self):
+        cookies = ['a=1; Expires=Wed, 21 Oct 2037 07:28:00 GMT', 'b=2']
+
+        @self.upstream.route('/v1/cookies')
+        def set_cookies(env, req):
+            return grole.Response('', headers={'Set-Cookie': cookies})
+
+        async def test(pool):
+            return await self._get(b'GET /api/cookies HTTP/1.1\r\n\r\n')
+        head, _ = self._run(test)
+        self.assertEqual(head.count(b'Set-Cookie: '), 2)
+        for cookie in cookies:
+            self.assertIn(b'\r\nSet-Cookie: ' + cookie.encode() + b'\r\n', head + b'\r\n')
+
+    def test_cancelled_waiter(self):
+        pool = grole.UpstreamPool('127.0.0.1', 1, max_size=1)
+        idle = (unittest.mock.Mock(**{'at_eof.return_value': False}),
+                unittest.mock.Mock(**{'transport.is_closing.return_value': False}))
+        async def run():
+            pool._idle.append(idle + (time.monotonic(),))
+            first = await pool.acquire()
+            waiters = [asyncio.ensure_future(pool.acquire()) for _ in range(2)]
+            await asyncio.sleep(0)
+            pool.release(*first[:2])
+            waiters[0].cancel() # Woken but cancelled before running
+            return await asyncio.wait_for(waiters[1], 1)
+        self.assertEqual(a_wait(run()), idle + (True,))
+
+    def test_down(self):
+        pool = grole.proxy(self.app, '/api', 'http://127.0.0.1:1/v1', retry_after=60)
+        head, body = a_wait(self._get(b'GET /api/echo HTTP/1.1\r\n\r\n'))
+        self.assertTrue(head.startswith(b'HTTP/1.1 502 Bad Gateway'))
+        a_wait(self._get(b'GET /api/echo HTTP/1.1\r\n\r\n'))
+        self.assertEqual(pool.report()['failures'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
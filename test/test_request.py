@@ -15,6 +15,11 @@ class TestEncoding(unittest.TestCase):
     def test_json(self):
         self.assertEqual(self.req.json(), {'foo': 'bar'})
 
+    def test_json_backend(self):
+        req = grole.Request(grole.JSONBackend('auto'))
+        req.data = self.req.data
+        self.assertEqual(req.json(), {'foo': 'bar'})
+
 class TestReading(unittest.TestCase):
     
     def setUp(self):
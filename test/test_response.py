@@ -1,5 +1,9 @@
 import unittest
+import unittest.mock
 import pathlib
+import json
+import os
+import tempfile
 from helpers import FakeWriter, a_wait
 
 import grole
@@ -88,6 +92,60 @@ class TestJSON(unittest.TestCase):
         a_wait(self.res._write(writer))
         self.assertEqual(writer.data, b'{"foo": "bar"}')
 
+class TestJSONStream(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {'foo': list(range(5000))}
+        self.res = grole.ResponseJSON(self.data, stream=True)
+
+    def test_headers(self):
+        hdr = {}
+        self.res._set_headers(hdr)
+        self.assertDictEqual(hdr, {'Transfer-Encoding': 'chunked',
+                                   'Content-Type': 'application/json'})
+
+    def test_data(self):
+        writer = FakeWriter()
+        a_wait(self.res._write(writer))
+        body = b''
+        rest = writer.data
+        while True:
+            size, rest = rest.split(b'\r\n', 1)
+            size = int(size, 16)
+            if size == 0:
+                break
+            body += rest[:size]
+            rest = rest[size + 2:]
+        self.assertGreater(writer.data.count(b'\r\n'), 4) # More than one chunk
+        self.assertEqual(json.loads(body.decode()), self.data)
+
+class TestJSONBackend(unittest.TestCase):
+
+    def test_default(self):
+        self.assertEqual(grole.JSONBackend().name, 'json')
+
+    def test_auto(self):
+        backend = grole.JSONBackend('auto')
+        self.assertIn(backend.name, grole.JSONBackend.FAST + ('json',))
+        self.assertEqual(backend.loads(backend.dumps({'foo': 'bar'})), {'foo': 'bar'})
+
+    def test_missing(self):
+        with self.assertRaises(ImportError):
+            grole.JSONBackend('notajsonmodule')
+
+    def test_backend(self):
+        backend = grole.JSONBackend('auto')
+        res = grole.ResponseJSON({'foo': 'bar'}, backend=backend)
+        self.assertEqual(json.loads(res._data.decode()), {'foo': 'bar'})
+
+class TestStream(unittest.TestCase):
+
+    def test_data(self):
+        res = grole.ResponseStream(['foo', b'', b'bar'])
+        writer = FakeWriter()
+        a_wait(res._write(writer))
+        self.assertEqual(writer.data, b'3\r\nfoo\r\n3\r\nbar\r\n0\r\n\r\n')
+
 class TestFile(unittest.TestCase):
 
     def setUp(self):
@@ -105,6 +163,69 @@ class TestFile(unittest.TestCase):
         a_wait(self.res._write(writer))
         self.assertEqual(writer.data, b'4\r\nfoo\n\r\n0\r\n\r\n')
 
+    def test_large(self):
+        content = os.urandom(300000)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            writer = FakeWriter()
+            a_wait(grole.ResponseFile(f.name)._write(writer))
+
+        chunks = []
+        data = writer.data
+        while True:
+            size, data = data.split(b'\r\n', 1)
+            size = int(size, 16)
+            chunks.append(data[:size])
+            data = data[size + 2:]
+            if size == 0:
+                break
+        self.assertEqual(data, b'')
+        self.assertEqual(b''.join(chunks), content)
+        self.assertEqual(len(chunks[0]), grole._read_size(len(content)))
+
+    def test_short_reads(self):
+        # Like a network filesystem, returning less than asked for
+        content = os.urandom(10000)
+        class Short:
+            def __init__(self):
+                self.pos = 0
+            def read(self, n):
+                data = content[self.pos:self.pos + min(n, 999)]
+                self.pos += len(data)
+                return data
+            def close(self):
+                pass
+        writer = FakeWriter()
+        with unittest.mock.patch('grole._open_file', return_value=(Short(), len(content))):
+            a_wait(grole.ResponseFile('short')._write(writer))
+        body, data = b'', writer.data
+        while True:
+            size, data = data.split(b'\r\n', 1)
+            size = int(size, 16)
+            body += data[:size]
+            data = data[size + 2:]
+            if size == 0:
+                break
+        self.assertEqual(body, content)
+
+    def test_read_size(self):
+        self.assertEqual(grole._read_size(0), 1)
+        self.assertEqual(grole._read_size(1000), 1001)
+        self.assertEqual(grole._read_size(1 << 20), 1 << 17)
+        self.assertEqual(grole._read_size(1 << 30), 1 << 20)
+
+    def test_pool_after_fork(self):
+        pool = grole._file_executor()
+        self.assertIs(grole._file_executor(), pool)
+        with unittest.mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(grole._file_executor(), pool)
+
+    def test_missing(self):
+        res = grole.ResponseFile('/does/not/exist')
+        with self.assertRaises(FileNotFoundError):
+            a_wait(res._write(FakeWriter()))
+
 
 class TestAuto(unittest.TestCase):
 
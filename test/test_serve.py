@@ -4,8 +4,15 @@ import io
 import multiprocessing
 import urllib.request
 import time
+import os
+import shutil
+import ssl
+import socket
+import stat
+import tempfile
 
 import grole
+from helpers import a_wait
 
 def simple_server():
     app = grole.Grole()
@@ -43,4 +50,181 @@ class TestServe(unittest.TestCase):
         self.assertRaises(urllib.error.URLError)
         p.terminate()
 
+class TestListener(unittest.TestCase):
 
+    def setUp(self):
+        self.app = grole.Grole()
+
+        @self.app.route('/')
+        def hello(env, req):
+            return 'Hello, World!'
+
+    def _get(self, listener, connect):
+        async def run():
+            await listener._start(self.app._handle)
+            reader, writer = await connect()
+            writer.write(b'GET / HTTP/1.1\r\n\r\n')
+            data = await reader.readuntil(b'World!')
+            writer.close()
+            await asyncio.sleep(0.01) # Let the server see the close
+            await listener._close()
+            return data
+        return a_wait(run())
+
+    def test_unix(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'grole.sock')
+        listener = grole.Listener(path=path, mode=0o600)
+        async def connect():
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+            return await asyncio.open_unix_connection(path)
+        data = self._get(listener, connect)
+        self.assertTrue(data.endswith(b'Hello, World!'))
+        self.assertFalse(os.path.exists(path))
+
+    def test_fd(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen()
+        port = sock.getsockname()[1]
+        listener = grole.Listener(fd=sock.detach(), nodelay=True, fastopen=5)
+        data = self._get(listener, lambda: asyncio.open_connection('127.0.0.1', port))
+        self.assertTrue(data.endswith(b'Hello, World!'))
+
+    def test_fds(self):
+        # Several sockets for one listener, as handed over on reload for dual stack
+        socks = []
+        for _ in range(2):
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            sock.listen()
+            socks.append(sock)
+        ports = [sock.getsockname()[1] for sock in socks]
+        listener = grole.Listener(fd=[sock.detach() for sock in socks])
+        async def run():
+            await listener._start(self.app._handle)
+            names = [sock.getsockname()[1] for sock in listener.sockets()]
+            data = []
+            for port in ports:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(b'GET / HTTP/1.1\r\n\r\n')
+                data.append(await reader.readuntil(b'World!'))
+                writer.close()
+            await asyncio.sleep(0.01)
+            await listener._close()
+            return names, data
+        names, data = a_wait(run())
+        self.assertEqual(names, ports)
+        self.assertEqual(len(data), 2)
+
+    def test_inherited_fds(self):
+        os.environ['GROLE_LISTEN_FDS'] = '3+4,5'
+        self.assertEqual(grole._inherited_fds(), [[3, 4], [5]])
+        self.assertNotIn('GROLE_LISTEN_FDS', os.environ)
+
+class TestTLS(unittest.TestCase):
+
+    HERE = os.path.dirname(os.path.abspath(__file__))
+    CERT = os.path.join(HERE, 'cert.pem')
+    KEY = os.path.join(HERE, 'key.pem')
+
+    def setUp(self):
+        self.app = grole.Grole()
+
+        @self.app.route('/')
+        def hello(env, req):
+            return 'Hello, World!'
+
+        self.tls = grole.TLSContext(self.CERT, self.KEY)
+        self.client = ssl.create_default_context(cafile=self.CERT)
+
+    def _serve(self, client):
+        """
+        Run client(port) in a thread against a TLS listener
+        """
+        listener = grole.Listener('127.0.0.1', 0, ssl_context=self.tls)
+        async def run():
+            server = await listener._start(self.app._handle)
+            port = server.sockets[0].getsockname()[1]
+            loop = asyncio.get_event_loop()
+            try:
+                return await loop.run_in_executor(None, client, port)
+            finally:
+                await asyncio.sleep(0.01)
+                await listener._close()
+        return a_wait(run())
+
+    def _get(self, port, session=None):
+        with socket.create_connection(('127.0.0.1', port)) as sock:
+            with self.client.wrap_socket(sock, server_hostname='localhost', session=session) as tls:
+                tls.sendall(b'GET / HTTP/1.1\r\n\r\n')
+                data = b''
+                while not data.endswith(b'World!'):
+                    data += tls.recv(4096)
+                return data, tls.session, tls.selected_alpn_protocol()
+
+    def test_resume(self):
+        self.client.set_alpn_protocols(['h2', 'http/1.1'])
+        def client(port):
+            data, session, alpn = self._get(port)
+            self.assertTrue(data.endswith(b'Hello, World!'))
+            self.assertEqual(alpn, 'http/1.1')
+            self._get(port, session)
+        self._serve(client)
+        stats = self.tls.stats()
+        self.assertEqual(stats['handshakes'], 2)
+        self.assertEqual(stats['resumed'], 1)
+        self.assertEqual(stats['resumption_rate'], 0.5)
+        self.assertEqual(stats['failed'], 0)
+        self.assertGreater(stats['max_handshake'], 0)
+
+    def test_failure(self):
+        def client(port):
+            with self.assertRaises(ssl.SSLError):
+                self._get(port)
+        self.client = ssl.create_default_context() # Doesn't trust our cert
+        self._serve(client)
+        stats = self.tls.stats()
+        self.assertEqual(stats['handshakes'], 0)
+        self.assertEqual(stats['failed'], 1)
+
+    def test_reload(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cert = os.path.join(tmp.name, 'cert.pem')
+        key = os.path.join(tmp.name, 'key.pem')
+        shutil.copy(self.CERT, cert)
+        shutil.copy(self.KEY, key)
+        self.tls = grole.TLSContext(cert, key, reload_interval=0)
+        first = self.tls.context
+
+        # A broken file is logged and the old certificate kept
+        with open(cert, 'w') as f:
+            f.write('junk')
+        os.utime(cert, ns=(0, 0))
+        with self.assertLogs('grole', 'ERROR'):
+            data, _, _ = self._serve(self._get)
+            self.tls._checking.result()
+        self.assertTrue(data.endswith(b'Hello, World!'))
+
+        # So is a key which doesn't match the certificate, later handshakes still succeed
+        shutil.copy(self.CERT, cert)
+        shutil.copy(os.path.join(self.HERE, 'other_key.pem'), key)
+        with self.assertLogs('grole', 'ERROR'):
+            self._serve(self._get)
+            self.tls._checking.result()
+        data, _, _ = self._serve(self._get)
+        self.assertTrue(data.endswith(b'Hello, World!'))
+        self.assertIs(self.tls.context, first)
+
+        shutil.copy(self.KEY, key)
+        self._serve(self._get)
+        self.tls._checking.result()
+        # The new context is used from the next handshake
+        data, _, _ = self._serve(self._get)
+        self.assertTrue(data.endswith(b'Hello, World!'))
+        self.assertIsNot(self.tls.context, first)
+        self.assertEqual(self.tls.stats()['handshakes'], 5)
+        self.assertEqual(self.tls.stats()['failed'], 0)
+        self.assertEqual(self.tls.stats()['reloads'], 1)